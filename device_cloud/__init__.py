@@ -23,15 +23,41 @@ from logging import INFO as LOGINFO
 from logging import NOTSET as LOGNOTSET
 from logging import WARNING as LOGWARNING
 
+import sys
+
 from device_cloud._core.client import Client
 from device_cloud._core.handler import status_string
 
+from device_cloud._core.constants import ACTION_POLICY_QUEUE
+from device_cloud._core.constants import ACTION_POLICY_REJECT
+
+from device_cloud._core.constants import AGGREGATE_AVG
+from device_cloud._core.constants import AGGREGATE_COUNT
+from device_cloud._core.constants import AGGREGATE_LAST
+from device_cloud._core.constants import AGGREGATE_MAX
+from device_cloud._core.constants import AGGREGATE_MIN
+from device_cloud._core.constants import AGGREGATE_SUM
+
 from device_cloud._core.constants import DEFAULT_CONFIG_DIR
 from device_cloud._core.constants import DEFAULT_CONFIG_FILE
 from device_cloud._core.constants import DEFAULT_KEEP_ALIVE
 from device_cloud._core.constants import DEFAULT_LOOP_TIME
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_POLICY
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_SIZE
 from device_cloud._core.constants import DEFAULT_THREAD_COUNT
 
+from device_cloud._core.constants import PUBLISH_POLICY_BLOCK
+from device_cloud._core.constants import PUBLISH_POLICY_COALESCE
+from device_cloud._core.constants import PUBLISH_POLICY_DROP_NEWEST
+from device_cloud._core.constants import PUBLISH_POLICY_DROP_OLDEST
+
+from device_cloud._core.constants import RATE_LIMIT_AGGREGATE
+from device_cloud._core.constants import RATE_LIMIT_DELAY
+from device_cloud._core.constants import RATE_LIMIT_DROP
+
+from device_cloud._core.constants import READ_ATTRIBUTE
+from device_cloud._core.constants import READ_TELEMETRY
+
 from device_cloud._core.constants import STATUS_SUCCESS
 from device_cloud._core.constants import STATUS_INVOKED
 from device_cloud._core.constants import STATUS_BAD_PARAMETER
@@ -62,10 +88,20 @@ __all__ = ["Client",
            "osal"
            "ota_handler",
            "relay",
+           "ACTION_POLICY_QUEUE",
+           "ACTION_POLICY_REJECT",
+           "AGGREGATE_AVG",
+           "AGGREGATE_COUNT",
+           "AGGREGATE_LAST",
+           "AGGREGATE_MAX",
+           "AGGREGATE_MIN",
+           "AGGREGATE_SUM",
            "DEFAULT_CONFIG_DIR",
            "DEFAULT_CONFIG_FILE",
            "DEFAULT_KEEP_ALIVE",
            "DEFAULT_LOOP_TIME",
+           "DEFAULT_PUBLISH_QUEUE_POLICY",
+           "DEFAULT_PUBLISH_QUEUE_SIZE",
            "DEFAULT_THREAD_COUNT",
            "LOGCRITICAL",
            "LOGERROR",
@@ -73,6 +109,15 @@ __all__ = ["Client",
            "LOGINFO",
            "LOGNOTSET",
            "LOGWARNING",
+           "PUBLISH_POLICY_BLOCK",
+           "PUBLISH_POLICY_COALESCE",
+           "PUBLISH_POLICY_DROP_NEWEST",
+           "PUBLISH_POLICY_DROP_OLDEST",
+           "RATE_LIMIT_AGGREGATE",
+           "RATE_LIMIT_DELAY",
+           "RATE_LIMIT_DROP",
+           "READ_ATTRIBUTE",
+           "READ_TELEMETRY",
            "STATUS_SUCCESS",
            "STATUS_INVOKED",
            "STATUS_BAD_PARAMETER",
@@ -93,3 +138,8 @@ __all__ = ["Client",
            "STATUS_TRY_AGAIN",
            "STATUS_NOT_SUPPORTED",
            "STATUS_FAILURE"]
+
+# AsyncClient is written with async/await, which needs Python 3.5 or later
+if sys.version_info >= (3, 5):
+    from device_cloud._core.async_client import AsyncClient
+    __all__.append("AsyncClient")
@@ -0,0 +1,586 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the AsyncClient class for asyncio applications. It
+requires Python 3.5 or later.
+"""
+
+import asyncio
+import json
+import os
+import socket
+from time import monotonic
+
+import paho.mqtt.client as mqttlib
+
+from device_cloud._core import constants
+from device_cloud._core import defs
+from device_cloud._core.client import Client
+
+
+def resolve(future, result):
+    """
+    Set the result of a future, unless it is already done (cancelled by a
+    timeout, for example)
+    """
+
+    if not future.done():
+        future.set_result(result)
+
+
+class AsyncClient(Client):
+    """
+    Client for asyncio applications. Calls that wait for the Cloud are
+    coroutines that await futures resolved when the reply is handled, instead
+    of polling. The MQTT socket is driven by the event loop rather than a
+    thread of its own, and replies are handled on the event loop as they
+    arrive. Worker threads still run actions and file transfers.
+
+    Coroutines:
+        alarm_publish, attribute_publish, attribute_read_last_sample, connect,
+        disconnect, event_publish, file_download, file_upload,
+        location_publish, read_last_samples, telemetry_publish,
+        telemetry_publish_many, telemetry_read_last_sample
+
+    Everything else behaves as it does in Client.
+    """
+
+    def __init__(self, app_id, kwargs=None):
+        super(AsyncClient, self).__init__(app_id, kwargs)
+        self.loop = None
+        self.connected = None
+        self.misc_task = None
+        # File descriptors watched by the event loop
+        self.sock = None
+        self.wake = None
+        self.writing = False
+
+    def initialize(self):
+        """
+        Finish client setup, as Client.initialize, and hand MQTT callbacks to
+        the event loop
+
+        Returns:
+          STATUS_SUCCESS               Client initialized
+        """
+
+        status = super(AsyncClient, self).initialize()
+        mqtt = self.handler.mqtt
+        mqtt.on_connect = self.on_connect
+        mqtt.on_message = self.on_message
+
+        # Newer versions of paho say when they have something to write.
+        # Otherwise their (private) wake up socket is watched for it.
+        if hasattr(mqtt, "on_socket_register_write"):
+            mqtt.on_socket_register_write = self.on_register_write
+            mqtt.on_socket_unregister_write = self.on_register_write
+        return status
+
+    def attach(self):
+        """
+        Watch the MQTT socket, and paho's wake up socket, from the event loop
+        """
+
+        mqtt = self.handler.mqtt
+        sock = mqtt.socket()
+        if sock is None:
+            return
+        self.sock = sock.fileno()
+        self.loop.add_reader(self.sock, self.on_readable)
+
+        # Only needed by versions of paho without on_socket_register_write
+        wake = None
+        if not hasattr(mqtt, "on_socket_register_write"):
+            wake = getattr(mqtt, "_sockpairR", None)
+        if wake is not None and self.wake is None:
+            self.wake = wake
+            self.loop.add_reader(wake.fileno(), self.on_wake)
+        self.update_writer()
+
+    def detach(self):
+        """
+        Stop watching the MQTT socket
+        """
+
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock)
+            if self.writing:
+                self.loop.remove_writer(self.sock)
+                self.writing = False
+            self.sock = None
+
+    def update_writer(self):
+        """
+        Watch for the MQTT socket to be writable only while paho has
+        something to write
+        """
+
+        want_write = self.sock is not None and self.handler.mqtt.want_write()
+        if want_write and not self.writing:
+            self.loop.add_writer(self.sock, self.on_writable)
+            self.writing = True
+        elif not want_write and self.writing:
+            self.loop.remove_writer(self.sock)
+            self.writing = False
+
+    def on_connect(self, mqtt, userdata, flags, rc):
+        """
+        Callback when MQTT Client connects to Cloud
+        """
+
+        self.handler.on_connect(mqtt, userdata, flags, rc)
+        if self.connected:
+            self.loop.call_soon_threadsafe(resolve, self.connected, rc)
+
+    def on_message(self, mqtt, userdata, msg):
+        """
+        Callback when MQTT Client receives a message. It is handled straight
+        away, so waiting coroutines are resumed without going through the
+        worker threads.
+        """
+
+        message = defs.Message(msg.topic, json.loads(msg.payload.decode()))
+        self.handler.logger.debug("Received message on topic \"%s\"\n%s",
+                                  msg.topic, message)
+        try:
+            self.handler.handle_message(message)
+        except Exception:
+            self.handler.logger.exception("Failed to handle message:")
+        # Wake a disconnect waiting for replies
+        self.handler.state_notify()
+
+    def on_readable(self):
+        mqtt = self.handler.mqtt
+        result = mqtt.loop_read()
+
+        # TLS and websockets may hold data the event loop cannot see
+        sock = mqtt.socket()
+        while (result == mqttlib.MQTT_ERR_SUCCESS and sock is not None and
+               hasattr(sock, "pending") and sock.pending()):
+            result = mqtt.loop_read()
+            sock = mqtt.socket()
+
+        if result != mqttlib.MQTT_ERR_SUCCESS or sock is None:
+            # Connection lost, misc_loop reconnects
+            self.detach()
+        else:
+            self.update_writer()
+
+    def on_register_write(self, mqtt, userdata, sock):
+        # May be called from any thread that publishes
+        self.loop.call_soon_threadsafe(self.update_writer)
+
+    def on_wake(self):
+        try:
+            self.wake.recv(1024)
+        except socket.error:
+            pass
+        self.update_writer()
+
+    def on_writable(self):
+        self.handler.mqtt.loop_write()
+        self.update_writer()
+
+    async def misc_loop(self):
+        """
+        Keep the MQTT connection alive, reconnecting when it is lost
+        """
+
+        handler = self.handler
+        while not handler.to_quit:
+            if handler.state == constants.STATE_DISCONNECTED:
+                self.detach()
+                if handler.reconnect_expired():
+                    self.misc_task = None
+                    await self.stop()
+                    break
+                try:
+                    # Opening the connection blocks
+                    result = await self.loop.run_in_executor(
+                        None, handler.reconnect)
+                    if result == 0:
+                        self.attach()
+                except Exception:
+                    pass
+            else:
+                handler.mqtt.loop_misc()
+                self.update_writer()
+            await asyncio.sleep(handler.loop_timeout())
+
+    async def stop(self):
+        """
+        Stop driving MQTT from the event loop, then disconnect and wait for the
+        worker threads without blocking the event loop
+        """
+
+        if self.misc_task:
+            self.misc_task.cancel()
+            try:
+                await self.misc_task
+            except asyncio.CancelledError:
+                pass
+            self.misc_task = None
+
+        # One last write to send out any pending messages
+        mqtt = self.handler.mqtt
+        if self.sock is not None and mqtt.want_write():
+            mqtt.loop_write()
+        self.detach()
+        if self.wake is not None:
+            self.loop.remove_reader(self.wake.fileno())
+            self.wake = None
+        await self.loop.run_in_executor(None, self.handler.shutdown)
+
+    async def rate_wait(self, name, value=None):
+        """
+        Apply rate limits to a publish, waiting without blocking the event loop
+        if the delay policy says so. Returns None if it can be queued,
+        otherwise the status to return for it.
+        """
+
+        status, wait = self.handler.rate_check(name, value)
+        if wait:
+            await asyncio.sleep(wait)
+        return status
+
+    async def queue_publish(self, pub, on_reply=None):
+        """
+        Queue a publish without blocking the event loop. With the block
+        policy, waiting for room in a full publish queue is left to the event
+        loop's default executor.
+        """
+
+        handler = self.handler
+        publish_queue = handler.publish_queue
+        if (publish_queue.policy == constants.PUBLISH_POLICY_BLOCK and
+                not publish_queue.fits(pub)):
+            return await asyncio.get_event_loop().run_in_executor(
+                None, handler.queue_publish, pub, on_reply)
+
+        # Should the queue fill up in the meantime, pub is shed rather than
+        # blocking the event loop
+        return handler.queue_publish(pub, on_reply, block=False)
+
+    async def state_wait(self, predicate, deadline):
+        """
+        Wait until predicate() is True or the monotonic deadline passes,
+        without blocking the event loop. Handler.state_wait is woken as the
+        worker threads finish work and replies are handled.
+        """
+
+        return await self.loop.run_in_executor(None, self.handler.state_wait,
+                                               predicate, deadline)
+
+    async def wait_transfer(self, future, timeout):
+        try:
+            return await asyncio.wait_for(future, timeout or None)
+        except asyncio.TimeoutError:
+            return constants.STATUS_TIMED_OUT
+
+    async def alarm_publish(self, alarm_name, state, message=None):
+        """
+        Publish an alarm to the Cloud. See Client.alarm_publish.
+        """
+
+        status = await self.rate_wait(alarm_name)
+        if status is not None:
+            return status
+        alarm = defs.PublishAlarm(alarm_name, state, message)
+        return await self.queue_publish(alarm)
+
+    async def attribute_publish(self, attribute_name, value):
+        """
+        Publish string telemetry to the Cloud. See Client.attribute_publish.
+        """
+
+        status = await self.rate_wait(attribute_name)
+        if status is not None:
+            return status
+        attr = defs.PublishAttribute(attribute_name, value)
+        return await self.queue_publish(attr)
+
+    async def connect(self, timeout=0):
+        """
+        Connect the Client to the Cloud. Resolving the host and opening the
+        connection block, so they run in the event loop's default executor.
+        Everything after that runs on the event loop.
+
+        Parameters:
+          timeout             (number) Maximum time to try to connect
+
+        Returns:
+          STATUS_FAILURE               Failed to connect to Cloud
+          STATUS_SUCCESS               Successfully connected to Cloud
+          STATUS_TIMED_OUT             Connection attempt timed out
+        """
+
+        handler = self.handler
+        self.loop = asyncio.get_event_loop()
+        self.connected = self.loop.create_future()
+        deadline = monotonic() + timeout if timeout else None
+        status, result = await self.loop.run_in_executor(
+            None, handler.connect_start, deadline)
+
+        if result == 0:
+            # Successful MQTT connection, wait for the Cloud to accept it
+            handler.logger.info("Connecting...")
+            self.attach()
+            self.misc_task = asyncio.ensure_future(self.misc_loop())
+            try:
+                await asyncio.wait_for(asyncio.shield(self.connected),
+                                       timeout or None)
+            except asyncio.TimeoutError:
+                pass
+
+            # Still connecting, timed out
+            if handler.state == constants.STATE_CONNECTING:
+                handler.logger.error("Connection timed out")
+                status = constants.STATUS_TIMED_OUT
+
+        status = handler.connect_finish(status)
+        if status != constants.STATUS_SUCCESS:
+            await self.stop()
+        return status
+
+    async def disconnect(self, wait_for_replies=False, timeout=0):
+        """
+        End Client connection to the Cloud
+
+        Parameters:
+          wait_for_replies      (bool) When True, wait for any pending replies
+                                       to be received or time out before
+                                       disconnecting
+          timeout             (number) Maximum time to wait before returning
+
+        Returns:
+          STATUS_SUCCESS               Successfully disconnected
+          STATUS_TIMED_OUT             Disconnected when the timeout passed,
+                                       leaving what undelivered() returns
+                                       undelivered
+        """
+
+        handler = self.handler
+        deadline = monotonic() + timeout if timeout else None
+
+        # Publish any data that was queued before disconnecting
+        handler.publish_flush()
+
+        # Wait for pending work that has not been dealt with
+        handler.logger.info("Disconnecting...")
+        timed_out = not await self.state_wait(handler.drained, deadline)
+
+        # Optionally wait for any outstanding replies.
+        if wait_for_replies and handler.is_connected():
+            handler.logger.info("Waiting for replies...")
+            if not await self.state_wait(
+                    lambda: (len(handler.reply_tracker) == 0 or
+                             not handler.is_connected()), deadline):
+                timed_out = True
+
+        # Whatever is left now will not be delivered
+        handler.disconnect_report(wait_for_replies)
+        handler.to_quit = True
+        await self.stop()
+        if timed_out:
+            return constants.STATUS_TIMED_OUT
+        return constants.STATUS_SUCCESS
+
+    async def event_publish(self, message):
+        """
+        Publishes an event message to the Cloud. See Client.event_publish.
+        """
+
+        status = await self.rate_wait(None)
+        if status is not None:
+            return status
+        log = defs.PublishLog(message)
+        return await self.queue_publish(log)
+
+    async def file_download(self, file_name, download_dest, blocking=False,
+                            callback=None, timeout=0, file_global=False):
+        """
+        Download a file from the Cloud to the device (C2D). With blocking,
+        waits for the transfer to complete without blocking the event loop.
+        See Client.file_download.
+        """
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def finished(client, name, status):
+            if callback:
+                callback(client, name, status)
+            loop.call_soon_threadsafe(resolve, future, status)
+
+        def replied(message, reply):
+            if not reply.get("success"):
+                loop.call_soon_threadsafe(resolve, future,
+                                          message.data.status)
+
+        status = self.handler.request_download(file_name, download_dest,
+                                               False, finished, 0,
+                                               file_global, replied)
+        if status == constants.STATUS_SUCCESS and blocking:
+            status = await self.wait_transfer(future, timeout)
+        return status
+
+    async def file_upload(self, file_path, upload_name=None, blocking=False,
+                          callback=None, timeout=0, file_global=False):
+        """
+        Upload a file from the device to the Cloud (D2C). With blocking, waits
+        for the transfer to complete without blocking the event loop. See
+        Client.file_upload.
+        """
+
+        if os.path.isdir(file_path):
+            result = await asyncio.gather(*[
+                self.file_upload(file_path + os.sep + fn, fn, blocking,
+                                 callback, timeout, file_global)
+                for fn in os.listdir(file_path)])
+            if not result:
+                return constants.STATUS_NOT_FOUND
+            return max(result)
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def finished(client, name, status):
+            if callback:
+                callback(client, name, status)
+            loop.call_soon_threadsafe(resolve, future, status)
+
+        def replied(message, reply):
+            if not reply.get("success"):
+                loop.call_soon_threadsafe(resolve, future,
+                                          message.data.status)
+
+        status = self.handler.request_upload(file_path, upload_name, False,
+                                             finished, 0, file_global,
+                                             replied)
+        if status == constants.STATUS_SUCCESS and blocking:
+            status = await self.wait_transfer(future, timeout)
+        return status
+
+    async def location_publish(self, latitude, longitude, heading=None,
+                               altitude=None, speed=None, accuracy=None,
+                               fix_type=None):
+        """
+        Publish a location metric to the Cloud. See Client.location_publish.
+        """
+
+        status = await self.rate_wait(None)
+        if status is not None:
+            return status
+        location = defs.PublishLocation(latitude, longitude, heading=heading,
+                                        altitude=altitude, speed=speed,
+                                        accuracy=accuracy, fix_type=fix_type)
+        return await self.queue_publish(location)
+
+    async def read_last_samples(self, names, kind=constants.READ_TELEMETRY,
+                                timeout=0):
+        """
+        Read back the last sample of many telemetry or attribute keys from the
+        Cloud in one request. See Client.read_last_samples.
+        """
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        results = self.handler.read_request(
+            names, kind,
+            lambda done: loop.call_soon_threadsafe(resolve, future, done))
+        try:
+            return await asyncio.wait_for(future, timeout or None)
+        except asyncio.TimeoutError:
+            return results.finish()
+
+    async def attribute_read_last_sample(self, attribute_name, timeout=0):
+        """
+        Read back the last attribute sample from the Cloud. See
+        Client.attribute_read_last_sample.
+        """
+
+        results = await self.read_last_samples([attribute_name],
+                                               constants.READ_ATTRIBUTE,
+                                               timeout)
+        return results[attribute_name]
+
+    async def telemetry_read_last_sample(self, telemetry_name, timeout=0):
+        """
+        Read back the last telemetry sample from the Cloud. See
+        Client.telemetry_read_last_sample.
+        """
+
+        results = await self.read_last_samples([telemetry_name],
+                                               constants.READ_TELEMETRY,
+                                               timeout)
+        return results[telemetry_name]
+
+    async def telemetry_publish(self, telemetry_name, value,
+                                cloud_response=False, timestamp=None):
+        """
+        Publish telemetry to the Cloud. With cloud_response, awaits the
+        Cloud's reply to this sample. See Client.telemetry_publish.
+
+        Returns:
+          STATUS_FAILURE             Cloud rejected the sample
+          STATUS_FULL                Publish queue is full, so this sample
+                                     was shed
+          STATUS_SUCCESS             Telemetry has been queued for publishing
+                                     (or accepted by the Cloud, with
+                                     cloud_response), added to an aggregation
+                                     window, or suppressed by a deadband
+          STATUS_TIMED_OUT           No reply from the Cloud in time
+          STATUS_TRY_AGAIN           Telemetry was dropped by a rate limit
+        """
+
+        handler = self.handler
+        if handler.telemetry_filter(telemetry_name, value):
+            return constants.STATUS_SUCCESS
+        status = await self.rate_wait(telemetry_name, value)
+        if status is not None:
+            return status
+
+        telem = defs.PublishTelemetry(telemetry_name, value, timestamp)
+        if not cloud_response:
+            return await self.queue_publish(telem)
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        status = await self.queue_publish(
+            telem, lambda status: loop.call_soon_threadsafe(resolve, future,
+                                                            status))
+        if status == constants.STATUS_FULL:
+            handler.publish_waiters.pop(telem, None)
+            return status
+        try:
+            return await asyncio.wait_for(future,
+                                          handler.publish_reply_timeout)
+        except asyncio.TimeoutError:
+            handler.publish_waiters.pop(telem, None)
+            return constants.STATUS_TIMED_OUT
+
+    async def telemetry_publish_many(self, samples, values=None,
+                                     timestamps=None):
+        """
+        Publish many telemetry samples to the Cloud at once. See
+        Client.telemetry_publish_many.
+        """
+
+        status, pub, wait = self.handler.telemetry_batch(samples, values,
+                                                         timestamps)
+        if pub is None:
+            return status
+        if wait:
+            await asyncio.sleep(wait)
+        return await self.queue_publish(pub)
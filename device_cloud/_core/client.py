@@ -20,13 +20,37 @@ import json
 import os
 import uuid
 
+from device_cloud._core.constants import ACTION_POLICY_QUEUE
+from device_cloud._core.constants import DEFAULT_ACTION_DEFER_TIMEOUT
+from device_cloud._core.constants import DEFAULT_ACTION_THREADS
+from device_cloud._core.constants import DEFAULT_COMMAND_PROGRESS_INTERVAL
+from device_cloud._core.constants import DEFAULT_COMMAND_TAIL_BYTES
 from device_cloud._core.constants import DEFAULT_CONFIG_DIR
 from device_cloud._core.constants import DEFAULT_CONFIG_FILE
 from device_cloud._core.constants import DEFAULT_KEEP_ALIVE
 from device_cloud._core.constants import DEFAULT_LOOP_TIME
+from device_cloud._core.constants import DEFAULT_MAX_COMMANDS_PER_REQUEST
+from device_cloud._core.constants import DEFAULT_MAX_PAYLOAD_BYTES
+from device_cloud._core.constants import DEFAULT_PUBLISH_BATCH_SIZE
+from device_cloud._core.constants import DEFAULT_PUBLISH_BLOCK_TIMEOUT
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_POLICY
+from device_cloud._core.constants import DEFAULT_PUBLISH_QUEUE_SIZE
+from device_cloud._core.constants import DEFAULT_PUBLISH_REPLY_TIMEOUT
+from device_cloud._core.constants import DEFAULT_PUBLISH_ROUND_SIZE
+from device_cloud._core.constants import DEFAULT_READ_CACHE_MAX_ENTRIES
+from device_cloud._core.constants import DEFAULT_READ_CACHE_TTL
+from device_cloud._core.constants import DEFAULT_REPLY_TIMEOUT
+from device_cloud._core.constants import DEFAULT_REPLY_TRACKER_SIZE
+from device_cloud._core.constants import DEFAULT_SPOOL_FSYNC_INTERVAL
+from device_cloud._core.constants import DEFAULT_SPOOL_MAX_BYTES
+from device_cloud._core.constants import DEFAULT_SPOOL_REPLAY_BATCH
+from device_cloud._core.constants import DEFAULT_SPOOL_REPLAY_INTERVAL
+from device_cloud._core.constants import DEFAULT_SPOOL_SEGMENT_BYTES
 from device_cloud._core.constants import DEFAULT_THREAD_COUNT
+from device_cloud._core.constants import DEFAULT_TRANSFER_THREADS
+from device_cloud._core.constants import READ_ATTRIBUTE
+from device_cloud._core.constants import READ_TELEMETRY
 from device_cloud._core.constants import STATUS_SUCCESS
-from device_cloud._core.constants import WORK_PUBLISH
 from device_cloud._core.constants import STATUS_NOT_FOUND
 from device_cloud._core import defs
 from device_cloud._core.handler import Handler
@@ -161,6 +185,42 @@ class Client(object):
             "keep_alive":DEFAULT_KEEP_ALIVE,
             "loop_time":DEFAULT_LOOP_TIME,
             "thread_count":DEFAULT_THREAD_COUNT,
+            "action_limits":{},
+            "action_defer_timeout":DEFAULT_ACTION_DEFER_TIMEOUT,
+            "worker_pools":{
+                "action":DEFAULT_ACTION_THREADS,
+                "transfer":DEFAULT_TRANSFER_THREADS
+            },
+            "publish_queue_size":DEFAULT_PUBLISH_QUEUE_SIZE,
+            "publish_queue_policy":DEFAULT_PUBLISH_QUEUE_POLICY,
+            "publish_block_timeout":DEFAULT_PUBLISH_BLOCK_TIMEOUT,
+            "publish_coalesce_keys":[],
+            "publish_lane_weights":None,
+            "publish_round_size":DEFAULT_PUBLISH_ROUND_SIZE,
+            "publish_rate_limit":{},
+            "max_commands_per_request":DEFAULT_MAX_COMMANDS_PER_REQUEST,
+            "max_payload_bytes":DEFAULT_MAX_PAYLOAD_BYTES,
+            "publish_batch_size":DEFAULT_PUBLISH_BATCH_SIZE,
+            "publish_alarm_immediate":True,
+            "property_batch":False,
+            "reply_timeout":DEFAULT_REPLY_TIMEOUT,
+            "publish_reply_timeout":DEFAULT_PUBLISH_REPLY_TIMEOUT,
+            "reply_tracker_size":DEFAULT_REPLY_TRACKER_SIZE,
+            "telemetry_aggregate":{},
+            "telemetry_deadband":{},
+            "runtime_dir":self.config.config_dir,
+            "spool":{
+                "enabled":False,
+                "segment_bytes":DEFAULT_SPOOL_SEGMENT_BYTES,
+                "max_bytes":DEFAULT_SPOOL_MAX_BYTES,
+                "fsync_interval":DEFAULT_SPOOL_FSYNC_INTERVAL,
+                "replay_batch":DEFAULT_SPOOL_REPLAY_BATCH,
+                "replay_interval":DEFAULT_SPOOL_REPLAY_INTERVAL
+            },
+            "read_cache":{
+                "ttl":DEFAULT_READ_CACHE_TTL,
+                "max_entries":DEFAULT_READ_CACHE_MAX_ENTRIES
+            },
             "ca_bundle_file":certifi.where()
         }
         self.config.update(config_defaults, False)
@@ -235,6 +295,36 @@ class Client(object):
 
         return self.handler.action_deregister(action_name)
 
+    def action_limit_set(self, action_name, max_concurrency=0, timeout=0,
+                         policy=ACTION_POLICY_QUEUE, max_queued=0):
+        """
+        Limit how many requests of an action run at once, and for how long
+
+        Parameters:
+          action_name         (string) Action to limit, or "*" for every
+                                       action without limits of its own
+          max_concurrency        (int) Requests that may run at once, 0 is no
+                                       limit
+          timeout             (number) Seconds a request may run before it is
+                                       given up on, 0 is no limit. Its command
+                                       is killed, and the Cloud told
+                                       STATUS_TIMED_OUT. A callback is only
+                                       abandoned, not stopped: its worker
+                                       thread stays busy until it returns
+          policy              (string) "queue" (default) requests over
+                                       max_concurrency until their turn, or
+                                       "reject" them with STATUS_TRY_AGAIN
+          max_queued             (int) Requests that may wait for their turn,
+                                       0 is no limit. Any more are rejected
+
+        Returns:
+          STATUS_BAD_PARAMETER         Unknown policy
+          STATUS_SUCCESS               Limits updated for the action
+        """
+
+        return self.handler.action_limit_set(action_name, max_concurrency,
+                                             timeout, policy, max_queued)
+
     def action_register_callback(self, action_name, callback_function,
                                  user_data=None):
         """
@@ -248,11 +338,25 @@ class Client(object):
                                        parameters, user_data[, action_request])
                                        where action_request is optional, but
                                        contains the request_id for later use.
+                                       Trailing parameters may be left out.
+                                       Keyword-only parameters named client,
+                                       params, user_data or request are passed
+                                       by name, and **kwargs is passed every
+                                       one not taken by position.
                                        The callback function must also return
                                        status_code, or (status_code,
                                        status_message) in a tuple.
+                                       To complete the request later, without
+                                       holding up a worker thread, the
+                                       callback calls
+                                       action_request.defer([timeout]) and
+                                       returns STATUS_SUCCESS. The completion
+                                       it gets is later resolved with
+                                       completion.resolve(status_code[,
+                                       status_message[, params]]).
 
         Returns:
+          STATUS_BAD_PARAMETER         Parameters of callback cannot be found
           STATUS_EXISTS                Action with that name already exists
           STATUS_SUCCESS               Successfully registered callback
         """
@@ -260,7 +364,26 @@ class Client(object):
                                                      callback_function,
                                                      user_data)
 
-    def action_register_command(self, action_name, command):
+    def action_stats(self):
+        """
+        Get statistics about executing actions
+
+        Returns:
+          dict                         For each action requested: requests
+                                       running and waiting, and how many were
+                                       rejected and timed out. latency is a
+                                       histogram of execution times with
+                                       count, avg_ms, max_ms and buckets, the
+                                       count of times up to each bound in
+                                       milliseconds
+        """
+
+        return self.handler.action_stats()
+
+    def action_register_command(self, action_name, command, stream=False,
+                                tail_bytes=DEFAULT_COMMAND_TAIL_BYTES,
+                                progress_interval=DEFAULT_COMMAND_PROGRESS_INTERVAL,
+                                upload_log=False):
         """
         Associate a console command with an action in the Cloud
 
@@ -268,12 +391,27 @@ class Client(object):
           action_name         (string) Action to register
           command             (string) Console command to execute when
                                        triggered by action
+          stream                (bool) Read the command's output as it comes
+                                       instead of all at once when it
+                                       finishes. Only the last tail_bytes of it
+                                       are reported to the Cloud.
+          tail_bytes             (int) If streaming, bytes at the end of the
+                                       output reported once the command
+                                       finishes
+          progress_interval   (number) If streaming, least number of seconds
+                                       between updates of the action's progress
+                                       in the Cloud with the latest line of
+                                       output. 0 sends no updates
+          upload_log            (bool) If streaming, upload the full output as
+                                       the file <action_name>-<request_id>.log
         Returns:
           STATUS_EXISTS                Action with that name already exists
           STATUS_SUCCESS               Successfully registered command
         """
 
-        return self.handler.action_register_command(action_name, command)
+        return self.handler.action_register_command(
+            action_name, command, stream=stream, tail_bytes=tail_bytes,
+            progress_interval=progress_interval, upload_log=upload_log)
 
     def alarm_publish(self, alarm_name, state, message=None):
         """
@@ -285,13 +423,17 @@ class Client(object):
           message             (string) Optional message to accompany alarm
 
         Returns:
+          STATUS_FULL                  Publish queue is full, so this alarm
+                                       was shed
           STATUS_SUCCESS               Alarm has been queued for publishing
+          STATUS_TRY_AGAIN             Alarm was dropped by a rate limit
         """
 
+        status = self.handler.rate_limit(alarm_name)
+        if status is not None:
+            return status
         alarm = defs.PublishAlarm(alarm_name, state, message)
-        self.handler.queue_publish(alarm)
-        work = defs.Work(WORK_PUBLISH, None)
-        return self.handler.queue_work(work)
+        return self.handler.queue_publish(alarm)
 
     def attribute_publish(self, attribute_name, value):
         """
@@ -302,9 +444,15 @@ class Client(object):
           value               (string) Value to publish
 
         Returns:
+          STATUS_FULL                  Publish queue is full, so this attribute
+                                       was shed
           STATUS_SUCCESS               Attribute has been queued for publishing
+          STATUS_TRY_AGAIN             Attribute was dropped by a rate limit
         """
 
+        status = self.handler.rate_limit(attribute_name)
+        if status is not None:
+            return status
         attr = defs.PublishAttribute(attribute_name, value)
         return self.handler.queue_publish(attr)
 
@@ -323,6 +471,21 @@ class Client(object):
 
         return self.handler.connect(timeout)
 
+    def connect_async(self, timeout=0):
+        """
+        Start connecting the Client to the Cloud without waiting for it
+
+        Parameters:
+          timeout             (number) Maximum time to try to connect
+
+        Returns:
+          Completion                   Handle whose wait(timeout) returns the
+                                       status connect would return, or None
+                                       if it has not finished yet
+        """
+
+        return self.handler.connect_async(timeout)
+
     def disconnect(self, wait_for_replies=False, timeout=0):
         """
         End Client connection to the Cloud
@@ -335,6 +498,9 @@ class Client(object):
 
         Returns:
           STATUS_SUCCESS               Successfully disconnected
+          STATUS_TIMED_OUT             Disconnected when the timeout passed,
+                                       leaving what undelivered() returns
+                                       undelivered
         """
 
         return self.handler.disconnect(wait_for_replies=wait_for_replies,
@@ -376,8 +542,13 @@ class Client(object):
 
         Returns:
           STATUS_SUCCESS               Event has been queued for publishing
+          STATUS_TRY_AGAIN             Event was dropped by the client rate
+                                       limit
         """
 
+        status = self.handler.rate_limit(None)
+        if status is not None:
+            return status
         log = defs.PublishLog(message)
         return self.handler.queue_publish(log)
 
@@ -491,13 +662,97 @@ class Client(object):
 
         Returns:
           STATUS_SUCCESS               Location has been queued for publishing
+          STATUS_TRY_AGAIN             Location was dropped by the client rate
+                                       limit
         """
 
+        status = self.handler.rate_limit(None)
+        if status is not None:
+            return status
         location = defs.PublishLocation(latitude, longitude, heading=heading,
                                         altitude=altitude, speed=speed,
                                         accuracy=accuracy, fix_type=fix_type)
         return self.handler.queue_publish(location)
 
+    def publish_coalesce_set(self, key, enabled=True):
+        """
+        Only send the newest pending telemetry or attribute publish for a key
+        each time the pending publishes are sent. Useful for gauges or
+        attributes where stale values do not matter.
+
+        Parameters:
+          key                 (string) Telemetry or attribute key, or "*" for
+                                       every key
+          enabled               (bool) Enable or disable coalescing for key
+
+        Returns:
+          STATUS_SUCCESS               Coalescing updated for key
+        """
+
+        return self.handler.publish_coalesce_set(key, enabled)
+
+    def publish_rate_limit_set(self, key=None, rate=None, burst=None,
+                               policy=None, functions=None):
+        """
+        Limit how often a telemetry, attribute or alarm key, or the client as
+        a whole, may publish, using a token bucket that holds up to burst
+        publishes and refills at rate publishes per second. Limits are checked
+        before anything is queued. Calling this without a rate removes the
+        limit.
+
+        Parameters:
+          key                 (string) Key to limit, "*" for every key without
+                                       its own limit, or None for the client
+          rate                (number) Publishes per second on average
+          burst               (number) Publishes allowed at once (default:
+                                       rate, at least 1)
+          policy              (string) "drop" (default) over limit publishes,
+                                       "delay" the publisher until within the
+                                       limit, or "aggregate" over limit
+                                       telemetry over the time the bucket
+                                       takes to refill (anything else is
+                                       dropped)
+          functions             (list) Aggregation functions for the
+                                       "aggregate" policy (default: ["avg"])
+
+        Returns:
+          STATUS_BAD_PARAMETER         Invalid rate, policy or function
+          STATUS_SUCCESS               Rate limit updated for key
+        """
+
+        return self.handler.publish_rate_limit_set(key, rate, burst, policy,
+                                                   functions)
+
+    def publish_stats(self):
+        """
+        Get statistics about pending publishes
+
+        Returns:
+          dict                         queue_depth, queue_capacity,
+                                       dropped_oldest, dropped_newest,
+                                       coalesced, drain_coalesced,
+                                       aggregated_samples and
+                                       deadband_suppressed counters.
+                                       queue_lanes and work_lanes hold the
+                                       backlog of the "high", "normal" and
+                                       "low" priority lanes. rate_dropped,
+                                       rate_delayed and rate_aggregated
+                                       count publishes limited by rate
+                                       limits, and rate_limited_keys how
+                                       many were limited for each key.
+                                       reply_pending, reply_expired,
+                                       reply_evicted, reply_mids_pending
+                                       and reply_mids_expired count sent
+                                       messages waiting for a reply, and
+                                       those given up on.
+                                       With the spool enabled, also
+                                       spool_bytes, spool_segments,
+                                       spool_pending, spool_evicted and
+                                       spool_replay_backlog
+        """
+
+        return self.handler.publish_stats()
+
     def telemetry_publish(self, telemetry_name, value, cloud_response=False, timestamp=None):
         """
         Publish telemetry to the Cloud
@@ -512,38 +767,206 @@ class Client(object):
           timestamp           (string) Optional datetime format timestamp to
                                        override the timestamp applied by the API
         Returns:
-          STATUS_SUCCESS             Telemetry has been queued for publishing
-        """
+          STATUS_FULL                Publish queue is full, so this sample
+                                     was shed
+          STATUS_SUCCESS             Telemetry has been queued for publishing,
+                                     added to an aggregation window, or
+                                     suppressed by a deadband
+          STATUS_TRY_AGAIN           Telemetry was dropped by a rate limit
+        """
+
+        # Aggregated samples, samples within the deadband and samples over a
+        # rate limit are dealt with before any other work
+        if self.handler.telemetry_filter(telemetry_name, value):
+            return STATUS_SUCCESS
+        status = self.handler.rate_limit(telemetry_name, value)
+        if status is not None:
+            return status
 
         telem = defs.PublishTelemetry(telemetry_name, value, timestamp)
         return self.handler.request_publish(telem, cloud_response)
 
-    def telemetry_read_last_sample(self, telemetry_name):
+    def telemetry_aggregate_set(self, telemetry_name, window=None,
+                                functions=None):
+        """
+        Aggregate samples of a telemetry key over tumbling windows instead of
+        publishing every sample. When a window ends, the result of each
+        function is published with the TR50 aggregate flag, timestamped with
+        the start of the window. With one function the result is published
+        to telemetry_name, otherwise to telemetry_name_function (for example
+        "temp_max"). Samples that are not numbers are published as they are.
+        Calling this without a window stops aggregating the key and publishes
+        what was aggregated so far.
+
+        Parameters:
+          telemetry_name      (string) Key of property to aggregate
+          window              (number) Length of each window in seconds
+          functions             (list) Any of "avg", "count", "last", "max",
+                                       "min" and "sum" (default: ["avg"])
+
+        Returns:
+          STATUS_BAD_PARAMETER         Unknown aggregation function
+          STATUS_SUCCESS               Aggregation updated for telemetry_name
+        """
+
+        return self.handler.telemetry_aggregate_set(telemetry_name, window,
+                                                    functions)
+
+    def telemetry_deadband_set(self, telemetry_name, absolute=None,
+                               percent=None, max_silence=None):
+        """
+        Suppress telemetry samples that are within a deadband of the last
+        published value of the same key. A sample is published when it differs
+        from the last published value by more than absolute, or by more than
+        percent of it, or when max_silence seconds have passed since the last
+        publish. Calling this without any thresholds removes the deadband.
+
+        Parameters:
+          telemetry_name      (string) Key of property, or "*" for every key
+                                       without its own deadband
+          absolute            (number) Minimum absolute change to publish
+          percent             (number) Minimum change to publish, as a
+                                       percentage of the last published value
+          max_silence         (number) Maximum seconds between publishes
+
+        Returns:
+          STATUS_SUCCESS               Deadband updated for telemetry_name
+        """
+
+        return self.handler.telemetry_deadband_set(telemetry_name, absolute,
+                                                   percent, max_silence)
+
+    def telemetry_publish_many(self, samples, values=None, timestamps=None):
+        """
+        Publish many telemetry samples to the Cloud at once. The samples are
+        queued as one unit and encoded in one pass, which is much cheaper than
+        calling telemetry_publish for each one. Aggregation windows,
+        deadbands and rate limits still apply to each sample.
+
+        Parameters:
+          samples           (iterable) (name, value) or (name, value,
+                                       timestamp) tuples. If values is given,
+                                       a sequence of names parallel to values
+                                       or a single name for every value
+          values            (sequence) Optional values to publish (a list,
+                                       array.array, numpy array, etc.)
+          timestamps        (sequence) Optional datetimes or datetime format
+                                       strings, parallel to values
+
+        Returns:
+          STATUS_BAD_PARAMETER         Names, values and timestamps differ in
+                                       length
+          STATUS_FULL                  Publish queue is full, so these samples
+                                       were shed
+          STATUS_SUCCESS               Telemetry has been queued for publishing
+        """
+
+        return self.handler.telemetry_publish_many(samples, values, timestamps)
+
+    def telemetry_read_last_sample(self, telemetry_name, timeout=0):
         """
         Read back last/current telemetry sample from the Cloud
 
         Parameters
-          telemetry_name      (string) Key of property to publish
+          telemetry_name      (string) Key of property to read
+          timeout             (number) Maximum time in seconds to wait for the
+                              Cloud to reply. 0 waits forever
 
         Returns:
-          STATUS_SUCCESS               Telemetry has been queued for publishing
+          status                       STATUS_SUCCESS if the sample was read
           value                        Value for last telemetry sample in cloud
           timestamp                    Timestamp for the sample
         """
 
-        return self.handler.handle_telemetry_get(telemetry_name)
+        return self.handler.read_last_samples(
+            [telemetry_name], READ_TELEMETRY,
+            timeout)[telemetry_name]
 
-    def attribute_read_last_sample(self, attribute_name):
+    def attribute_read_last_sample(self, attribute_name, timeout=0):
         """
         Read back last/current attribute sample from the Cloud
 
         Parameters
-          attribute_name      (string) Key of property to publish
+          attribute_name      (string) Key of attribute to read
+          timeout             (number) Maximum time in seconds to wait for the
+                              Cloud to reply. 0 waits forever
 
         Returns:
-          STATUS_SUCCESS               Telemetry has been queued for publishing
+          status                       STATUS_SUCCESS if the sample was read
           value                        Value for last attribute sample in cloud
           timestamp                    Timestamp for the sample
         """
 
-        return self.handler.handle_attribute_get(attribute_name)
+        return self.handler.read_last_samples(
+            [attribute_name], READ_ATTRIBUTE,
+            timeout)[attribute_name]
+
+    def read_cache_stats(self):
+        """
+        Get statistics about the cache of last sample reads
+
+        Returns:
+          dict                         read_cache_hits, read_cache_misses,
+                                       read_cache_entries,
+                                       read_cache_evictions and
+                                       read_cache_invalidations counters
+        """
+
+        return self.handler.read_cache_stats()
+
+    def read_last_samples(self, names, kind=READ_TELEMETRY,
+                          timeout=0):
+        """
+        Read back the last sample of many telemetry or attribute keys from the
+        Cloud in one request. Safe to call from several threads at once. With
+        the read_cache configured, keys read within its ttl, and not published
+        since, are answered from the cache.
+
+        Parameters:
+          names               (list) Keys to read
+          kind                (string) READ_TELEMETRY or READ_ATTRIBUTE
+          timeout             (number) Maximum time in seconds to wait for the
+                              Cloud to reply. 0 waits forever
+
+        Returns:
+          dict of (status, value, timestamp) for each key. status is one of:
+          STATUS_SUCCESS               Sample was read
+          STATUS_NOT_FOUND             Cloud has no sample for the key
+          STATUS_TIMED_OUT             No reply within timeout
+          STATUS_BAD_PARAMETER         Unknown kind
+          STATUS_FAILURE               Read failed or could not be sent
+        """
+
+        return self.handler.read_last_samples(names, kind, timeout)
+
+    def undelivered(self):
+        """
+        Get what the last disconnect left undelivered, because its timeout
+        passed first or the connection was lost
+
+        Returns:
+          Undelivered                  publishes and work still queued, and
+                                       with wait_for_replies, sent messages
+                                       that never got a reply
+        """
+
+        return self.handler.undelivered
+
+    def work_stats(self):
+        """
+        Get statistics about the worker pools, to help size them
+
+        Returns:
+          dict                         For each of the "message", "publish",
+                                       "action" and "transfer" pools:
+                                       threads of its own (0 when the
+                                       thread_count worker threads handle
+                                       it), pending work, and wait and run
+                                       histograms of how long work waited in
+                                       the queue and took to handle. Each
+                                       histogram has count, avg_ms, max_ms
+                                       and buckets, the count of durations
+                                       up to each bound in milliseconds
+        """
+
+        return self.handler.work_stats()
@@ -29,6 +29,163 @@ DEFAULT_KEEP_ALIVE = 0
 DEFAULT_LOOP_TIME = 1
 # Default number of worker threads
 DEFAULT_THREAD_COUNT = 3
+# Default number of worker threads dedicated to actions, and to file
+# transfers. 0 leaves them to the thread_count worker threads
+DEFAULT_ACTION_THREADS = 0
+DEFAULT_TRANSFER_THREADS = 0
+# Default maximum number of pending publishes. 0 means unbounded
+DEFAULT_PUBLISH_QUEUE_SIZE = 0
+# Default policy for new publishes when the publish queue is full
+DEFAULT_PUBLISH_QUEUE_POLICY = "block"
+# Default maximum time in seconds to block a publish when the queue is full.
+# 0 means block until there is room
+DEFAULT_PUBLISH_BLOCK_TIMEOUT = 0
+# Default maximum number of commands sent in one request. 0 means no limit
+DEFAULT_MAX_COMMANDS_PER_REQUEST = 0
+# Default maximum size of one request payload in bytes. 0 means no limit
+DEFAULT_MAX_PAYLOAD_BYTES = 0
+# Default number of pending publishes that are sent without waiting for the
+# linger time. 0 means only the linger time triggers sending
+DEFAULT_PUBLISH_BATCH_SIZE = 0
+# Default maximum number of publishes sent in one round of publish work. 0
+# means one turn of every lane with publish_lane_weights, otherwise no limit
+DEFAULT_PUBLISH_ROUND_SIZE = 0
+# Default size in bytes of a spool segment before a new one is started
+DEFAULT_SPOOL_SEGMENT_BYTES = 1048576
+# Default maximum size in bytes of the spool. Oldest segments are evicted past
+# this. 0 means no limit
+DEFAULT_SPOOL_MAX_BYTES = 67108864
+# Default maximum number of seconds spooled publishes are buffered before
+# being written to disk
+DEFAULT_SPOOL_FSYNC_INTERVAL = 1
+# Default number of spooled publishes replayed at a time after a restart
+DEFAULT_SPOOL_REPLAY_BATCH = 100
+# Default number of seconds between batches of replayed publishes
+DEFAULT_SPOOL_REPLAY_INTERVAL = 1
+# Default number of seconds last sample reads are cached. 0 disables the cache
+DEFAULT_READ_CACHE_TTL = 0
+# Default maximum number of cached last sample reads. 0 means no limit
+DEFAULT_READ_CACHE_MAX_ENTRIES = 1024
+# Default number of seconds a sent message waits for a reply before it is
+# given up on. 0 means wait forever
+DEFAULT_REPLY_TIMEOUT = 300
+# Default number of seconds a publish waits for the Cloud's reply when a
+# response was asked for. 0 means until the reply arrives, reply_timeout gives
+# up on it or the client disconnects
+DEFAULT_PUBLISH_REPLY_TIMEOUT = 0
+# Default maximum number of sent messages waiting for a reply. The oldest are
+# given up on past this. 0 means no limit
+DEFAULT_REPLY_TRACKER_SIZE = 10000
+# Default number of seconds a deferred action request has to be completed
+# before it times out. 0 means no limit
+DEFAULT_ACTION_DEFER_TIMEOUT = 3600
+# Default number of bytes at the end of a streamed command's output that are
+# reported once it finishes
+DEFAULT_COMMAND_TAIL_BYTES = 4096
+# Default minimum number of seconds between progress updates of a streamed
+# command. 0 means no progress updates
+DEFAULT_COMMAND_PROGRESS_INTERVAL = 5
+# MQTT keep alive interval in seconds
+MQTT_KEEP_ALIVE = 60
+# Longest time in seconds the MQTT loop waits for network activity when there
+# is nothing to resend, and no keep alive ping due
+MQTT_IDLE_LOOP_TIME = MQTT_KEEP_ALIVE / 4.0
+
+# PUBLISH QUEUE POLICIES
+
+# Block the publisher until there is room in the queue
+PUBLISH_POLICY_BLOCK = "block"
+# Shed the oldest pending publish to make room for the new one
+PUBLISH_POLICY_DROP_OLDEST = "drop_oldest"
+# Shed the new publish
+PUBLISH_POLICY_DROP_NEWEST = "drop_newest"
+# Replace the pending publish with the same key, otherwise drop the oldest
+PUBLISH_POLICY_COALESCE = "coalesce"
+
+PUBLISH_POLICIES = [
+    PUBLISH_POLICY_BLOCK,
+    PUBLISH_POLICY_DROP_OLDEST,
+    PUBLISH_POLICY_DROP_NEWEST,
+    PUBLISH_POLICY_COALESCE
+]
+
+
+# ACTION POLICIES
+
+# Requests over an action's max_concurrency wait for their turn
+ACTION_POLICY_QUEUE = "queue"
+# Requests over an action's max_concurrency are refused with STATUS_TRY_AGAIN
+ACTION_POLICY_REJECT = "reject"
+
+ACTION_POLICIES = [
+    ACTION_POLICY_QUEUE,
+    ACTION_POLICY_REJECT
+]
+
+
+# RATE LIMIT POLICIES
+
+# Drop publishes over the limit
+RATE_LIMIT_DROP = "drop"
+# Make the publisher wait until the publish is within the limit
+RATE_LIMIT_DELAY = "delay"
+# Aggregate telemetry over the limit into one value per refill of the bucket,
+# drop anything else
+RATE_LIMIT_AGGREGATE = "aggregate"
+
+RATE_LIMIT_POLICIES = [
+    RATE_LIMIT_DROP,
+    RATE_LIMIT_DELAY,
+    RATE_LIMIT_AGGREGATE
+]
+
+
+# READ KINDS
+
+# Last sample of telemetry (properties)
+READ_TELEMETRY = "telemetry"
+# Last value of attributes
+READ_ATTRIBUTE = "attribute"
+
+READ_KINDS = [
+    READ_TELEMETRY,
+    READ_ATTRIBUTE
+]
+
+
+# PRIORITY LANES
+
+# Alarms and action acknowledgements
+PRIORITY_HIGH = 0
+# Attributes, locations, logs and other work
+PRIORITY_NORMAL = 1
+# Telemetry and file transfers
+PRIORITY_LOW = 2
+
+PRIORITY_NAMES = [
+    "high",
+    "normal",
+    "low"
+]
+
+
+# TELEMETRY AGGREGATION FUNCTIONS
+
+AGGREGATE_AVG = "avg"
+AGGREGATE_COUNT = "count"
+AGGREGATE_LAST = "last"
+AGGREGATE_MAX = "max"
+AGGREGATE_MIN = "min"
+AGGREGATE_SUM = "sum"
+
+AGGREGATE_FUNCTIONS = [
+    AGGREGATE_AVG,
+    AGGREGATE_COUNT,
+    AGGREGATE_LAST,
+    AGGREGATE_MAX,
+    AGGREGATE_MIN,
+    AGGREGATE_SUM
+]
 
 
 # PORTS THAT REQUIRE SSL CONNECTIONS
@@ -139,3 +296,36 @@ WORK_ACTION = 2
 WORK_DOWNLOAD = 3
 # Upload a file
 WORK_UPLOAD = 4
+
+# Priority lane for each type of work
+WORK_PRIORITIES = {
+    WORK_MESSAGE:PRIORITY_HIGH,
+    WORK_PUBLISH:PRIORITY_HIGH,
+    WORK_ACTION:PRIORITY_NORMAL,
+    WORK_DOWNLOAD:PRIORITY_LOW,
+    WORK_UPLOAD:PRIORITY_LOW
+}
+
+# Worker pool that handles each type of work. Pools configured with no
+# threads of their own are handled by the thread_count worker threads.
+WORK_POOL_MESSAGE = "message"
+WORK_POOL_PUBLISH = "publish"
+WORK_POOL_ACTION = "action"
+WORK_POOL_TRANSFER = "transfer"
+WORK_POOL_NAMES = [
+    WORK_POOL_MESSAGE,
+    WORK_POOL_PUBLISH,
+    WORK_POOL_ACTION,
+    WORK_POOL_TRANSFER
+]
+WORK_POOLS = {
+    WORK_MESSAGE:WORK_POOL_MESSAGE,
+    WORK_PUBLISH:WORK_POOL_PUBLISH,
+    WORK_ACTION:WORK_POOL_ACTION,
+    WORK_DOWNLOAD:WORK_POOL_TRANSFER,
+    WORK_UPLOAD:WORK_POOL_TRANSFER
+}
+
+# Upper bounds in milliseconds of the buckets of latency histograms. Anything
+# longer goes in one last bucket.
+LATENCY_BUCKETS_MS = [1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 60000]
@@ -15,16 +15,149 @@
 This module defines several helper classes for use in the device_cloud handler
 """
 
+import bisect
+import heapq
 import inspect
 import json
+import os
 import subprocess
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from collections import deque
 from datetime import datetime
+from datetime import timedelta
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+try:
+    from time import time_ns
+except ImportError:
+    from time import time
+
+    def time_ns():
+        """
+        Current time in integer nanoseconds since the epoch
+        """
+
+        return int(time() * 1000000000)
 
 from device_cloud._core import constants
 
+if sys.version_info.major == 2:
+    import Queue as queue
+else:
+    import queue
+
+EPOCH = datetime(1970, 1, 1)
+
+# What action callbacks are passed, in order, and their keyword names
+ACTION_ARGUMENTS = ("client", "params", "user_data", "request")
+
+# TIME_FORMAT split around the microseconds, and the formatted part before
+# them for the most recent second
+_TIME_PREFIX_FORMAT, _TIME_SUFFIX = constants.TIME_FORMAT.split("%f")
+_time_prefix = (None, None)
+
+
+def format_time_ns(timestamp_ns):
+    """
+    Format nanoseconds since the epoch with TIME_FORMAT. The date and time up
+    to the second are only formatted once for each second.
+    """
+
+    global _time_prefix
+    seconds, nanoseconds = divmod(timestamp_ns, 1000000000)
+    cached_seconds, prefix = _time_prefix
+    if cached_seconds != seconds:
+        prefix = (EPOCH + timedelta(seconds=seconds)).strftime(
+            _TIME_PREFIX_FORMAT)
+        _time_prefix = (seconds, prefix)
+    return "{}{:06d}{}".format(prefix, nanoseconds // 1000, _TIME_SUFFIX)
+
+def action_arguments(callback):
+    """
+    Work out how to call an action callback from its prototype. Returns how
+    many of ACTION_ARGUMENTS to pass positionally, and the names of the rest
+    to pass as keywords. Callbacks taking *args are passed every argument,
+    and callbacks taking **kwargs every argument they do not take by
+    position. Raises TypeError or ValueError if there is no prototype.
+    """
+
+    if not hasattr(inspect, "signature"):
+        # Python 2
+        spec = inspect.getargspec(callback)
+        positional = len(spec.args)
+        # Skip the "self" parameter of methods
+        if inspect.ismethod(callback):
+            positional -= 1
+        if spec.varargs:
+            positional = len(ACTION_ARGUMENTS)
+        positional = min(positional, len(ACTION_ARGUMENTS))
+        keywords = ACTION_ARGUMENTS[positional:] if spec.keywords else ()
+        return positional, keywords
+
+    positional = 0
+    keywords = []
+    var_keyword = False
+    for parameter in inspect.signature(callback).parameters.values():
+        if parameter.kind in (parameter.POSITIONAL_ONLY,
+                              parameter.POSITIONAL_OR_KEYWORD):
+            positional += 1
+        elif parameter.kind == parameter.VAR_POSITIONAL:
+            positional = len(ACTION_ARGUMENTS)
+        elif parameter.kind == parameter.KEYWORD_ONLY:
+            if parameter.name in ACTION_ARGUMENTS:
+                keywords.append(parameter.name)
+        elif parameter.kind == parameter.VAR_KEYWORD:
+            var_keyword = True
+    positional = min(positional, len(ACTION_ARGUMENTS))
+    if var_keyword:
+        keywords = ACTION_ARGUMENTS[positional:]
+    else:
+        keywords = [name for name in keywords
+                    if ACTION_ARGUMENTS.index(name) >= positional]
+    return positional, tuple(keywords)
+
+def action_dispatcher(callback):
+    """
+    Build a function calling an action callback with the arguments its
+    prototype takes, given (client, request, user_data)
+    """
+
+    positional, keywords = action_arguments(callback)
+    if keywords:
+        indexes = [(name, ACTION_ARGUMENTS.index(name)) for name in keywords]
+
+        def dispatch(client, request, user_data):
+            values = (client, request.params, user_data, request)
+            kwargs = dict((name, values[index]) for name, index in indexes)
+            return callback(*values[:positional], **kwargs)
+        return dispatch
+
+    # The common prototypes, without building any argument lists
+    if positional == 0:
+        return lambda client, request, user_data: callback()
+    if positional == 1:
+        return lambda client, request, user_data: callback(client)
+    if positional == 2:
+        return lambda client, request, user_data: callback(
+            client, request.params)
+    if positional == 3:
+        return lambda client, request, user_data: callback(
+            client, request.params, user_data)
+    return lambda client, request, user_data: callback(
+        client, request.params, user_data, request)
+
 class Action(object):
     """
-    Holds information associating an action and a callback
+    Holds information associating an action and a callback. How to call the
+    callback is worked out once, from its prototype, when the action is
+    created.
     """
 
     def __init__(self, name, callback, client, user_data=None):
@@ -32,6 +165,9 @@ class Action(object):
         self.callback = callback
         self.client = client
         self.user_data = user_data
+        self.dispatch = None
+        if callback is not None:
+            self.dispatch = action_dispatcher(callback)
 
     def __str__(self):
         string = "Action {} --> Callback {}"
@@ -42,40 +178,28 @@ class Action(object):
         Execute callback
         """
 
-        # Determine the callback prototype that we have
-        signature = inspect.getargspec(self.callback)
-        args = []
-        arglen = len(signature.args)
-
-        # If there is a "self" parameter (ie. for class methods as a callback),
-        # decrement the number of args so as to supply the correct amount
-        if inspect.ismethod(self.callback):
-            arglen -= 1
-
-        # Build the arguments to pass based on the protoype
-        if arglen >= 1:
-            args.append(self.client)
-
-        if arglen >= 2:
-            args.append(request.params)
-
-        if arglen >= 3:
-            args.append(self.user_data)
-
-        if arglen >= 4:
-            args.append(request)
-
-        return self.callback(*args)
+        return self.dispatch(self.client, request, self.user_data)
 
 
 class ActionCommand(Action):
     """
-    Holds information associating an action and a console command
+    Holds information associating an action and a console command. Streamed
+    commands have their output read as it comes, sending a progress update
+    with the latest line at most every progress_interval seconds, and only
+    report the last tail_bytes of it once finished. The full output can be
+    uploaded as a log file.
     """
 
-    def __init__(self, name, callback, client, user_data=None):
+    def __init__(self, name, callback, client, user_data=None, stream=False,
+                 tail_bytes=constants.DEFAULT_COMMAND_TAIL_BYTES,
+                 progress_interval=constants.DEFAULT_COMMAND_PROGRESS_INTERVAL,
+                 upload_log=False):
         super(ActionCommand, self).__init__(name, None, client, user_data)
         self.command = callback
+        self.stream = stream
+        self.tail_bytes = tail_bytes
+        self.progress_interval = progress_interval
+        self.upload_log = upload_log
 
     def __str__(self):
         return "Action {} --> Command \"{}\"".format(self.name, self.command)
@@ -100,16 +224,218 @@ class ActionCommand(Action):
                     final_command.append("--{}={}".format(key,
                                                           request.params[key]))
 
-        # Execute command with arguments and wait for result
+        if self.stream:
+            return self.execute_stream(request, final_command)
+
+        # Execute command with arguments and wait for result. Cancelling the
+        # request kills it.
         proc = subprocess.Popen(final_command, shell=False,
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE)
+        request.set_process(proc)
         outstr, errstr = proc.communicate()
         ret_code = proc.returncode
 
         return_string = "command: {}  ,  stdout: {}  ,  stderr: {}"
         return (ret_code, return_string.format(final_command, outstr, errstr))
 
+    def execute_stream(self, request, final_command):
+        """
+        Execute command, reading its output as it comes
+        """
+
+        # stderr is interleaved with stdout, as it would be on a console
+        proc = subprocess.Popen(final_command, shell=False,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        request.set_process(proc)
+        tail = OutputTail(self.tail_bytes)
+        log_file = None
+        if self.upload_log:
+            log_file = tempfile.NamedTemporaryFile(prefix=self.name + "-",
+                                                   suffix=".log",
+                                                   delete=False)
+        last_update = None
+        try:
+            # Lines are read at most READ_BYTES at a time, so a command that
+            # never ends a line cannot fill memory
+            read_line = lambda: proc.stdout.readline(OutputTail.READ_BYTES)
+            for line in iter(read_line, b""):
+                tail.add(line)
+                if log_file:
+                    log_file.write(line)
+                text = line.decode("utf-8", "replace").strip()
+                now = monotonic()
+                if (text and self.progress_interval and
+                        (last_update is None or
+                         now - last_update >= self.progress_interval)):
+                    last_update = now
+                    # text[-0:] would be the whole line
+                    self.client.action_progress_update(
+                        request.request_id,
+                        text[-self.tail_bytes:] if self.tail_bytes else "")
+        finally:
+            proc.stdout.close()
+            ret_code = proc.wait()
+            if log_file:
+                log_file.close()
+
+        return_string = "command: {}  ,  output: {}".format(final_command,
+                                                            tail)
+        if tail.truncated():
+            return_string = "command: {}  ,  output (last {} of {} bytes): " \
+                "{}".format(final_command, tail.max_bytes, tail.total, tail)
+        if log_file:
+            upload_name = "{}-{}.log".format(self.name, request.request_id)
+            status = self.client.file_upload(
+                log_file.name, upload_name=upload_name,
+                callback=lambda client, file_name, status: os.remove(
+                    log_file.name))
+            if status == constants.STATUS_SUCCESS:
+                return_string += "  ,  log: {}".format(upload_name)
+            else:
+                os.remove(log_file.name)
+        return (ret_code, return_string)
+
+
+class ActionCompletion(object):
+    """
+    Handle for completing a deferred action request after its callback has
+    returned. Only the first resolve() is reported to the Cloud.
+    """
+
+    def __init__(self, request, timeout=None):
+        self.request = request
+        # Seconds to be resolved in, None for the default
+        self.timeout = timeout
+        self.deadline = None
+        self.result = None
+        self.on_resolve = None
+        self.lock = threading.Lock()
+
+    def done(self):
+        """
+        Whether the request has been resolved, or has timed out
+        """
+
+        return self.result is not None
+
+    def resolve(self, status=constants.STATUS_SUCCESS, message=None,
+                params=None):
+        """
+        Complete the request with a status, and an optional message and
+        parameters to report to the Cloud
+        """
+
+        if status == constants.STATUS_INVOKED:
+            return constants.STATUS_BAD_PARAMETER
+        with self.lock:
+            if self.result is not None:
+                return constants.STATUS_FAILURE
+            self.result = (status, message, params)
+            on_resolve = self.on_resolve
+        if on_resolve:
+            return on_resolve(self)
+        return constants.STATUS_SUCCESS
+
+    def track(self, on_resolve, deadline):
+        """
+        Have on_resolve called once the request is resolved, which must happen
+        before deadline. Returns the result if it already was.
+        """
+
+        with self.lock:
+            if self.result is None:
+                self.on_resolve = on_resolve
+                self.deadline = deadline
+            return self.result
+
+
+class ActionLimit(object):
+    """
+    Limits how many requests of one action run at once, and for how long.
+    Past max_concurrency (0 is no limit), requests wait their turn with the
+    "queue" policy, up to max_queued of them (0 is no limit), or are refused
+    with the "reject" policy. Also counts how long requests take to execute.
+    """
+
+    def __init__(self, max_concurrency=0, timeout=0,
+                 policy=constants.ACTION_POLICY_QUEUE, max_queued=0):
+        self.set(max_concurrency, timeout, policy, max_queued)
+        self.running = 0
+        self.waiting = deque()
+        self.rejected = 0
+        self.timed_out = 0
+        self.latency = LatencyHistogram()
+        self.lock = threading.Lock()
+
+    def finish(self, seconds, timed_out=False):
+        """
+        Record a request that has finished executing. Returns the next waiting
+        request, which takes over its turn, or None.
+        """
+
+        self.latency.add(seconds)
+        with self.lock:
+            if timed_out:
+                self.timed_out += 1
+            if self.waiting and (not self.max_concurrency or
+                                 self.running <= self.max_concurrency):
+                request = self.waiting.popleft()
+                request.admitted = True
+                return request
+            self.running -= 1
+        return None
+
+    def set(self, max_concurrency=0, timeout=0,
+            policy=constants.ACTION_POLICY_QUEUE, max_queued=0):
+        """
+        Change the limits. Requests already running or waiting are not
+        affected.
+        """
+
+        self.max_concurrency = max_concurrency or 0
+        self.timeout = timeout or 0
+        self.policy = policy
+        self.max_queued = max_queued or 0
+
+    def start(self, request):
+        """
+        Try to start executing a request. Returns STATUS_SUCCESS if it may run
+        now, STATUS_TRY_AGAIN if it is waiting to be returned by finish(), or
+        STATUS_FULL if it is refused.
+        """
+
+        with self.lock:
+            if request.admitted:
+                return constants.STATUS_SUCCESS
+            if not self.max_concurrency or self.running < self.max_concurrency:
+                self.running += 1
+                return constants.STATUS_SUCCESS
+            if (self.policy == constants.ACTION_POLICY_QUEUE and
+                    (not self.max_queued or
+                     len(self.waiting) < self.max_queued)):
+                self.waiting.append(request)
+                return constants.STATUS_TRY_AGAIN
+            self.rejected += 1
+            return constants.STATUS_FULL
+
+    def stats(self):
+        """
+        Returns the requests running and waiting, how many were rejected and
+        timed out, and a histogram of execution times
+        """
+
+        with self.lock:
+            stats = {
+                "running":self.running,
+                "waiting":len(self.waiting),
+                "rejected":self.rejected,
+                "timed_out":self.timed_out
+            }
+        stats["latency"] = self.latency.stats()
+        return stats
+
 
 class ActionRequest(object):
     """
@@ -120,6 +446,68 @@ class ActionRequest(object):
         self.request_id = request_id
         self.name = name
         self.params = params
+        # Whether its turn to run was handed over by an ActionLimit
+        self.admitted = False
+        # Process running its command, whether it was given up on, and
+        # whether its callback returned
+        self.process = None
+        self.cancelled = False
+        self.finished = False
+        # Handle for completing it later, if deferred
+        self.completion = None
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        """
+        Give up on the request, killing its command if one is running.
+        Returns True if its callback was still running.
+        """
+
+        with self.lock:
+            running = not (self.finished or self.cancelled)
+            self.cancelled = True
+            process = self.process
+        if process is not None:
+            try:
+                process.kill()
+            except OSError:
+                # Already finished
+                pass
+        return running
+
+    def finish(self):
+        """
+        Record that the callback of the request returned. Returns False if
+        the request was given up on first, so its result is not wanted.
+        """
+
+        with self.lock:
+            self.finished = True
+            return not self.cancelled
+
+    def defer(self, timeout=None):
+        """
+        Complete the request later, through the returned ActionCompletion,
+        instead of with the result of its callback. It times out after timeout
+        seconds (None for the default, 0 for no limit).
+        """
+
+        with self.lock:
+            if self.completion is None:
+                self.completion = ActionCompletion(self, timeout)
+            return self.completion
+
+    def set_process(self, process):
+        """
+        Record the process running the request's command, killing it straight
+        away if the request was already given up on
+        """
+
+        with self.lock:
+            self.process = process
+            cancelled = self.cancelled
+        if cancelled:
+            self.cancel()
 
 
 class Callbacks(dict):
@@ -171,6 +559,59 @@ class Callbacks(dict):
             del self[action_name]
 
 
+class Completion(object):
+    """
+    Handle for an operation finishing in another thread, with the status it
+    finished with
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.status = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def add_done_callback(self, callback):
+        """
+        Call callback with the status once finished, straight away if it
+        already has
+        """
+
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self.status)
+
+    def done(self):
+        """
+        Returns True once finished
+        """
+
+        return self.event.is_set()
+
+    def set(self, status):
+        """
+        Record the final status, waking any waiters and calling any callbacks
+        """
+
+        with self.lock:
+            self.status = status
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(status)
+
+    def wait(self, timeout=None):
+        """
+        Wait up to timeout seconds (None waits forever). Returns the status,
+        or None if it has not finished in time.
+        """
+
+        self.event.wait(timeout)
+        return self.status
+
+
 class Config(dict):
     """
     Holds all configuration information about the Client
@@ -218,6 +659,88 @@ class Config(dict):
                     self[key] = value
 
 
+class Deadband(object):
+    """
+    Suppresses telemetry samples of one key that are within a deadband of the
+    last published value, unless max_silence seconds have passed since then
+    """
+
+    def __init__(self, absolute=None, percent=None, max_silence=None):
+        self.absolute = absolute
+        self.percent = percent
+        self.max_silence = max_silence
+        self.last_value = None
+        self.last_time = None
+        # Publish of the last value, and the value and time before it, to go
+        # back to if that publish is shed
+        self.pub = None
+        self.previous = (None, None)
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def accept(self, pub, value, now=None):
+        """
+        Make value the last published value, once pub holding it is queued
+        """
+
+        if now is None:
+            now = monotonic()
+        with self.lock:
+            if self.pub is not pub:
+                self.previous = (self.last_value, self.last_time)
+                self.pub = pub
+            self.last_value = value
+            self.last_time = now
+
+    def check(self, value, now=None):
+        """
+        Returns True if value should be published. It is only compared with
+        later values once accept() is called for it.
+        """
+
+        if now is None:
+            now = monotonic()
+        with self.lock:
+            if (self.last_time is None or
+                    (self.max_silence and
+                     now - self.last_time >= self.max_silence) or
+                    self.changed(value)):
+                return True
+            self.suppressed += 1
+            return False
+
+    def changed(self, value):
+        """
+        Check whether value is outside the deadband of the last published value
+        """
+
+        try:
+            delta = abs(value - self.last_value)
+        except TypeError:
+            # Not a number, so any change counts
+            return value != self.last_value
+
+        if self.absolute is None and self.percent is None:
+            return delta != 0
+        if self.absolute is not None and delta > self.absolute:
+            return True
+        if (self.percent is not None and
+                delta * 100.0 > self.percent * abs(self.last_value)):
+            return True
+        return False
+
+    def shed(self, pub):
+        """
+        Go back to the value published before pub if pub, holding the last
+        published value, is shed
+        """
+
+        with self.lock:
+            if self.pub is pub:
+                self.last_value, self.last_time = self.previous
+                self.pub = None
+
+
 class FileTransfer(object):
     """
     Holds information about pending file transfers
@@ -241,6 +764,111 @@ class FileTransfer(object):
             self.callback(self.client, self.file_name, self.status)
 
 
+class LaneQueue(queue.Queue):
+    """
+    Queue split into priority lanes. Without weights, items are taken from
+    the highest priority lane that has any (strict priority). With weights,
+    each lane may give up to its weight in items per round before lower
+    lanes get their turn (weighted round robin), so no lane starves.
+    """
+
+    def __init__(self, maxsize=0, weights=None):
+        self.weights = weights
+        queue.Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        self.lanes = [deque() for _ in constants.PRIORITY_NAMES]
+        if self.weights:
+            self.credits = list(self.weights)
+
+    def _qsize(self, len=len):
+        return sum(len(lane) for lane in self.lanes)
+
+    def _put(self, item):
+        self.lanes[self.priority(item)].append(item)
+
+    def _get(self):
+        if self.weights:
+            for _ in range(2):
+                for num, lane in enumerate(self.lanes):
+                    if lane and self.credits[num] > 0:
+                        self.credits[num] -= 1
+                        return lane.popleft()
+                # Every lane with items is out of credits, start a new round
+                self.credits = list(self.weights)
+        for lane in self.lanes:
+            if lane:
+                return lane.popleft()
+
+    def items(self):
+        """
+        Return a list of the items waiting, in the order lanes are drained
+        without weights, leaving them queued
+        """
+
+        with self.mutex:
+            return [item for lane in self.lanes for item in lane]
+
+    def lane_sizes(self):
+        """
+        Return the number of items waiting in each lane, by lane name
+        """
+
+        with self.mutex:
+            return dict(zip(constants.PRIORITY_NAMES,
+                            [len(lane) for lane in self.lanes]))
+
+    def priority(self, item):
+        """
+        Return the lane an item belongs in
+        """
+
+        return constants.PRIORITY_NORMAL
+
+
+class LatencyHistogram(object):
+    """
+    Counts durations into buckets (constants.LATENCY_BUCKETS_MS), keeping
+    their total and maximum too
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(constants.LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        """
+        Count one duration in seconds
+        """
+
+        millis = seconds * 1000.0
+        bucket = bisect.bisect_left(constants.LATENCY_BUCKETS_MS, millis)
+        with self.lock:
+            self.buckets[bucket] += 1
+            self.count += 1
+            self.total += millis
+            if millis > self.max:
+                self.max = millis
+
+    def stats(self):
+        """
+        Returns count, avg_ms, max_ms and buckets, the count for each bucket
+        by its upper bound ("inf" for the last)
+        """
+
+        with self.lock:
+            bounds = [str(bound) for bound in constants.LATENCY_BUCKETS_MS]
+            return {
+                "count":self.count,
+                "avg_ms":self.total / self.count if self.count else 0.0,
+                "max_ms":self.max,
+                "buckets":dict(zip(bounds + ["inf"], self.buckets))
+            }
+
+
 class Message(object):
     """
     Holds received messages in their json format
@@ -261,32 +889,93 @@ class OutMessage(object):
     """
 
     def __init__(self, command, description, timestamp=None, data=None,
-                 out_id=None):
-        self.command = command
+                 out_id=None, publishes=None, encoded=None,
+                 command_type=None, on_reply=None):
+        self._command = command
         self.description = description
         self.timestamp = timestamp
         self.data = data
         self.out_id = out_id
+        # Publishes carried by this command
+        self.publishes = publishes or []
+        # Command already encoded as JSON, along with its command name.
+        # command is only decoded from it if it is needed.
+        self.encoded = encoded
+        self._command_type = command_type
+        # Called with this message and the reply once the reply is handled,
+        # or with {"success":False, "timedOut":True} if none came in time
+        self.on_reply = on_reply
 
     def __str__(self):
         return self.description
 
+    @property
+    def command(self):
+        if self._command is None and self.encoded is not None:
+            self._command = json.loads(self.encoded)
+        return self._command
+
+    @command.setter
+    def command(self, command):
+        self._command = command
+        self.encoded = None
+
+    @property
+    def command_type(self):
+        if self._command is None and self._command_type is not None:
+            return self._command_type
+        return self.command.get("command")
+
 
 class OutTracker(dict):
     """
-    Holds all sent messages that are waiting for a reply
+    Holds all sent messages that are waiting for a reply. Every message, and
+    every MID waiting for its publish to complete, gets a deadline timeout
+    seconds after it was added, after which expire() drops it. Past max_size
+    messages, the oldest are dropped early. Deadlines are kept in heaps that
+    are cleaned up lazily, so nothing is scanned.
     """
 
-    def __init__(self):
+    def __init__(self, timeout=0, max_size=0):
         super(OutTracker, self).__init__()
         self.mid_tracker = {}
+        self.timeout = timeout
+        self.max_size = max_size
+        # Heaps of (deadline, sequence, out_id) and (deadline, sequence, mid,
+        # topic). Entries for anything already removed are skipped.
+        self.deadlines = []
+        self.mid_deadlines = []
+        self.sequence = 0
+        self.expired = 0
+        self.evicted = 0
+        self.mids_expired = 0
 
     def add_message(self, message):
         """
-        Add a message
+        Add a message. Returns the messages dropped to stay within max_size.
         """
 
+        evicted = []
+        if self.max_size:
+            while len(self) >= self.max_size and self.deadlines:
+                out_id = heapq.heappop(self.deadlines)[2]
+                oldest = self.pop(out_id, None)
+                if oldest is not None:
+                    evicted.append(oldest)
+            self.evicted += len(evicted)
+
         self[message.out_id] = message
+        if self.timeout or self.max_size:
+            self.sequence += 1
+            deadline = (monotonic() + self.timeout if self.timeout
+                        else float("inf"))
+            heapq.heappush(self.deadlines,
+                           (deadline, self.sequence, message.out_id))
+            if len(self.deadlines) > 2 * len(self) + 1024:
+                self.deadlines = [entry for entry in self.deadlines
+                                  if entry[2] in self]
+                heapq.heapify(self.deadlines)
+        return evicted
 
     def add_mid(self, mid, topic):
         """
@@ -294,6 +983,54 @@ class OutTracker(dict):
         """
 
         self.mid_tracker[mid] = topic
+        if self.timeout:
+            self.sequence += 1
+            heapq.heappush(self.mid_deadlines,
+                           (monotonic() + self.timeout, self.sequence, mid,
+                            topic))
+            if len(self.mid_deadlines) > 2 * len(self.mid_tracker) + 1024:
+                self.mid_deadlines = [
+                    entry for entry in self.mid_deadlines
+                    if self.mid_tracker.get(entry[2]) == entry[3]]
+                heapq.heapify(self.mid_deadlines)
+
+    def expire(self, now=None):
+        """
+        Remove everything whose deadline has passed. Returns the expired
+        messages.
+        """
+
+        if now is None:
+            now = monotonic()
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            message = self.pop(heapq.heappop(self.deadlines)[2], None)
+            if message is not None:
+                expired.append(message)
+        self.expired += len(expired)
+
+        while self.mid_deadlines and self.mid_deadlines[0][0] <= now:
+            mid, topic = heapq.heappop(self.mid_deadlines)[2:]
+            if self.mid_tracker.get(mid) == topic:
+                del self.mid_tracker[mid]
+                self.mids_expired += 1
+        return expired
+
+    def next_deadline(self):
+        """
+        Returns the earliest deadline of anything tracked, or None. It may
+        belong to something already removed.
+        """
+
+        if not self.timeout:
+            return None
+        try:
+            heads = [heap[0][0] for heap in (self.deadlines, self.mid_deadlines)
+                     if heap]
+        except IndexError:
+            # Emptied by another thread
+            return None
+        return min(heads) if heads else None
 
     def pop_message(self, topic_num, cmd_num):
         """
@@ -318,14 +1055,116 @@ class OutTracker(dict):
             raise KeyError("Message {} not found.".format(mid))
         return pop_id
 
+    def stats(self):
+        """
+        Return the number of tracked messages and expiry counters
+        """
+
+        return {
+            "reply_pending":len(self),
+            "reply_expired":self.expired,
+            "reply_evicted":self.evicted,
+            "reply_mids_pending":len(self.mid_tracker),
+            "reply_mids_expired":self.mids_expired
+        }
+
+
+class OutputTail(object):
+    """
+    Keeps the last max_bytes of a command's output, and counts all of it
+    """
+
+    # Most bytes read from a command's output at a time
+    READ_BYTES = 65536
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.chunks = deque()
+        self.size = 0
+        self.total = 0
+
+    def __str__(self):
+        if not self.max_bytes:
+            return ""
+        data = b"".join(self.chunks)[-self.max_bytes:]
+        return data.decode("utf-8", "replace")
+
+    def add(self, data):
+        """
+        Add more output, forgetting chunks no longer needed for the tail
+        """
+
+        self.chunks.append(data)
+        self.size += len(data)
+        self.total += len(data)
+        while self.chunks and self.size - len(self.chunks[0]) >= \
+                self.max_bytes:
+            self.size -= len(self.chunks.popleft())
+
+    def truncated(self):
+        """
+        Whether more output was added than is kept
+        """
+
+        return self.total > self.max_bytes
+
+
 class Publish(object):
     """
-    Super Class for holding information about a pending publish
+    Super Class for holding information about a pending publish. The time is
+    kept in nanoseconds since the epoch, and only formatted as a timestamp
+    string when it is needed.
     """
 
+    __slots__ = ("time_ns", "_timestamp", "spool_id")
+    type = "Publish"
+    priority = constants.PRIORITY_NORMAL
+
     def __init__(self):
-        self.timestamp = datetime.utcnow().strftime(constants.TIME_FORMAT)
-        self.type = self.__class__.__name__
+        self.time_ns = time_ns()
+        self._timestamp = None
+        # Sequence number in the spool, if spooled
+        self.spool_id = None
+
+    @property
+    def timestamp(self):
+        if self._timestamp is None and self.time_ns is not None:
+            self._timestamp = format_time_ns(self.time_ns)
+        return self._timestamp
+
+    @timestamp.setter
+    def timestamp(self, timestamp):
+        if type(timestamp) is datetime:
+            timestamp = timestamp.strftime(constants.TIME_FORMAT)
+        self._timestamp = timestamp
+        self.time_ns = None
+
+    def exchange(self, other):
+        """
+        Exchange value, time and spool sequence number with another publish of
+        the same key
+        """
+
+        self.value, other.value = other.value, self.value
+        self.time_ns, other.time_ns = other.time_ns, self.time_ns
+        self._timestamp, other._timestamp = other._timestamp, self._timestamp
+        self.spool_id, other.spool_id = other.spool_id, self.spool_id
+
+    def key(self):
+        """
+        Key identifying publishes that supersede each other, or None if this
+        publish cannot be superseded
+        """
+
+        return None
+
+    def size(self):
+        """
+        Number of samples this publish holds, which is how much of a bounded
+        publish queue it takes up
+        """
+
+        return 1
 
 
 class PublishAlarm(Publish):
@@ -333,6 +1172,10 @@ class PublishAlarm(Publish):
     Holds information about an alarm
     """
 
+    __slots__ = ("name", "state", "message")
+    type = "PublishAlarm"
+    priority = constants.PRIORITY_HIGH
+
     def __init__(self, name, state, message=None):
         super(PublishAlarm, self).__init__()
         self.name = name
@@ -345,17 +1188,27 @@ class PublishAttribute(Publish):
     Holds information about an attribute that is to be published
     """
 
+    __slots__ = ("name", "value")
+    type = "PublishAttribute"
+
     def __init__(self, name, value):
         super(PublishAttribute, self).__init__()
         self.name = name
         self.value = value
 
+    def key(self):
+        return (self.type, self.name)
+
 
 class PublishLocation(Publish):
     """
     Holds location information
     """
 
+    __slots__ = ("latitude", "longitude", "heading", "altitude", "speed",
+                 "accuracy", "fix_type")
+    type = "PublishLocation"
+
     def __init__(self, latitude, longitude, heading=None, altitude=None,
                  speed=None, accuracy=None, fix_type=None):
         super(PublishLocation, self).__init__()
@@ -388,22 +1241,590 @@ class PublishLog(Publish):
     Holds a log message to be sent to the Cloud
     """
 
+    __slots__ = ("message",)
+    type = "PublishLog"
+
     def __init__(self, message):
         super(PublishLog, self).__init__()
         self.message = message
 
 
+class PublishQueue(LaneQueue):
+    """
+    Queue for pending publishes with an optional capacity, with a lane for
+    each publish priority. The capacity is counted in samples, so a batch of
+    telemetry takes up a place for each of its samples. When the queue is
+    full, the policy decides whether the publisher blocks or which publish is
+    shed. Publishes are shed from the lowest priority lane first. on_shed is
+    called with every publish that is shed.
+    """
+
+    def __init__(self, maxsize=0, policy=constants.PUBLISH_POLICY_BLOCK,
+                 block_timeout=0, on_shed=None, weights=None):
+        LaneQueue.__init__(self, maxsize, weights)
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.on_shed = on_shed
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+        self.coalesced = 0
+
+    def _init(self, maxsize):
+        LaneQueue._init(self, maxsize)
+        # Most recently queued publish for each coalescable key
+        self.latest = {}
+        # Samples waiting in the queue
+        self.samples = 0
+
+    def _full(self, size):
+        # A publish larger than the whole queue still goes in an empty one
+        return (self.maxsize > 0 and self.samples > 0 and
+                self.samples + size > self.maxsize)
+
+    def _qsize(self):
+        return self.samples
+
+    def _put(self, item):
+        LaneQueue._put(self, item)
+        self.samples += item.size()
+        if self.policy == constants.PUBLISH_POLICY_COALESCE:
+            key = item.key()
+            if key:
+                self.latest[key] = item
+
+    def _get(self):
+        return self._forget(LaneQueue._get(self))
+
+    def _forget(self, item):
+        self.samples -= item.size()
+        if self.latest:
+            key = item.key()
+            if key and self.latest.get(key) is item:
+                del self.latest[key]
+        return item
+
+    def _drop_oldest(self, item, size):
+        # Only lanes at or below item's priority give up their oldest
+        # publishes to make room for it, the lowest lane first. Nothing is
+        # dropped (and False returned) if that is not enough.
+        lanes = self.lanes[self.priority(item):]
+        need = self.samples + size - self.maxsize
+        freed = 0
+        dropped = []
+        for lane in reversed(lanes):
+            for pub in lane:
+                if freed >= need:
+                    break
+                freed += pub.size()
+                dropped.append(lane)
+        if freed < need and freed < self.samples:
+            return False
+        for lane in dropped:
+            self._shed(self._forget(lane.popleft()))
+            self.unfinished_tasks -= 1
+            self.dropped_oldest += 1
+        return True
+
+    def _shed(self, item):
+        if self.on_shed:
+            self.on_shed(item)
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Add a publish to the queue, applying the queue policy if it is full.
+        Returns STATUS_FULL if item was shed rather than queued. A coalesced
+        item counts as queued, as its value takes the pending one's place.
+        Older publishes dropped to make room for item are counted in stats().
+        Publishes of a higher priority are never dropped for item; it is shed
+        instead.
+        """
+
+        size = item.size()
+        with self.not_full:
+            if self._full(size):
+                if self.policy == constants.PUBLISH_POLICY_DROP_NEWEST:
+                    self.dropped_newest += 1
+                    self._shed(item)
+                    return constants.STATUS_FULL
+
+                elif self.policy == constants.PUBLISH_POLICY_COALESCE:
+                    pending = self.latest.get(item.key())
+                    if pending:
+                        # Newest value wins, but keeps its place in the
+                        # queue. The old value is shed in its place.
+                        pending.exchange(item)
+                        self.coalesced += 1
+                        self._shed(item)
+                        return constants.STATUS_SUCCESS
+                    if not self._drop_oldest(item, size):
+                        self.dropped_newest += 1
+                        self._shed(item)
+                        return constants.STATUS_FULL
+
+                elif self.policy == constants.PUBLISH_POLICY_DROP_OLDEST:
+                    if not self._drop_oldest(item, size):
+                        self.dropped_newest += 1
+                        self._shed(item)
+                        return constants.STATUS_FULL
+
+                else:
+                    if timeout is None and self.block_timeout:
+                        timeout = self.block_timeout
+                    if not block:
+                        self.dropped_newest += 1
+                        self._shed(item)
+                        return constants.STATUS_FULL
+                    elif timeout is None:
+                        while self._full(size):
+                            self.not_full.wait()
+                    else:
+                        end_time = monotonic() + timeout
+                        while self._full(size):
+                            remaining = end_time - monotonic()
+                            if remaining <= 0.0:
+                                self.dropped_newest += 1
+                                self._shed(item)
+                                return constants.STATUS_FULL
+                            self.not_full.wait(remaining)
+
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+        return constants.STATUS_SUCCESS
+
+    def fits(self, item):
+        """
+        Returns True if item can be queued straight away, without blocking or
+        shedding anything
+        """
+
+        with self.mutex:
+            return not self._full(item.size())
+
+    def priority(self, item):
+        return item.priority
+
+    def stats(self):
+        """
+        Return the current depth and drop counters of the queue
+        """
+
+        with self.mutex:
+            return {
+                "queue_depth":self._qsize(),
+                "queue_lanes":dict(zip(constants.PRIORITY_NAMES,
+                                       [len(lane) for lane in self.lanes])),
+                "queue_capacity":self.maxsize,
+                "dropped_oldest":self.dropped_oldest,
+                "dropped_newest":self.dropped_newest,
+                "coalesced":self.coalesced
+            }
+
+
 class PublishTelemetry(Publish):
     """
     Holds information about telemetry that is to be published
     """
 
-    def __init__(self, name, value, timestamp=None):
+    __slots__ = ("name", "value", "aggregate")
+    type = "PublishTelemetry"
+    priority = constants.PRIORITY_LOW
+
+    def __init__(self, name, value, timestamp=None, aggregate=None):
         super(PublishTelemetry, self).__init__()
-        if type(timestamp) is datetime:
-            self.timestamp = timestamp.strftime(constants.TIME_FORMAT)
+        if timestamp is not None:
+            self.timestamp = timestamp
         self.name = name
         self.value = value
+        self.aggregate = aggregate
+
+    def key(self):
+        return (self.type, self.name)
+
+
+class PublishTelemetryBatch(Publish):
+    """
+    Holds many telemetry samples that are queued and encoded as one unit
+    """
+
+    __slots__ = ("samples",)
+    type = "PublishTelemetryBatch"
+    priority = constants.PRIORITY_LOW
+
+    def __init__(self, samples):
+        super(PublishTelemetryBatch, self).__init__()
+        # List of (name, value, timestamp string) tuples
+        self.samples = samples
+
+    def __str__(self):
+        return "{} samples".format(len(self.samples))
+
+    def size(self):
+        return len(self.samples) or 1
+
+
+class ReadCache(object):
+    """
+    Least recently used cache of last sample reads, keyed by (kind, name).
+    Entries expire ttl seconds after the read that filled them was sent.
+    Publishing a key invalidates it, including reads of it still waiting for a
+    reply, so a read after a publish always goes to the Cloud.
+    """
+
+    def __init__(self, ttl, max_entries=0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Reads waiting for a reply: key -> [count, sequence of the last
+        # invalidation]
+        self.reading = {}
+        self.sequence = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        Returns the cached (status, value, timestamp) for key, or None
+        """
+
+        now = monotonic()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and entry[0] > now:
+                # Move to the most recently used end
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def invalidate(self, key):
+        """
+        Forget key, and any read of it already sent
+        """
+
+        with self.lock:
+            if self.entries.pop(key, None):
+                self.invalidations += 1
+            reading = self.reading.get(key)
+            if reading:
+                self.sequence += 1
+                reading[1] = self.sequence
+
+    def put(self, key, result, token):
+        """
+        Store the result of a read started with start(). Only successful
+        reads not invalidated since they started are kept.
+        """
+
+        sequence, started = token
+        with self.lock:
+            reading = self.reading[key]
+            reading[0] -= 1
+            if not reading[0]:
+                del self.reading[key]
+            if (result[0] != constants.STATUS_SUCCESS or
+                    reading[1] > sequence):
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (started + self.ttl, result)
+            while self.max_entries and len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def start(self, key):
+        """
+        Note that a read of key is being sent. Returns the token to put() its
+        result with.
+        """
+
+        with self.lock:
+            self.sequence += 1
+            self.reading.setdefault(key, [0, 0])[0] += 1
+            return self.sequence, monotonic()
+
+    def stats(self):
+        """
+        Return the size and counters of the cache
+        """
+
+        with self.lock:
+            return {
+                "read_cache_hits":self.hits,
+                "read_cache_misses":self.misses,
+                "read_cache_entries":len(self.entries),
+                "read_cache_evictions":self.evictions,
+                "read_cache_invalidations":self.invalidations
+            }
+
+
+class ReadResults(object):
+    """
+    Collects the Cloud's replies to a batch of reads, one per name. Names
+    without a reply stay STATUS_TIMED_OUT. Replies arriving after the results
+    were taken are ignored.
+    """
+
+    def __init__(self, names, on_done=None, on_result=None):
+        self.results = dict((name, (constants.STATUS_TIMED_OUT, None, None))
+                            for name in names)
+        self.pending = set(self.results)
+        self.on_done = on_done
+        # Called with each name and its final result, exactly once
+        self.on_result = on_result
+        self.done = False
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        if not self.pending:
+            self.event.set()
+
+    def finish(self):
+        """
+        Stop accepting replies and return {name: (status, value, timestamp)}
+        """
+
+        with self.lock:
+            pending = [] if self.done else list(self.pending)
+            self.done = True
+            results = dict(self.results)
+        if self.on_result:
+            for name in pending:
+                self.on_result(name, results[name])
+        return results
+
+    def reply(self, message, reply):
+        """
+        Record the reply to the read of one name. Called as the on_reply of
+        its OutMessage, whose data is the name.
+        """
+
+        if reply.get("success"):
+            params = reply.get("params") or {}
+            result = (constants.STATUS_SUCCESS, params.get("value"),
+                      params.get("ts"))
+        elif reply.get("timedOut"):
+            result = (constants.STATUS_TIMED_OUT, None, None)
+        elif -90008 in reply.get("errorCodes", []):
+            result = (constants.STATUS_NOT_FOUND, None, None)
+        else:
+            result = (constants.STATUS_FAILURE, None, None)
+        self.set(message.data, result)
+
+    def set(self, name, result):
+        """
+        Record the result for one name, waking any waiter once every name has
+        one
+        """
+
+        with self.lock:
+            if self.done or name not in self.pending:
+                return
+            self.results[name] = result
+            self.pending.discard(name)
+            results = None
+            if not self.pending:
+                self.event.set()
+                results = dict(self.results)
+        if self.on_result:
+            self.on_result(name, result)
+        if results is not None and self.on_done:
+            self.on_done(results)
+
+    def wait(self, timeout=None):
+        """
+        Wait up to timeout seconds (None waits forever) for every reply and
+        return the results
+        """
+
+        self.event.wait(timeout)
+        return self.finish()
+
+
+class ReplyWaiter(object):
+    """
+    Lets a thread wait for the Cloud's reply to one message
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.status = None
+
+    def set(self, status):
+        """
+        Record the status of the reply and wake the waiting thread
+        """
+
+        self.status = status
+        self.event.set()
+
+    def wait(self, timeout=None):
+        """
+        Returns the status of the reply, or None if there was none in time
+        """
+
+        self.event.wait(timeout)
+        return self.status
+
+
+class TelemetryWindow(object):
+    """
+    Accumulates the samples of one telemetry key over tumbling windows of a
+    fixed number of seconds. Only the running results are kept, not the
+    samples.
+    """
+
+    def __init__(self, window, functions):
+        self.window = window
+        self.functions = functions
+        self.samples = 0
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+        self.last = None
+        self.end = None
+        self.start_time = None
+
+    def add(self, value, now=None):
+        """
+        Add a sample to the current window. Returns the results of the
+        previous window if the sample arrived after it ended, otherwise None.
+        """
+
+        if now is None:
+            now = monotonic()
+        with self.lock:
+            results = None
+            if self.count and now >= self.end:
+                results = self.results()
+            if not self.count:
+                self.end = now + self.window
+                self.start_time = datetime.utcnow()
+            self.count += 1
+            self.samples += 1
+            self.total += value
+            if self.minimum is None or value < self.minimum:
+                self.minimum = value
+            if self.maximum is None or value > self.maximum:
+                self.maximum = value
+            self.last = value
+        return results
+
+    def flush(self, now=None, force=False):
+        """
+        Returns the results of the current window if it has ended (or if
+        forced), otherwise None
+        """
+
+        if now is None:
+            now = monotonic()
+        with self.lock:
+            if self.count and (force or now >= self.end):
+                return self.results()
+        return None
+
+    def results(self):
+        """
+        Returns (start time, [(function, value), ...]) for the current window
+        and starts a new one
+        """
+
+        values = {
+            constants.AGGREGATE_AVG:float(self.total) / self.count,
+            constants.AGGREGATE_COUNT:self.count,
+            constants.AGGREGATE_LAST:self.last,
+            constants.AGGREGATE_MAX:self.maximum,
+            constants.AGGREGATE_MIN:self.minimum,
+            constants.AGGREGATE_SUM:self.total
+        }
+        results = (self.start_time,
+                   [(function, values[function])
+                    for function in self.functions])
+        self.reset()
+        return results
+
+
+class TokenBucket(object):
+    """
+    Limits publishes to rate per second on average, allowing bursts of up to
+    burst publishes. Each bucket has its own lock, so publishers of different
+    keys never wait on each other.
+    """
+
+    def __init__(self, rate, burst=None, policy=constants.RATE_LIMIT_DROP,
+                 functions=None):
+        self.rate = float(rate)
+        self.burst = burst or max(self.rate, 1)
+        self.policy = policy
+        self.functions = functions or [constants.AGGREGATE_AVG]
+        self.tokens = self.burst
+        self.last = monotonic()
+        self.dropped = 0
+        self.delayed = 0
+        self.aggregated = 0
+        self.lock = threading.Lock()
+
+    def take(self, now=None, aggregate=False):
+        """
+        Take a token. Returns 0 if one was available, otherwise the seconds
+        until one will be. With the delay policy the token is taken anyway, to
+        be used once that time has passed. aggregate says whether the publish
+        can be aggregated rather than dropped.
+        """
+
+        if now is None:
+            now = monotonic()
+        with self.lock:
+            tokens = min(self.burst,
+                         self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if tokens >= 1:
+                self.tokens = tokens - 1
+                return 0
+            if self.policy == constants.RATE_LIMIT_DELAY:
+                self.tokens = tokens - 1
+                self.delayed += 1
+            else:
+                self.tokens = tokens
+                if self.policy == constants.RATE_LIMIT_AGGREGATE and aggregate:
+                    self.aggregated += 1
+                else:
+                    self.dropped += 1
+            return (1 - tokens) / self.rate
+
+    def window(self):
+        """
+        Returns the seconds it takes to refill the bucket, which is how long
+        over limit telemetry is aggregated for
+        """
+
+        return self.burst / self.rate
+
+
+class Undelivered(object):
+    """
+    What disconnecting left behind: publishes still queued, work still queued
+    and, when waiting for replies, sent messages that never got one
+    """
+
+    def __init__(self, publishes=None, work=None, replies=None):
+        self.publishes = publishes or []
+        self.work = work or []
+        self.replies = replies or []
+
+    def __len__(self):
+        return len(self.publishes) + len(self.work) + len(self.replies)
+
+    def __str__(self):
+        return "{} publishes, {} work items, {} replies".format(
+            len(self.publishes), len(self.work), len(self.replies))
 
 
 class Work(object):
@@ -414,5 +1835,17 @@ class Work(object):
     def __init__(self, work_type, data):
         self.type = work_type
         self.data = data
+        # Monotonic time it was queued
+        self.queued = None
+
+
+class WorkQueue(LaneQueue):
+    """
+    Queue for pending work, with a lane for each work priority
+    """
+
+    def priority(self, item):
+        return constants.WORK_PRIORITIES.get(item.type,
+                                             constants.PRIORITY_NORMAL)
 
 
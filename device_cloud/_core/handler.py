@@ -15,10 +15,13 @@
 This module handles all the underlying functionality of the Client
 """
 
+import heapq
 import json
 import logging
+import numbers
 import os
 import random
+import select
 import socket
 
 # proxy support requires PySocks, it is an optional module
@@ -37,10 +40,17 @@ from datetime import datetime
 from datetime import timedelta
 from time import sleep
 import requests
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
 import paho.mqtt.client as mqttlib
 
 from device_cloud._core import constants
 from device_cloud._core import defs
+from device_cloud._core import spool
 from device_cloud._core import tr50
 from device_cloud._core.tr50 import TR50Command
 
@@ -160,44 +170,234 @@ class Handler(object):
         # data
         self.callbacks = defs.Callbacks()
 
-        # Connection state of the Client
+        # Connection state of the Client. Changes to it, to to_quit, finished
+        # work and replies all notify state_cond, so connecting and
+        # disconnecting can wait for them.
+        self.state_cond = threading.Condition()
         self.state = constants.STATE_DISCONNECTED
 
+        # What the last disconnect left undelivered
+        self.undelivered = defs.Undelivered()
+
         # Track last time the app was connected so keep alive can time out
         self.last_connected = datetime.utcnow()
 
         # Lock for thread safety
         self.lock = threading.Lock()
 
+        # Optional spool that keeps publishes on disk until the Cloud replies,
+        # so they survive a restart
+        self.spool = None
+        spool_config = self.config.spool
+        if spool_config and spool_config.enabled:
+            spool_dir = spool_config.dir
+            if not spool_dir:
+                spool_dir = os.path.join(self.config.runtime_dir or ".",
+                                         "spool", self.config.key)
+            self.spool = spool.Spool(
+                spool_dir,
+                spool_config.segment_bytes or
+                constants.DEFAULT_SPOOL_SEGMENT_BYTES,
+                spool_config.max_bytes or 0,
+                spool_config.fsync_interval or 0,
+                self.logger)
+            try:
+                self.spool.open()
+            except (IOError, OSError) as error:
+                self.logger.error("Failed to open spool in %s: %s", spool_dir,
+                                  str(error))
+                self.spool = None
+        self.spool_replay_batch = ((spool_config and spool_config.replay_batch)
+                                   or constants.DEFAULT_SPOOL_REPLAY_BATCH)
+        self.spool_replay_interval = (
+            (spool_config and spool_config.replay_interval) or
+            constants.DEFAULT_SPOOL_REPLAY_INTERVAL)
+
         # Queue for any pending publishes (number, string, location, etc.)
-        self.publish_queue = queue.Queue()
+        policy = self.config.publish_queue_policy
+        if policy is None:
+            policy = constants.DEFAULT_PUBLISH_QUEUE_POLICY
+        elif policy not in constants.PUBLISH_POLICIES:
+            self.logger.warning("publish_queue_policy \"%s\" invalid, \"%s\" "
+                                "used as default", policy,
+                                constants.DEFAULT_PUBLISH_QUEUE_POLICY)
+            policy = constants.DEFAULT_PUBLISH_QUEUE_POLICY
+
+        # Publishes and work are taken from the high, normal and low priority
+        # lanes in strict priority order, unless weights are given for a
+        # weighted round robin between them
+        weights = self.config.publish_lane_weights
+        if weights is not None and (
+                not isinstance(weights, list) or
+                len(weights) != len(constants.PRIORITY_NAMES) or
+                not all(isinstance(weight, int) and weight > 0
+                        for weight in weights)):
+            self.logger.warning("publish_lane_weights must be a list of %d "
+                                "positive integers, using strict priority",
+                                len(constants.PRIORITY_NAMES))
+            weights = None
+        self.publish_queue = defs.PublishQueue(
+            self.config.publish_queue_size or 0, policy,
+            self.config.publish_block_timeout or 0, self.publish_shed,
+            weights)
+
+        # Publishes sent in each round of publish work. With weights, a round
+        # is one turn of every lane unless it is configured.
+        self.publish_round_size = self.config.publish_round_size or 0
+        if not self.publish_round_size and weights:
+            self.publish_round_size = sum(weights)
+
+        # Telemetry and attribute keys where only the newest pending publish
+        # is sent. "*" coalesces every key.
+        coalesce_keys = self.config.publish_coalesce_keys or []
+        if not isinstance(coalesce_keys, list):
+            coalesce_keys = [coalesce_keys]
+        self.coalesce_keys = set(coalesce_keys)
+        self.drain_coalesced = 0
+
+        # Callbacks waiting for the Cloud to reply to a publish
+        self.publish_waiters = {}
+        # Publishes sent in more than one message, with how many of those
+        # messages are still waiting for a reply and the worst status so far
+        self.publish_parts = {}
+
+        # Send consecutive samples of one telemetry key as a single
+        # property.batch command. Turned off if the Cloud rejects it.
+        self.property_batch = self.config.property_batch is True
+
+        # Deadbands suppressing telemetry samples that barely changed. Keys
+        # without their own deadband use the "*" deadband, if any.
+        self.deadbands = {}
+        self.deadband_default = None
+        self.default_deadbands = {}
+        self.deadband_suppressed = 0
+        deadband_config = self.config.telemetry_deadband or {}
+        for key, settings in deadband_config.items():
+            self.telemetry_deadband_set(key, settings.get("absolute"),
+                                        settings.get("percent"),
+                                        settings.get("max_silence"))
+
+        # Limits on how many requests of each action run at once, and for how
+        # long. Actions without limits of their own use the "*" limits, if
+        # any.
+        self.action_settings = {}
+        self.action_limits = {}
+        # Deferred action requests not yet completed, by request id
+        self.action_completions = {}
+        # Heap of (deadline, sequence, request, limit, start) for action
+        # requests running with a timeout, expired by the linger thread
+        self.action_deadlines = []
+        self.action_sequence = 0
+        limit_config = self.config.action_limits or {}
+        for name, settings in limit_config.items():
+            self.action_limit_set(name, settings.get("max_concurrency"),
+                                  settings.get("timeout"),
+                                  settings.get("policy",
+                                               constants.ACTION_POLICY_QUEUE),
+                                  settings.get("max_queued"))
+
+        # Optional cache of last sample reads, invalidated by publishing
+        self.read_cache = None
+        cache_config = self.config.read_cache
+        if cache_config and cache_config.ttl:
+            self.read_cache = defs.ReadCache(
+                cache_config.ttl, cache_config.max_entries or 0)
+
+        # Telemetry keys aggregated over windows, publishing one value per
+        # function each window instead of every sample
+        self.windows = {}
+        self.window_samples = 0
+        aggregate_config = self.config.telemetry_aggregate or {}
+        for key, settings in aggregate_config.items():
+            self.telemetry_aggregate_set(key, settings.get("window"),
+                                         settings.get("functions"))
+
+        # Token buckets limiting how often each key, and the client as a whole,
+        # may publish. Keys without their own limit use the "*" limit, if any.
+        # Over limit telemetry can be aggregated in rate_limit_windows.
+        self.rate_limits = {}
+        self.rate_limit_default = None
+        self.default_rate_limits = {}
+        self.rate_limit_client = None
+        self.rate_limit_windows = {}
+        self.rate_limit_counts = {"rate_dropped":0, "rate_delayed":0,
+                                  "rate_aggregated":0}
+        rate_limit_config = self.config.publish_rate_limit or {}
+        rate_limit_keys = dict(rate_limit_config.get("keys") or {})
+        if rate_limit_config.get("client"):
+            rate_limit_keys[None] = rate_limit_config["client"]
+        for key, settings in rate_limit_keys.items():
+            self.publish_rate_limit_set(key, settings.get("rate"),
+                                        settings.get("burst"),
+                                        settings.get("policy"),
+                                        settings.get("functions"))
+
+        # Pending publishes are sent once the batch fills or the first one has
+        # waited publish_linger_ms, whichever comes first. Alarms can skip the
+        # wait.
+        linger_ms = self.config.publish_linger_ms
+        if linger_ms is None:
+            linger_ms = (self.config.loop_time or 0) * 1000
+        self.publish_linger = linger_ms / 1000.0
+        self.publish_batch_size = self.config.publish_batch_size or 0
+        self.publish_alarm_immediate = (self.config.publish_alarm_immediate
+                                        is not False)
+        self.publish_cond = threading.Condition()
+        self.publish_deadline = None
+        self.publish_scheduled = False
 
         # Dicts to track which messages sent out have not received replies. Also
-        # stores any actions to be taken when the reply is received.
-        self.reply_tracker = defs.OutTracker()
+        # stores any actions to be taken when the reply is received. Messages
+        # without a reply within reply_timeout are given up on.
+        self.reply_tracker = defs.OutTracker(
+            self.config.reply_timeout or 0,
+            self.config.reply_tracker_size or 0)
+        self.reply_expire_time = 0
         self.no_reply = []
+        # Seconds a publish with cloud_response waits for its reply, None
+        # until it is settled one way or another
+        self.publish_reply_timeout = self.config.publish_reply_timeout or None
 
         # Counter to allow every message to be sent on a unique topic
         self.topic_counter = 1
 
-        # Flag for notifying client to exit
-        self.to_quit = True
+        # Flag for notifying client to exit. Setting it wakes every thread.
+        self._to_quit = True
 
-        # Telemetry Response Flag
-        self.pub_wait = self.pub_response = False
-        self.pub_topic = '0000'
+        # Socket pair that wakes the main loop from waiting on the MQTT socket
+        self.wake_recv = self.wake_send = None
+        if hasattr(socket, "socketpair"):
+            self.wake_recv, self.wake_send = socket.socketpair()
+            self.wake_recv.setblocking(False)
+            self.wake_send.setblocking(False)
 
-        # Thread trackers. Main thread for handling MQTT loop, and worker
-        # threads for everything else.
+        # Thread trackers. Main thread for handling MQTT loop, linger thread
+        # for timing batches of publishes, replay thread for sending publishes
+        # recovered from the spool, and worker threads for everything else.
         self.main_thread = None
+        self.linger_thread = None
+        self.replay_thread = None
         self.worker_threads = []
 
         # Queue to track any pending work (parsing messages, actions,
         # publishing, file transfer, etc.)
-        self.work_queue = queue.Queue()
-
-        # store any requested data here
-        self.response = {}
+        self.work_queue = defs.WorkQueue(weights=weights)
+
+        # Pools of worker threads dedicated to one kind of work, each with a
+        # queue of its own, so slow actions or transfers cannot hold up
+        # handling messages. Work of a pool without threads of its own goes
+        # on work_queue, for the thread_count worker threads.
+        self.pool_sizes = self.worker_pool_sizes()
+        self.pool_queues = dict(
+            (pool, defs.WorkQueue(weights=weights))
+            for pool, size in self.pool_sizes.items() if size)
+        # Queues that currently have worker threads
+        self.worker_queues = []
+        # How long work of each pool waits in its queue, and takes to handle
+        self.work_wait = dict((pool, defs.LatencyHistogram())
+                              for pool in constants.WORK_POOL_NAMES)
+        self.work_run = dict((pool, defs.LatencyHistogram())
+                             for pool in constants.WORK_POOL_NAMES)
 
     def action_deregister(self, action_name):
         """
@@ -226,6 +426,193 @@ class Handler(object):
                                                               error_message))
         return self.send(message)
 
+    def action_complete(self, completion, limit, start):
+        """
+        Report the result of a deferred action request to the Cloud, once it
+        has been resolved
+        """
+
+        action_request = completion.request
+        with self.lock:
+            self.action_completions.pop(action_request.request_id, None)
+        self.action_finish(action_request, limit, start)
+
+        result_code, message, params = completion.result
+        result_args = {"mail_id":action_request.request_id}
+        if message is not None:
+            result_args["error_message"] = str(message)
+        if params is not None:
+            result_args["params"] = params
+        if not is_valid_status(result_code):
+            error_string = "Invalid return status: " + str(result_code)
+            self.logger.error(error_string)
+            result_code = constants.STATUS_BAD_PARAMETER
+            result_args["error_message"] = "ERROR: " + error_string
+        return self.handle_action_result(action_request, result_code,
+                                         result_args)
+
+    def action_defer(self, completion, limit, start):
+        """
+        Keep track of a deferred action request until it is resolved or times
+        out. Its worker is free to go, but it still counts against the limits
+        of its action.
+        """
+
+        action_request = completion.request
+        timeout = completion.timeout
+        if timeout is None:
+            timeout = self.config.action_defer_timeout
+        deadline = monotonic() + timeout if timeout else None
+
+        with self.lock:
+            self.action_completions[action_request.request_id] = completion
+        on_resolve = lambda resolved: self.action_complete(resolved, limit,
+                                                           start)
+        if completion.track(on_resolve, deadline) is not None:
+            # Resolved before its callback returned
+            return on_resolve(completion)
+
+        self.logger.info("Action %s will be completed later",
+                         action_request.name)
+        # Have the linger thread wake up in time to expire it
+        if deadline is not None:
+            with self.publish_cond:
+                self.publish_cond.notify_all()
+        return self.handle_action_result(action_request,
+                                         constants.STATUS_INVOKED,
+                                         {"mail_id":action_request.request_id})
+
+    def action_expire(self):
+        """
+        Time out action requests still running past the timeout of their
+        action, and deferred action requests that have not been completed in
+        time
+        """
+
+        now = monotonic()
+        with self.lock:
+            timed_out = []
+            while self.action_deadlines and \
+                    self.action_deadlines[0][0] <= now:
+                timed_out.append(heapq.heappop(self.action_deadlines))
+            expired = [completion for completion in
+                       self.action_completions.values()
+                       if completion.deadline is not None and
+                       completion.deadline <= now]
+
+        for deadline, _, action_request, limit, start in timed_out:
+            # Requests that finished in time are simply dropped
+            if action_request.cancel():
+                self.action_time_out(action_request, limit, start,
+                                     deadline - start)
+        for completion in expired:
+            action_request = completion.request
+            action_request.cancel()
+            self.logger.error("Deferred action %s was not completed in time",
+                              action_request.name)
+            completion.resolve(constants.STATUS_TIMED_OUT,
+                               "Not completed in time")
+
+    def action_execute(self, action_request):
+        """
+        Execute the callback of an action request. Returns the result code and
+        the arguments of the mailbox ack reporting it.
+        """
+
+        result_code = -1
+        result_args = {"mail_id":action_request.request_id}
+        action_result = None
+        action_failed = False
+
+        try:
+            # Execute callback
+            action_result = self.callbacks.execute_action(action_request)
+
+        except Exception as error:
+            # Error with action execution. Might not have been registered.
+            action_failed = True
+            self.logger.error("Action %s execution failed", action_request.name)
+            self.logger.error(".... %s", str(error))
+            result_code = constants.STATUS_FAILURE
+            result_args["error_message"] = "ERROR: {}".format(str(error))
+            if action_request.name not in self.callbacks:
+                result_code = constants.STATUS_NOT_FOUND
+            else:
+                self.logger.exception("Exception:")
+
+        # Action execution did not raise an error
+        if not action_failed:
+            # Handle returning a tuple or just a status code
+            if action_result.__class__.__name__ == "tuple":
+                result_code = action_result[0]
+                if len(action_result) >= 2:
+                    result_args["error_message"] = str(action_result[1])
+                if len(action_result) >= 3:
+                    result_args["params"] = action_result[2]
+            else:
+                result_code = action_result
+
+            if not is_valid_status(result_code):
+                # Returned 'status' is not a valid status
+                error_string = ("Invalid return status: " +
+                                str(result_code))
+                self.logger.error(error_string)
+                result_code = constants.STATUS_BAD_PARAMETER
+                result_args["error_message"] = "ERROR: " + error_string
+
+        return result_code, result_args
+
+    def action_finish(self, action_request, limit, start):
+        """
+        Record an action request as finished with the limits of its action,
+        handing its turn over to the next request waiting for one
+        """
+
+        if limit:
+            following = limit.finish(monotonic() - start,
+                                     action_request.cancelled)
+            if following:
+                self.queue_work(defs.Work(constants.WORK_ACTION, following))
+
+    def action_limit(self, action_name):
+        """
+        Get the limits of an action, creating them from its settings (or the
+        "*" settings) the first time
+        """
+
+        with self.lock:
+            limit = self.action_limits.get(action_name)
+            if limit is None:
+                settings = self.action_settings.get(
+                    action_name, self.action_settings.get("*", ()))
+                limit = defs.ActionLimit(*settings)
+                self.action_limits[action_name] = limit
+        return limit
+
+    def action_limit_set(self, action_name, max_concurrency=0, timeout=0,
+                         policy=constants.ACTION_POLICY_QUEUE, max_queued=0):
+        """
+        Set the limits on executing an action, or with "*" on every action
+        without limits of its own
+        """
+
+        if policy not in constants.ACTION_POLICIES:
+            self.logger.error("Unknown action policy \"%s\", expected one "
+                              "of %s", policy,
+                              ", ".join(constants.ACTION_POLICIES))
+            return constants.STATUS_BAD_PARAMETER
+
+        settings = (max_concurrency or 0, timeout or 0, policy,
+                    max_queued or 0)
+        with self.lock:
+            self.action_settings[action_name] = settings
+            for name, limit in self.action_limits.items():
+                if name == action_name or (
+                        action_name == "*" and name not in
+                        self.action_settings):
+                    limit.set(*settings)
+        return constants.STATUS_SUCCESS
+
     def action_progress_update(self, request_id, message):
         """
         Update message for action (method) request in Cloud
@@ -242,8 +629,13 @@ class Handler(object):
         Associate a callback function with an action in the Cloud
         """
         status = constants.STATUS_SUCCESS
-        action = defs.Action(action_name, callback_function, self.client,
-                             user_data=user_data)
+        try:
+            action = defs.Action(action_name, callback_function, self.client,
+                                 user_data=user_data)
+        except (TypeError, ValueError) as error:
+            self.logger.error("Failed to register action. Cannot tell what "
+                              "arguments it takes: %s", str(error))
+            return constants.STATUS_BAD_PARAMETER
         try:
             self.callbacks.add_action(action)
             self.logger.info("Registered action \"%s\" with function \"%s\"",
@@ -254,13 +646,68 @@ class Handler(object):
 
         return status
 
-    def action_register_command(self, action_name, command):
+    def action_time_out(self, action_request, limit, start, timeout):
+        """
+        Report an action request that has run past its timeout to the Cloud
+        as STATUS_TIMED_OUT, and hand its turn over. Its command was killed,
+        but a callback cannot be stopped: it is abandoned, and whatever it
+        returns is dropped.
+        """
+
+        self.logger.error("Action %s timed out after %s seconds",
+                          action_request.name, timeout)
+        error_message = "Timed out after {} seconds".format(timeout)
+        if action_request.completion is not None:
+            # Resolving it later is refused
+            action_request.completion.resolve(constants.STATUS_TIMED_OUT,
+                                              error_message)
+        self.action_finish(action_request, limit, start)
+        return self.handle_action_result(
+            action_request, constants.STATUS_TIMED_OUT,
+            {"mail_id":action_request.request_id,
+             "error_message":error_message})
+
+    def action_watch(self, action_request, limit, start):
+        """
+        Have the linger thread time out an action request if it runs past the
+        timeout of its action
+        """
+
+        with self.lock:
+            self.action_sequence += 1
+            heapq.heappush(self.action_deadlines,
+                           (start + limit.timeout, self.action_sequence,
+                            action_request, limit, start))
+        # Wake the linger thread in time for it
+        with self.publish_cond:
+            self.publish_cond.notify_all()
+
+    def action_stats(self):
+        """
+        Get the requests running and waiting, rejections, timeouts and
+        execution times of every action that has been requested
+        """
+
+        with self.lock:
+            limits = list(self.action_limits.items())
+        return dict((name, limit.stats()) for name, limit in limits)
+
+    def action_register_command(self, action_name, command, stream=False,
+                                tail_bytes=None, progress_interval=None,
+                                upload_log=False):
         """
         Associate a console command with an action in the Cloud
         """
 
         status = constants.STATUS_SUCCESS
-        action = defs.ActionCommand(action_name, command, self.client)
+        if tail_bytes is None:
+            tail_bytes = constants.DEFAULT_COMMAND_TAIL_BYTES
+        if progress_interval is None:
+            progress_interval = constants.DEFAULT_COMMAND_PROGRESS_INTERVAL
+        action = defs.ActionCommand(action_name, command, self.client,
+                                    stream=stream, tail_bytes=tail_bytes,
+                                    progress_interval=progress_interval,
+                                    upload_log=upload_log)
         try:
             self.callbacks.add_action(action)
             self.logger.info("Registered action \"%s\" with command \"%s\"",
@@ -276,6 +723,90 @@ class Handler(object):
         Connect to MQTT and start main thread
         """
 
+        deadline = monotonic() + timeout if timeout else None
+        status, result = self.connect_start(deadline)
+
+        if result == 0:
+            # Successful MQTT connection
+            self.logger.info("Connecting...")
+
+            # Start main loop thread so that MQTT can make the on_connect
+            # callback
+            self.main_thread = threading.Thread(target=self.main_loop)
+            self.main_thread.start()
+
+            # Wait for the Cloud to accept or refuse the connection
+            self.state_wait(
+                lambda: self.state != constants.STATE_CONNECTING, deadline)
+
+            # Still connecting, timed out
+            if self.state == constants.STATE_CONNECTING:
+                self.logger.error("Connection timed out")
+                status = constants.STATUS_TIMED_OUT
+
+        return self.connect_finish(status)
+
+    def connect_async(self, timeout=0):
+        """
+        Connect in a thread of its own. Returns a defs.Completion that
+        finishes with the status connect returns.
+        """
+
+        completion = defs.Completion()
+
+        def run():
+            completion.set(self.connect(timeout))
+        threading.Thread(target=run).start()
+        return completion
+
+    def connect_finish(self, status):
+        """
+        Start the worker threads once connected, or clean up after failing to
+        connect. Returns the final status of the connection.
+        """
+
+        if self.state == constants.STATE_CONNECTED:
+            # Connected Successfully
+            status = constants.STATUS_SUCCESS
+
+            # Start worker threads if we have successfully connected
+            for _ in range(self.config.thread_count):
+                self.worker_threads.append(threading.Thread(
+                    target=self.handle_work_loop))
+            if self.config.thread_count:
+                self.worker_queues.append(self.work_queue)
+            for pool, work_queue in self.pool_queues.items():
+                for _ in range(self.pool_sizes[pool]):
+                    self.worker_threads.append(threading.Thread(
+                        target=self.handle_work_loop, args=(work_queue,)))
+                self.worker_queues.append(work_queue)
+            for thread in self.worker_threads:
+                thread.start()
+            self.linger_thread = threading.Thread(target=self.linger_loop)
+            self.linger_thread.start()
+            if self.spool and self.spool.replay_backlog:
+                self.replay_thread = threading.Thread(target=self.replay_loop)
+                self.replay_thread.start()
+
+        else:
+            # Not connected. Stop main loop.
+            self.logger.error("Failed to connect")
+            self.to_quit = True
+            self.state = constants.STATE_DISCONNECTED
+            if self.main_thread:
+                self.main_thread.join()
+                self.main_thread = None
+
+        # Return result of connection
+        return status
+
+    def connect_start(self, deadline=None):
+        """
+        Wait for the network, until the monotonic deadline if there is one,
+        and open the MQTT connection. Returns the status so far and the result
+        of the MQTT connect, which is 0 if the connection was opened.
+        """
+
         self.to_quit = False
         status = constants.STATUS_FAILURE
         result = -1
@@ -286,8 +817,6 @@ class Handler(object):
             status = constants.STATUS_BAD_PARAMETER
 
         else:
-            current_time = datetime.utcnow()
-            end_time = current_time + timedelta(seconds=timeout)
             self.state = constants.STATE_CONNECTING
 
             # Add network check and poll here while it is not
@@ -302,9 +831,21 @@ class Handler(object):
                     if ret:
                         self.logger.info("Network is active" )
                         test_network = False
+                        break
                 except socket.error as err:
                     self.logger.error("Network error detected: %s" % str(err))
-                    sleep(1)
+
+                # Retry every second, unless disconnected or out of time
+                retry = monotonic() + 1
+                if deadline is not None:
+                    retry = min(retry, deadline)
+                if (self.state_wait(lambda: self.to_quit, retry) or
+                        (deadline is not None and monotonic() >= deadline)):
+                    self.logger.error("No network to connect with")
+                    self.state = constants.STATE_DISCONNECTED
+                    if not self.to_quit:
+                        status = constants.STATUS_TIMED_OUT
+                    return status, result
 
             # Start a secure connection if using a secure port and the cert file
             # is available
@@ -332,136 +873,214 @@ class Handler(object):
                 # Start MQTT connection
                 try:
                     result = self.mqtt.connect(self.config.cloud.host,
-                                               self.config.cloud.port, 60)
+                                               self.config.cloud.port,
+                                               constants.MQTT_KEEP_ALIVE)
                 except Exception as error:
                     # socket.gaierror or ssl.SSLError
                     self.state = constants.STATE_DISCONNECTED
                     self.logger.error(str(error))
 
-        if result == 0:
-            # Successful MQTT connection
-            self.logger.info("Connecting...")
+        return status, result
 
-            # Start main loop thread so that MQTT can make the on_connect
-            # callback
-            self.main_thread = threading.Thread(target=self.main_loop)
-            self.main_thread.start()
+    def deadband(self, telemetry_name):
+        """
+        Returns the deadband of a telemetry key, or None if it has none
+        """
 
-            # Wait for cloud connection
-            while ((timeout == 0 or current_time < end_time) and
-                   self.state == constants.STATE_CONNECTING):
-                sleep(0.1)
-                current_time = datetime.utcnow()
+        deadband = self.deadbands.get(telemetry_name)
+        if deadband is None:
+            default = self.deadband_default
+            if default is None:
+                return None
+            deadband = self.default_deadbands.get(telemetry_name)
+            if deadband is None:
+                deadband = self.default_deadbands.setdefault(
+                    telemetry_name, defs.Deadband(*default))
+        return deadband
+
+    def deadband_accept(self, pub, samples):
+        """
+        Make the (name, value, ...) samples of pub, which has been queued, the
+        last published values of their deadbands
+        """
 
-            # Still connecting, timed out
-            if self.state == constants.STATE_CONNECTING:
-                self.logger.error("Connection timed out")
-                status = constants.STATUS_TIMED_OUT
+        for sample in samples:
+            deadband = self.deadband(sample[0])
+            if deadband:
+                deadband.accept(pub, sample[1])
 
-        if self.state == constants.STATE_CONNECTED:
-            # Connected Successfully
-            status = constants.STATUS_SUCCESS
+    def deadband_filter(self, telemetry_name, value):
+        """
+        Returns True if a telemetry sample should be published, False if it is
+        suppressed by a deadband
+        """
 
-            # Start worker threads if we have successfully connected
-            for _ in range(self.config.thread_count):
-                self.worker_threads.append(threading.Thread(
-                    target=self.handle_work_loop))
-            for thread in self.worker_threads:
-                thread.start()
+        deadband = self.deadband(telemetry_name)
+        return deadband is None or deadband.check(value)
 
-        else:
-            # Not connected. Stop main loop.
-            self.logger.error("Failed to connect")
-            self.to_quit = True
-            self.state = constants.STATE_DISCONNECTED
-            if self.main_thread:
-                self.main_thread.join()
-                self.main_thread = None
+    def deadband_samples(self, pub):
+        """
+        Returns the samples of a publish that deadbands apply to, or None
+        """
 
-        # Return result of connection
-        return status
+        if not self.deadbands and self.deadband_default is None:
+            return None
+        if pub.type == "PublishTelemetry" and not pub.aggregate:
+            return [(pub.name, pub.value)]
+        if pub.type == "PublishTelemetryBatch":
+            return pub.samples
+        return None
 
     def disconnect(self, wait_for_replies=False, timeout=0):
         """
         Stop threads and shut down MQTT client
         """
 
-        current_time = datetime.utcnow()
-        end_time = current_time + timedelta(seconds=timeout)
+        deadline = monotonic() + timeout if timeout else None
+        timed_out = False
 
         # Publish any data that was queued before disconnecting
-        if not self.publish_queue.empty():
-            self.queue_work(defs.Work(constants.WORK_PUBLISH, None))
+        self.publish_flush()
 
-        # Wait for pending work that has not been dealt with
+        # Wait for pending work that has not been dealt with. Without a
+        # deadline, state_wait only returns once it is done.
         self.logger.info("Disconnecting...")
-        while ((timeout == 0 or current_time < end_time) and
-               not self.work_queue.empty()):
-            sleep(0.1)
-            current_time = datetime.utcnow()
+        if not self.state_wait(self.drained, deadline):
+            timed_out = True
 
         # Optionally wait for any outstanding replies.
         if wait_for_replies and self.is_connected():
             self.logger.info("Waiting for replies...")
-            while ((timeout == 0 or current_time < end_time) and
-                   len(self.reply_tracker) != 0):
-                sleep(0.1)
-                current_time = datetime.utcnow()
+            if not self.state_wait(lambda: (len(self.reply_tracker) == 0 or
+                                            not self.is_connected()),
+                                   deadline):
+                timed_out = True
+
+        # Whatever is left now will not be delivered
+        self.disconnect_report(wait_for_replies)
 
         self.to_quit = True
-        #TODO: Kill any hanging threads
         if threading.current_thread() not in self.worker_threads:
             if self.main_thread:
-                self.main_thread.join()
-                self.main_thread = None
+                remaining = None
+                if deadline is not None:
+                    remaining = max(deadline - monotonic(), 0.1)
+                self.main_thread.join(remaining)
+                if self.main_thread.is_alive():
+                    # Threads busy past the deadline finish shutting down on
+                    # their own
+                    self.logger.error("Threads still busy after %d seconds, "
+                                      "not waiting for them", timeout)
+                    timed_out = True
+                else:
+                    self.main_thread = None
 
+        if timed_out:
+            return constants.STATUS_TIMED_OUT
         return constants.STATUS_SUCCESS
 
-    def handle_action(self, action_request):
+    def disconnect_report(self, wait_for_replies=False):
         """
-        Handle action execution requests from Cloud
+        Record and log what has not been delivered when disconnecting:
+        publishes and work still queued and, if waiting for replies, messages
+        still without one. Returns the defs.Undelivered.
         """
 
-        result_code = -1
-        result_args = {"mail_id":action_request.request_id}
-        action_result = None
-        action_failed = False
-
-        try:
-            # Execute callback
-            action_result = self.callbacks.execute_action(action_request)
+        replies = []
+        if wait_for_replies:
+            with self.lock:
+                replies = list(self.reply_tracker.values())
+        self.undelivered = defs.Undelivered(
+            self.publish_queue.items(),
+            [work for work_queue in self.work_queues()
+             for work in work_queue.items() if work.type is not None],
+            replies)
+        if self.undelivered:
+            self.logger.error("Disconnecting with %s undelivered",
+                              self.undelivered)
+            for pub in self.undelivered.publishes:
+                self.logger.error(".... %s", pub)
+        return self.undelivered
+
+    def drained(self):
+        """
+        Returns True once the worker threads have finished all queued work
+        and, while connected, sent every queued publish. Disconnecting waits
+        for this.
+        """
 
-        except Exception as error:
-            # Error with action execution. Might not have been registered.
-            action_failed = True
-            self.logger.error("Action %s execution failed", action_request.name)
-            self.logger.error(".... %s", str(error))
-            result_code = constants.STATUS_FAILURE
-            result_args["error_message"] = "ERROR: {}".format(str(error))
-            if action_request.name not in self.callbacks:
-                result_code = constants.STATUS_NOT_FOUND
-            else:
-                self.logger.exception("Exception:")
+        if self.to_quit:
+            return True
+        for work_queue in self.work_queues():
+            if work_queue in self.worker_queues:
+                if work_queue.unfinished_tasks:
+                    return False
+            elif not work_queue.empty():
+                # Nothing to wait for but the queue
+                return False
+        if self.work_queue_for(constants.WORK_PUBLISH) not in \
+                self.worker_queues:
+            return True
+        return self.publish_queue.empty() or not self.is_connected()
 
-        # Action execution did not raise an error
-        if not action_failed:
-            # Handle returning a tuple or just a status code
-            if action_result.__class__.__name__ == "tuple":
-                result_code = action_result[0]
-                if len(action_result) >= 2:
-                    result_args["error_message"] = str(action_result[1])
-                if len(action_result) >= 3:
-                    result_args["params"] = action_result[2]
-            else:
-                result_code = action_result
+    def handle_action(self, action_request):
+        """
+        Handle action execution requests from Cloud, within the limits of the
+        action
+        """
 
-            if not is_valid_status(result_code):
-                # Returned 'status' is not a valid status
-                error_string = ("Invalid return status: " +
-                                str(result_code))
+        # Registered actions may be limited in how many run at once
+        limit = None
+        if action_request.name in self.callbacks:
+            limit = self.action_limit(action_request.name)
+            started = limit.start(action_request)
+            if started == constants.STATUS_TRY_AGAIN:
+                self.logger.info("Action %s is waiting for its turn",
+                                 action_request.name)
+                return constants.STATUS_SUCCESS
+            elif started == constants.STATUS_FULL:
+                error_string = "Too many {} actions running".format(
+                    action_request.name)
                 self.logger.error(error_string)
-                result_code = constants.STATUS_BAD_PARAMETER
-                result_args["error_message"] = "ERROR: " + error_string
+                return self.handle_action_result(
+                    action_request, constants.STATUS_TRY_AGAIN,
+                    {"mail_id":action_request.request_id,
+                     "error_message":"ERROR: " + error_string})
+
+        start = monotonic()
+        if limit and limit.timeout:
+            self.action_watch(action_request, limit, start)
+        release = True
+        try:
+            result_code, result_args = self.action_execute(action_request)
+            if not action_request.finish():
+                # Its timeout has already reported it and handed its turn
+                # over
+                release = False
+                self.logger.warning("Action %s returned after timing out, "
+                                    "its result is dropped",
+                                    action_request.name)
+                return constants.STATUS_SUCCESS
+            completion = action_request.completion
+            if completion is not None:
+                if result_code in (constants.STATUS_SUCCESS,
+                                   constants.STATUS_INVOKED):
+                    # The callback will complete the request later
+                    release = False
+                    return self.action_defer(completion, limit, start)
+                # The callback failed, so resolving it later is refused
+                completion.resolve(result_code,
+                                   result_args.get("error_message"))
+            return self.handle_action_result(action_request, result_code,
+                                             result_args)
+        finally:
+            if release:
+                self.action_finish(action_request, limit, start)
+
+    def handle_action_result(self, action_request, result_code, result_args):
+        """
+        Report the result of an action request to the Cloud
+        """
 
         # Return status to Cloud
         # Check for invoked status.  If so, return mail box update not
@@ -486,35 +1105,6 @@ class Handler(object):
         status = self.send(message)
         return status
 
-    def handle_attribute_get(self, attribute_name ):
-        command = tr50.create_attribute_current(self.config.key, attribute_name)
-        message_desc = "Reading current attribute..."
-        message = defs.OutMessage(command, message_desc)
-
-        self.pub_wait = True
-        status = self.send(message)
-        value = None
-        timestamp = None
-
-        # Wait for response from sending to cloud
-        while self.pub_wait:
-            sleep(0.5)
-        # Convert to return codes
-        if self.pub_response:
-            ret = constants.STATUS_SUCCESS
-        else:
-            ret = constants.STATUS_FAILURE
-
-        # make sure the key exists or there will be a KeyError
-        # exception
-        if 'attribute_current_value' in self.response.keys():
-            value = self.response['attribute_current_value']
-
-        if 'attribute_current_timestamp' in self.response.keys():
-            timestamp = self.response['attribute_current_timestamp']
-        return ret, value, timestamp
-
-
     def handle_file_download(self, download):
         """
         Handle any accepted C2D file transfers
@@ -687,11 +1277,22 @@ class Handler(object):
                     sent_message = self.reply_tracker.pop_message(topic_num,
                                                                   command_num)
                 except KeyError as error:
-                    self.logger.error(error.message)
+                    self.logger.error(error.args[0])
                     continue
                 finally:
                     self.lock.release()
-                sent_command_type = sent_message.command.get("command")
+                sent_command_type = sent_message.command_type
+
+                # The Cloud has replied, so publishes can leave the spool.
+                # Rejected batches are resent sample by sample first.
+                if (sent_command_type == TR50Command.property_batch and
+                        not reply.get("success")):
+                    self.property_batch_rejected(sent_message)
+                elif sent_message.publishes:
+                    self.publish_settle(
+                        sent_message.publishes,
+                        constants.STATUS_SUCCESS if reply.get("success")
+                        else constants.STATUS_FAILURE)
 
                 # Log success status of reply
                 if reply.get("success"):
@@ -702,14 +1303,6 @@ class Handler(object):
                                       topic_num, command_num, sent_message)
                     self.logger.error(".... %s", str(reply))
 
-                # Return "success" status
-                if self.pub_wait:
-                    if self.pub_topic == topic_num:
-                        self.pub_response = reply.get("success")
-                        self.pub_wait = False
-                    else:
-                        self.pub_wait = self.pub_response = False
-
                 # Check what kind of message this is a reply to
                 if sent_command_type == TR50Command.file_get:
                     # Recevied a reply for a file download request
@@ -779,122 +1372,140 @@ class Handler(object):
                         else:
                             sent_message.data.status = constants.STATUS_FAILURE
 
-                elif sent_command_type == TR50Command.property_current:
-                    # Recevied a reply for a ping request
-                    if reply.get("success"):
-                       params = reply.get("params")
-                       self.response['telemetry_current_value'] = params.get("value")
-                       self.response['telemetry_current_timestamp'] = params.get("ts")
-                    else:
-                        if -90008 in reply.get("errorCodes", []):
-                            sent_message.data.status = constants.STATUS_NOT_FOUND
-                        elif sent_message.data != None:
-                            sent_message.data.status = constants.STATUS_FAILURE
-                elif sent_command_type == TR50Command.attribute_current:
-                    # Recevied a reply for a ping request
-                    if reply.get("success"):
-                       params = reply.get("params")
-                       self.response['attribute_current_value']  = params.get("value")
-                       self.response['attribute_current_timestamp']  = params.get("ts")
-                    else:
-                        if -90008 in reply.get("errorCodes", []):
-                            sent_message.data.status = constants.STATUS_NOT_FOUND
-                        elif  sent_message.data != None:
-                            sent_message.data.status = constants.STATUS_FAILURE
+                if sent_message.on_reply:
+                    sent_message.on_reply(sent_message, reply)
             status = constants.STATUS_SUCCESS
 
         return status
 
+    def aggregate_flush(self, force=False):
+        """
+        Publish the results of every aggregation window that has ended, or of
+        every window with samples if forced
+        """
+
+        now = monotonic()
+        for name, window in (list(self.windows.items()) +
+                             list(self.rate_limit_windows.items())):
+            results = window.flush(now, force)
+            if results:
+                self.aggregate_publish(name, window, results)
+
+    def aggregate_publish(self, name, window, results):
+        """
+        Queue a publish for each function of an aggregation window
+        """
+
+        start_time, values = results
+        for function, value in values:
+            key = name
+            if len(window.functions) > 1:
+                key = "{}_{}".format(name, function)
+            self.queue_publish(defs.PublishTelemetry(key, value, start_time,
+                                                     aggregate=True))
+
+    def aggregate_sample(self, telemetry_name, value):
+        """
+        Add a sample to the aggregation window of its key. Returns False if
+        the key is not aggregated, or the sample is not a number and is
+        published as it is.
+        """
+
+        window = self.windows.get(telemetry_name)
+        if window is None:
+            return False
+        if not isinstance(value, numbers.Number) or isinstance(value, bool):
+            return False
+        results = window.add(value)
+        if results:
+            self.aggregate_publish(telemetry_name, window, results)
+        return True
+
+    def coalesce_publishes(self, to_publish):
+        """
+        Keep only the newest publish of each coalesced telemetry or attribute
+        key, preserving the order of everything that is kept
+        """
+
+        coalesce_all = "*" in self.coalesce_keys
+        seen = set()
+        kept = []
+        for pub in reversed(to_publish):
+            key = pub.key()
+            if key and (coalesce_all or key[1] in self.coalesce_keys):
+                if key in seen:
+                    self.publish_shed(pub)
+                    continue
+                seen.add(key)
+            kept.append(pub)
+        kept.reverse()
+
+        self.drain_coalesced += len(to_publish) - len(kept)
+        return kept
+
     def handle_publish(self):
         """
-        Publish any pending publishes in the publish queue, or the cloud logger
+        Publish any pending publishes in the publish queue, or the cloud logger,
+        up to publish_round_size of them at a time
         """
 
         status = constants.STATUS_SUCCESS
 
-        # Collect all pending publishes in publish queue
+        # Anything queued from here on needs another round of work
+        with self.publish_cond:
+            self.publish_scheduled = False
+
+        # Collect a round's worth of pending publishes from the publish queue
         to_publish = []
+        round_size = self.publish_round_size
         while not self.publish_queue.empty():
+            if round_size and len(to_publish) >= round_size:
+                # The rest go in another round, behind anything of a higher
+                # lane queued in the meantime
+                self.schedule_publish()
+                break
             try:
                 to_publish.append(self.publish_queue.get())
             except queue.Empty:
                 break
 
+        if self.coalesce_keys and len(to_publish) > 1:
+            to_publish = self.coalesce_publishes(to_publish)
+
         if to_publish:
             # If pending publishes are found, parse into list for sending
-            messages = []
-            for pub in to_publish:
-                # Create publish command for an alarm
-                if pub.type == "PublishAlarm":
-                    command = tr50.create_alarm_publish(self.config.key,
-                                                        pub.name, pub.state,
-                                                        message=pub.message,
-                                                        timestamp=pub.timestamp)
-                    message_desc = "Alarm Publish {}".format(pub.name)
-                    message_desc += " : {}".format(pub.state)
-                    message = defs.OutMessage(command, message_desc)
-
-                # Create publish command for strings
-                elif pub.type == "PublishAttribute":
-                    command = tr50.create_attribute_publish(self.config.key,
-                                                            pub.name, pub.value,
-                                                            timestamp=pub.timestamp)
-                    message_desc = "Attribute Publish {}".format(pub.name)
-                    message_desc += " : \"{}\"".format(pub.value)
-                    message = defs.OutMessage(command, message_desc)
-
-                # Create publish command for numbers
-                elif pub.type == "PublishTelemetry":
-                    command = tr50.create_property_publish(self.config.key,
-                                                           pub.name, pub.value,
-                                                           timestamp=pub.timestamp)
-                    message_desc = "Property Publish {}".format(pub.name)
-                    message_desc += " : {}".format(pub.value)
-                    message = defs.OutMessage(command, message_desc)
-
-                # Create publish command for location
-                elif pub.type == "PublishLocation":
-                    command = tr50.create_location_publish(self.config.key,
-                                                           pub.latitude,
-                                                           pub.longitude,
-                                                           heading=pub.heading,
-                                                           altitude=pub.altitude,
-                                                           speed=pub.speed,
-                                                           fix_accuracy=pub.accuracy,
-                                                           fix_type=pub.fix_type,
-                                                           timestamp=pub.timestamp)
-                    message_desc = "Location Publish {}".format(str(pub))
-                    message = defs.OutMessage(command, message_desc)
-
-                # Create publish command for a log
-                elif pub.type == "PublishLog":
-                    command = tr50.create_log_publish(self.config.key,
-                                                      pub.message,
-                                                      timestamp=pub.timestamp)
-                    message_desc = "Log Publish {}".format(pub.message)
-                    message = defs.OutMessage(command, message_desc)
-
-                messages.append(message)
+            messages = self.publish_messages(to_publish)
 
             # Send all publishes
             if messages:
-                status = self.send(messages)
+                status = self.send_split(messages)
 
         return status
 
-    def handle_work_loop(self):
+    def handle_work_loop(self, work_queue=None):
         """
-        Loop for worker threads to handle any items put on the work queue
+        Loop for worker threads to handle any items put on a work queue,
+        work_queue unless the queue of a worker pool is given
         """
 
-        # Continuously loop while connected
+        if work_queue is None:
+            work_queue = self.work_queue
+
+        # Continuously loop while connected. Workers sleep until there is
+        # work. Setting to_quit queues empty work to wake them, which each
+        # worker passes on to the next.
         while not self.to_quit:
-            work = None
-            try:
-                work = self.work_queue.get(timeout=self.config.loop_time)
-            except queue.Empty:
-                pass
-            # If work is retrieved from the queue, handle it based on type
+            work = work_queue.get()
+            if work.type is None:
+                work_queue.task_done()
+                if self.to_quit:
+                    work_queue.put(work)
+                continue
+            pool = constants.WORK_POOLS.get(work.type)
+            start = monotonic()
+            if pool and work.queued is not None:
+                self.work_wait[pool].add(start - work.queued)
+            # Handle the work based on type
             if work:
                 try:
                     if work.type == constants.WORK_MESSAGE:
@@ -910,6 +1521,10 @@ class Handler(object):
                 except Exception:
                     # Print traceback, but don't kill thread
                     self.logger.exception("Exception:")
+            if pool:
+                self.work_run[pool].add(monotonic() - start)
+            work_queue.task_done()
+            self.state_notify()
 
         return constants.STATUS_SUCCESS
 
@@ -933,45 +1548,75 @@ class Handler(object):
         status = self.send(message)
         return constants.STATUS_SUCCESS
 
-    def handle_telemetry_get(self, telem_name ):
+    def is_connected(self):
         """
-        Add data to publish queue and wait for cloud response
+        Returns connection status of Client to Cloud
+
         """
-        command = tr50.create_property_get_current(self.config.key, telem_name)
-        message_desc = "Reading current property..."
-        message = defs.OutMessage(command, message_desc)
+        return self.state == constants.STATE_CONNECTED
 
-        self.pub_wait = True
-        status = self.send(message)
-        value = None
-        timestamp = None
-
-        # Wait for response from sending to cloud
-        while self.pub_wait:
-            sleep(0.5)
-        # Convert to return codes
-        if self.pub_response:
-            ret = constants.STATUS_SUCCESS
-        else:
-            ret = constants.STATUS_FAILURE
 
-        # make sure the key exists or there will be a KeyError
-        # exception
-        if 'telemetry_current_value' in self.response.keys():
-            value = self.response['telemetry_current_value']
+    def linger_loop(self):
+        """
+        Loop to queue work for pending publishes once the oldest one has waited
+        for the linger time
+        """
+
+        while not self.to_quit:
+            # Periodically write spooled publishes to disk, and publish
+            # aggregation windows that have ended
+            if self.spool:
+                self.spool.sync(force=False)
+            if self.windows or self.rate_limit_windows:
+                self.aggregate_flush()
+            self.reply_expire()
+            if self.action_completions or self.action_deadlines:
+                self.action_expire()
+
+            with self.publish_cond:
+                if self.to_quit:
+                    break
+                if self.publish_deadline is None:
+                    self.publish_cond.wait(self.linger_timeout())
+                    continue
 
-        if 'telemetry_current_timestamp' in self.response.keys():
-            timestamp = self.response['telemetry_current_timestamp']
-        return ret, value, timestamp
+                remaining = self.publish_deadline - monotonic()
+                if remaining > 0:
+                    self.publish_cond.wait(remaining)
+                else:
+                    self.publish_deadline = None
+                    if not self.publish_scheduled:
+                        self.publish_scheduled = True
+                        self.queue_work(defs.Work(constants.WORK_PUBLISH, None))
 
+        return constants.STATUS_SUCCESS
 
-    def is_connected(self):
+    def linger_timeout(self):
         """
-        Returns connection status of Client to Cloud
-
+        Seconds the linger thread may wait while no publishes are pending, or
+        None to wait until woken (publishing, sending and to_quit all notify
+        it). It only has to wake on its own to sync the spool, end aggregation
+        windows, expire messages without replies and time out action
+        requests.
         """
-        return self.state == constants.STATE_CONNECTED
 
+        if self.spool or self.windows or self.rate_limit_windows:
+            return self.config.loop_time
+        timeout = None
+        deadline = self.reply_tracker.next_deadline()
+        if deadline is not None:
+            timeout = max(deadline, self.reply_expire_time) - monotonic()
+        with self.lock:
+            deadlines = [completion.deadline for completion in
+                         self.action_completions.values()
+                         if completion.deadline is not None]
+            if self.action_deadlines:
+                deadlines.append(self.action_deadlines[0][0])
+        if deadlines:
+            remaining = min(deadlines) - monotonic()
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        return timeout
 
     def log_level(self, log_level=None):
         """
@@ -1003,6 +1648,17 @@ class Handler(object):
         #self.logger.log(logging.INFO, "This is a log with info")
         #self.logger.warning("This is a warning")
 
+    def loop_timeout(self):
+        """
+        Seconds the MQTT loop may wait for network activity. Only keep alive
+        pings, resending unacknowledged messages and reconnecting need it to
+        wake on its own.
+        """
+
+        if self.state != constants.STATE_CONNECTED or self.num_unfinished():
+            return self.config.loop_time
+        return max(self.config.loop_time, constants.MQTT_IDLE_LOOP_TIME)
+
     def main_loop(self):
         """
         Main loop for MQTT to send and receive messages, as well as queue work
@@ -1014,40 +1670,88 @@ class Handler(object):
 
             # If disconnected, attempt to reestablish connection
             if self.state == constants.STATE_DISCONNECTED:
-                max_time = self.config.keep_alive
-                elapsed_time = (datetime.utcnow() -
-                                self.last_connected).total_seconds()
-                if max_time == 0 or elapsed_time < max_time:
-                    try:
-                        result = self.mqtt.reconnect()
-                        if result == 0:
-                            self.logger.debug("Reconnecting...")
-                            self.state = constants.STATE_CONNECTING
-                    except Exception:
-                        sleep(self.config.loop_time)
-                else:
-                    self.logger.error("No connection after %d seconds, "
-                                      "exiting...",
-                                      self.config.keep_alive)
-                    self.to_quit = True
+                if self.reconnect_expired():
                     break
+                try:
+                    self.reconnect()
+                except Exception:
+                    self.wake_wait(self.config.loop_time)
 
-            self.mqtt.loop(timeout=self.config.loop_time)
-
-            # Make a work item to publish anything that's pending
-            if not self.publish_queue.empty():
-                self.queue_work(defs.Work(constants.WORK_PUBLISH, None))
+            self.mqtt_loop(self.loop_timeout())
 
         # One last loop to send out any pending messages
         self.mqtt.loop(timeout=0.1)
 
+        return self.shutdown()
+
+    def mqtt_loop(self, timeout):
+        """
+        Wait up to timeout seconds for the MQTT socket, or for wake(), and
+        handle whatever network activity is ready
+        """
+
+        mqtt = self.mqtt
+        if self.wake_recv is None:
+            # No socket pair on this platform, let paho wait
+            mqtt.loop(timeout=timeout)
+            return
+
+        sock = mqtt.socket()
+        if sock is None:
+            # Not connected, only to_quit can be waited for
+            self.wake_wait(timeout)
+            return
+
+        # TLS and websockets may hold data select cannot see
+        pending = getattr(sock, "pending", None)
+        if pending and pending():
+            timeout = 0
+        wlist = [sock] if mqtt.want_write() else []
+        try:
+            readable, writable, _ = select.select([sock, self.wake_recv],
+                                                  wlist, [], timeout)
+        except (select.error, socket.error, ValueError):
+            # The socket was closed by another thread
+            return
+        if self.wake_recv in readable:
+            self.wake_drain()
+
+        result = mqttlib.MQTT_ERR_SUCCESS
+        if sock in readable or timeout == 0:
+            result = mqtt.loop_read()
+        if result == mqttlib.MQTT_ERR_SUCCESS and mqtt.want_write():
+            result = mqtt.loop_write()
+        if result == mqttlib.MQTT_ERR_SUCCESS:
+            mqtt.loop_misc()
+
+    def shutdown(self):
+        """
+        Disconnect MQTT and wait for every other thread to finish
+        """
+
         # Disconnect MQTT
         self.mqtt.disconnect()
 
-        # Wait for worker threads to finish.
+        # Wait for worker threads to finish. to_quit has woken them.
         for thread in self.worker_threads:
             thread.join()
         self.worker_threads = []
+        self.worker_queues = []
+        with self.publish_cond:
+            self.publish_cond.notify_all()
+        if self.linger_thread:
+            self.linger_thread.join()
+            self.linger_thread = None
+        if self.replay_thread:
+            self.replay_thread.join()
+            self.replay_thread = None
+        if self.spool:
+            self.spool.sync()
+
+        # Anything still waiting for a reply will not get one now
+        if self.publish_waiters:
+            self.publish_replied(list(self.publish_waiters),
+                                 constants.STATUS_FAILURE)
 
         # On disconnect, show all messages that never received replies
         if len(self.reply_tracker) > 0:
@@ -1109,9 +1813,12 @@ class Handler(object):
         """
         Notify that a message has been published
         """
-        if self.reply_tracker != {}:
+        try:
             topic_num = self.reply_tracker.pop_mid(mid)
-            self.logger.debug("MQTT sent %s", topic_num)
+        except KeyError:
+            # Published before it was tracked, or given up on already
+            return
+        self.logger.debug("MQTT sent %s", topic_num)
 
     def qos_level(self, qos_level=None):
         """
@@ -1125,52 +1832,569 @@ class Handler(object):
             self.logger.warning("qos_level invalid or not set, 1 used as default")
             self.qos_level = 1
 
-    def queue_publish(self, pub):
+    def property_batch_rejected(self, message):
         """
-        Place pub in the publish queue
+        Resend the samples of a rejected property.batch command as individual
+        property.publish commands, and stop using property.batch
         """
 
-        self.publish_queue.put(pub)
+        if self.property_batch:
+            self.logger.warning("property.batch rejected by the Cloud, "
+                                "falling back to property.publish")
+            self.property_batch = False
+        samples, owners = message.data
+        messages = self.telemetry_messages(samples, owners, replaced=message)
+        return self.send_split(messages)
+
+    def publish_stats(self):
+        """
+        Get the depth and drop counters of the publish queue
+        """
+
+        stats = self.publish_queue.stats()
+        stats["work_lanes"] = self.work_queue.lane_sizes()
+        with self.lock:
+            stats.update(self.reply_tracker.stats())
+        stats.update(self.rate_limit_stats())
+        stats["drain_coalesced"] = self.drain_coalesced
+        stats["aggregated_samples"] = (
+            self.window_samples +
+            sum(window.samples for window in list(self.windows.values())))
+        stats["deadband_suppressed"] = (
+            self.deadband_suppressed +
+            sum(deadband.suppressed for deadband in
+                list(self.deadbands.values()) +
+                list(self.default_deadbands.values())))
+        if self.spool:
+            stats.update(self.spool.stats())
+        return stats
+
+    def publish_coalesce_set(self, key, enabled=True):
+        """
+        Enable or disable last-value-wins coalescing for a key
+        """
+
+        if enabled:
+            self.coalesce_keys.add(key)
+        else:
+            self.coalesce_keys.discard(key)
+        return constants.STATUS_SUCCESS
+
+    def publish_message(self, pub):
+        """
+        Create the message that sends a publish to the Cloud
+        """
+
+        if pub.type == "PublishAlarm":
+            message_desc = "Alarm Publish {}".format(pub.name)
+            message_desc += " : {}".format(pub.state)
+        elif pub.type == "PublishAttribute":
+            message_desc = "Attribute Publish {}".format(pub.name)
+            message_desc += " : \"{}\"".format(pub.value)
+        elif pub.type == "PublishTelemetry":
+            message_desc = "Property Publish {}".format(pub.name)
+            message_desc += " : {}".format(pub.value)
+        elif pub.type == "PublishLocation":
+            message_desc = "Location Publish {}".format(str(pub))
+        elif pub.type == "PublishLog":
+            message_desc = "Log Publish {}".format(pub.message)
+
+        # Encode the command straight from the publish
+        encoded = tr50.encode_publish(self.config.key, pub)
+        return defs.OutMessage(None, message_desc, publishes=[pub],
+                               encoded=encoded,
+                               command_type=tr50.PUBLISH_TEMPLATES[pub.type][0])
+
+    def publish_messages(self, pubs):
+        """
+        Create the messages that send publishes to the Cloud. Runs of
+        telemetry samples, including batches, are encoded in one pass.
+        """
+
+        messages = []
+        samples = []
+        owners = []
+        for pub in pubs:
+            if pub.type == "PublishTelemetryBatch":
+                samples.extend(pub.samples)
+                owners.extend([pub] * len(pub.samples))
+            elif pub.type == "PublishTelemetry" and not pub.aggregate:
+                samples.append((pub.name, pub.value, pub.timestamp))
+                owners.append(pub)
+            else:
+                if samples:
+                    messages.extend(self.telemetry_messages(samples, owners))
+                    samples = []
+                    owners = []
+                messages.append(self.publish_message(pub))
+        if samples:
+            messages.extend(self.telemetry_messages(samples, owners))
+        return messages
+
+    def publish_flush(self):
+        """
+        Queue work to send every pending publish, including the results of
+        partial aggregation windows
+        """
+
+        self.aggregate_flush(force=True)
+        if not self.publish_queue.empty():
+            self.schedule_publish()
+
+    def publish_replied(self, pubs, status):
+        """
+        Call the reply callbacks waiting on any of pubs with status
+        """
+
+        for pub in pubs:
+            on_reply = self.publish_waiters.pop(pub, None)
+            if on_reply:
+                on_reply(status)
+
+    def publish_settle(self, pubs, status):
+        """
+        Handle the reply to a message carrying pubs. Publishes sent in more
+        than one message are only replied to once every one of those messages
+        has been, with the first status other than success. Replied publishes
+        leave the spool, unless a message carrying them timed out. Returns the
+        publishes replied to.
+        """
+
+        settled = []
+        with self.lock:
+            for pub in pubs:
+                parts = self.publish_parts.get(pub)
+                if parts is None:
+                    settled.append((pub, status))
+                    continue
+                parts[0] -= 1
+                if parts[1] == constants.STATUS_SUCCESS:
+                    parts[1] = status
+                if parts[0] <= 0:
+                    del self.publish_parts[pub]
+                    settled.append((pub, parts[1]))
+        if self.spool:
+            self.spool_ack([pub for pub, pub_status in settled
+                            if pub_status != constants.STATUS_TIMED_OUT])
+        if self.publish_waiters:
+            for pub, pub_status in settled:
+                self.publish_replied([pub], pub_status)
+        return [pub for pub, _ in settled]
+
+    def publish_shed(self, pub):
+        """
+        Callback for a publish that will never be sent
+        """
+
+        if self.spool and pub.spool_id is not None:
+            self.spool_ack([pub])
+        if self.publish_waiters:
+            self.publish_replied([pub], constants.STATUS_FULL)
+        samples = self.deadband_samples(pub)
+        if samples:
+            for sample in samples:
+                deadband = self.deadband(sample[0])
+                if deadband:
+                    deadband.shed(pub)
+
+    def publish_rate_limit_set(self, key=None, rate=None, burst=None,
+                               policy=None, functions=None):
+        """
+        Set or, with no rate, remove the rate limit for a key, for every key
+        without its own limit ("*"), or for the whole client (None)
+        """
+
+        if policy is None:
+            policy = constants.RATE_LIMIT_DROP
+        elif policy not in constants.RATE_LIMIT_POLICIES:
+            self.logger.error("Invalid rate limit policy \"%s\" for %s",
+                              policy, key)
+            return constants.STATUS_BAD_PARAMETER
+        if functions is not None:
+            if not isinstance(functions, list):
+                functions = [functions]
+            for function in functions:
+                if function not in constants.AGGREGATE_FUNCTIONS:
+                    self.logger.error("Invalid aggregation function \"%s\" "
+                                      "for %s", function, key)
+                    return constants.STATUS_BAD_PARAMETER
+        if rate is not None and rate <= 0:
+            self.logger.error("Rate limit for %s must be positive", key)
+            return constants.STATUS_BAD_PARAMETER
+
+        with self.lock:
+            if key is None:
+                removed = [self.rate_limit_client]
+                self.rate_limit_client = None
+            elif key == "*":
+                removed = list(self.default_rate_limits.values())
+                self.default_rate_limits = {}
+                self.rate_limit_default = None
+            else:
+                removed = [self.rate_limits.pop(key, None)]
+
+            for bucket in removed:
+                if bucket:
+                    self.rate_limit_counts["rate_dropped"] += bucket.dropped
+                    self.rate_limit_counts["rate_delayed"] += bucket.delayed
+                    self.rate_limit_counts["rate_aggregated"] += \
+                        bucket.aggregated
+
+            if rate is not None:
+                if key is None:
+                    self.rate_limit_client = defs.TokenBucket(
+                        rate, burst, policy, functions)
+                elif key == "*":
+                    self.rate_limit_default = (rate, burst, policy, functions)
+                else:
+                    self.rate_limits[key] = defs.TokenBucket(
+                        rate, burst, policy, functions)
         return constants.STATUS_SUCCESS
 
+    def queue_publish(self, pub, on_reply=None, block=True):
+        """
+        Place pub in the publish queue, after writing it to the spool.
+        on_reply is called with the status of the Cloud's reply to it, or
+        STATUS_FULL if it is shed. With the block policy and block False, pub
+        is shed instead of waiting for room in a full queue.
+        """
+
+        if on_reply:
+            self.publish_waiters[pub] = on_reply
+
+        if self.read_cache:
+            if pub.type == "PublishTelemetry":
+                self.read_cache.invalidate((constants.READ_TELEMETRY,
+                                            pub.name))
+            elif pub.type == "PublishAttribute":
+                self.read_cache.invalidate((constants.READ_ATTRIBUTE,
+                                            pub.name))
+            elif pub.type == "PublishTelemetryBatch":
+                for name in set(sample[0] for sample in pub.samples):
+                    self.read_cache.invalidate((constants.READ_TELEMETRY,
+                                                name))
+
+        if self.spool:
+            try:
+                self.spool.append(pub)
+            except (IOError, OSError) as error:
+                self.logger.error("Failed to spool publish: %s", str(error))
+
+        # Telemetry only becomes the last published value of its deadband
+        # once it is queued. Its value is taken first, as coalescing in the
+        # queue may exchange it.
+        samples = self.deadband_samples(pub)
+        status = self.publish_queue.put(pub, block)
+        if status == constants.STATUS_FULL:
+            self.logger.debug("Publish queue full, shed %s (%s)", pub.type,
+                              self.publish_queue.policy)
+        elif samples:
+            self.deadband_accept(pub, samples)
+
+        if (self.publish_linger <= 0 or
+                (self.publish_alarm_immediate and pub.type == "PublishAlarm") or
+                (self.publish_batch_size and
+                 self.publish_queue.qsize() >= self.publish_batch_size)):
+            self.schedule_publish()
+        else:
+            # Start the linger timer if this begins a new batch
+            with self.publish_cond:
+                if (self.publish_deadline is None and
+                        not self.publish_scheduled):
+                    self.publish_deadline = monotonic() + self.publish_linger
+                    self.publish_cond.notify()
+        return status
+
     def queue_work(self, work):
         """
-        Place work in the work queue
+        Place work in the work queue of its pool
         """
 
-        self.work_queue.put(work)
+        work.queued = monotonic()
+        self.work_queue_for(work.type).put(work)
         return constants.STATUS_SUCCESS
 
-    def request_publish(self, data, cloud_response):
+    def rate_limit(self, name, value=None):
         """
-        Add data to publish queue and wait for cloud response
+        Apply the rate limits of a key (if any) and of the client to a
+        publish. Returns None if it can be queued, after waiting if the delay
+        policy says so, otherwise the status to return for it.
         """
-        current_time = datetime.utcnow()
-        end_time = current_time + timedelta(seconds=15)
-        timeout = False
-
-        self.pub_wait = cloud_response
-        status = self.queue_publish(data)
-        if cloud_response:
-            status = constants.STATUS_FAILURE
-            # Wait for response from sending to cloud
-            while self.pub_wait and not self.to_quit:
-                current_time = datetime.utcnow()
-                if (current_time > end_time):
-                    timeout = True
-                    break
+
+        status, wait = self.rate_check(name, value)
+        if wait:
+            sleep(wait)
+        return status
+
+    def rate_check(self, name, value=None):
+        """
+        Check the rate limits of a key (if any) and of the client for a
+        publish. Returns (None, seconds to wait before queueing it) if it can
+        be queued, otherwise (status to return for it, 0).
+        """
+
+        bucket = None
+        if name is not None:
+            bucket = self.rate_limits.get(name)
+            if bucket is None and self.rate_limit_default is not None:
+                bucket = self.default_rate_limits.get(name)
+                if bucket is None:
+                    bucket = self.default_rate_limits.setdefault(
+                        name, defs.TokenBucket(*self.rate_limit_default))
+        if bucket is None and self.rate_limit_client is None:
+            return None, 0
+
+        aggregate = (isinstance(value, numbers.Number) and
+                     not isinstance(value, bool))
+        delay = 0
+        for bucket in (bucket, self.rate_limit_client):
+            if bucket is None:
+                continue
+            wait = bucket.take(aggregate=aggregate)
+            if not wait:
+                continue
+            if bucket.policy == constants.RATE_LIMIT_DELAY:
+                delay = max(delay, wait)
+            elif bucket.policy == constants.RATE_LIMIT_AGGREGATE and aggregate:
+                self.rate_limit_aggregate(name, bucket, value)
+                return constants.STATUS_SUCCESS, 0
+            else:
+                return constants.STATUS_TRY_AGAIN, 0
+        return None, delay
+
+    def rate_limit_aggregate(self, name, bucket, value):
+        """
+        Add an over limit telemetry sample to the aggregation window of its
+        key, which lasts as long as the bucket takes to refill
+        """
+
+        window = self.rate_limit_windows.get(name)
+        if window is None:
+            window = self.rate_limit_windows.setdefault(
+                name, defs.TelemetryWindow(bucket.window(), bucket.functions))
+        results = window.add(value)
+        if results:
+            self.aggregate_publish(name, window, results)
+
+    def rate_limit_stats(self):
+        """
+        Get how many publishes were dropped, delayed or aggregated by rate
+        limits, in total and for each key
+        """
+
+        with self.lock:
+            stats = dict(self.rate_limit_counts)
+            buckets = (list(self.rate_limits.items()) +
+                       list(self.default_rate_limits.items()))
+            client = self.rate_limit_client
+
+        keys = {}
+        for name, bucket in buckets + [(None, client)]:
+            if bucket is None:
+                continue
+            stats["rate_dropped"] += bucket.dropped
+            stats["rate_delayed"] += bucket.delayed
+            stats["rate_aggregated"] += bucket.aggregated
+            limited = bucket.dropped + bucket.delayed + bucket.aggregated
+            if name is not None and limited:
+                keys[name] = limited
+        stats["rate_limited_keys"] = keys
+        return stats
+
+    def read_cache_stats(self):
+        """
+        Get the hit and miss counters of the read cache
+        """
+
+        if self.read_cache:
+            return self.read_cache.stats()
+        return {"read_cache_hits":0, "read_cache_misses":0,
+                "read_cache_entries":0, "read_cache_evictions":0,
+                "read_cache_invalidations":0}
+
+    def read_last_samples(self, names, kind=constants.READ_TELEMETRY,
+                          timeout=0):
+        """
+        Read back the last sample of many telemetry or attribute keys from the
+        Cloud in one request, waiting up to timeout seconds (0 waits forever)
+        for the replies. Returns {name: (status, value, timestamp)}.
+        """
+
+        results = self.read_request(names, kind)
+        return results.wait(timeout or None)
+
+    def read_request(self, names, kind=constants.READ_TELEMETRY,
+                     on_done=None):
+        """
+        Send the reads of the last sample of each name, packed into as few
+        requests as the request limits allow. Names in the read cache are not
+        sent. Returns the ReadResults the replies are collected in. on_done is
+        called with the results once every name has one.
+        """
+
+        # Each name is only read once, however many times it was asked for
+        unique = []
+        seen = set()
+        for name in names:
+            if name not in seen:
+                seen.add(name)
+                unique.append(name)
+
+        if kind == constants.READ_TELEMETRY:
+            create = tr50.create_property_get_current
+        elif kind == constants.READ_ATTRIBUTE:
+            create = tr50.create_attribute_current
+        else:
+            self.logger.error("Unknown read kind \"%s\"", kind)
+            results = defs.ReadResults(unique, on_done)
+            for name in unique:
+                results.set(name, (constants.STATUS_BAD_PARAMETER, None, None))
+            return results
+
+        # Only names that are not cached are read from the Cloud. Whatever
+        # they read is cached, unless they are published in the meantime.
+        cache = self.read_cache
+        hits = []
+        misses = unique
+        tokens = {}
+        on_result = None
+        if cache:
+            misses = []
+            for name in unique:
+                result = cache.get((kind, name))
+                if result:
+                    hits.append((name, result))
                 else:
-                    sleep(0.5)
+                    tokens[name] = cache.start((kind, name))
+                    misses.append(name)
+
+            def on_result(name, result):
+                token = tokens.pop(name, None)
+                if token:
+                    cache.put((kind, name), result, token)
+
+        results = defs.ReadResults(unique, on_done, on_result)
+        messages = [defs.OutMessage(create(self.config.key, name),
+                                    "Read {} {}".format(kind, name),
+                                    data=name, on_reply=results.reply)
+                    for name in misses]
+        if messages:
+            self.send_split(messages)
+
+        # Anything that could not be sent will never get a reply
+        for message in messages:
+            if message.out_id is None:
+                results.set(message.data,
+                            (constants.STATUS_FAILURE, None, None))
+        for name, result in hits:
+            results.set(name, result)
+        return results
+
+    def reconnect(self):
+        """
+        Attempt to reestablish the MQTT connection. Raises whatever opening
+        the connection raises.
+        """
 
-            # Convert to return codes
-            if self.pub_response:
-                status = constants.STATUS_SUCCESS
-            elif timeout:
-                status = constants.STATUS_TIMED_OUT
+        result = self.mqtt.reconnect()
+        if result == 0:
+            self.logger.debug("Reconnecting...")
+            self.state = constants.STATE_CONNECTING
+        return result
+
+    def reconnect_expired(self):
+        """
+        Returns True, and tells the Client to quit, once there has been no
+        connection for longer than keep_alive
+        """
+
+        max_time = self.config.keep_alive
+        elapsed_time = (datetime.utcnow() -
+                        self.last_connected).total_seconds()
+        if max_time == 0 or elapsed_time < max_time:
+            return False
+        self.logger.error("No connection after %d seconds, exiting...",
+                          self.config.keep_alive)
+        self.to_quit = True
+        return True
+
+    def replay_loop(self):
+        """
+        Loop to send publishes recovered from the spool in rate limited batches
+        whenever connected
+        """
+
+        while not self.to_quit and self.spool.replay_backlog:
+            if self.is_connected():
+                pubs = self.spool.replay(self.spool_replay_batch)
+                if pubs:
+                    self.logger.info("Replaying %d spooled publishes",
+                                     len(pubs))
+                    self.send_split(self.publish_messages(pubs))
+            with self.publish_cond:
+                if not self.to_quit:
+                    self.publish_cond.wait(self.spool_replay_interval)
+
+        return constants.STATUS_SUCCESS
+
+    def reply_expire(self):
+        """
+        Give up on sent messages that have waited longer than reply_timeout
+        for a reply. Checked at most once a second.
+        """
+
+        now = monotonic()
+        if now < self.reply_expire_time:
+            return
+        self.reply_expire_time = now + 1
+        with self.lock:
+            expired = self.reply_tracker.expire(now)
+        for message in expired:
+            self.reply_expired(message)
+        if expired:
+            self.state_notify()
+
+    def reply_expired(self, message):
+        """
+        Fail whatever is waiting for the reply to a message that will never
+        get one
+        """
+
+        self.logger.error("No reply for %s - %s", message.out_id, message)
+        if message.publishes:
+            self.publish_settle(message.publishes, constants.STATUS_TIMED_OUT)
+        if isinstance(message.data, defs.FileTransfer):
+            message.data.status = constants.STATUS_TIMED_OUT
+            message.data.finish()
+        if message.on_reply:
+            message.on_reply(message, {"success":False, "timedOut":True})
+
+    def request_publish(self, data, cloud_response):
+        """
+        Add data to publish queue and, if cloud_response, wait for the Cloud
+        to reply to it
+        """
+
+        if not cloud_response:
+            return self.queue_publish(data)
+
+        # Each publish has its own waiter, so any number of threads can wait
+        # for their replies at once
+        waiter = defs.ReplyWaiter()
+        status = self.queue_publish(data, waiter.set)
+        if status == constants.STATUS_FULL:
+            self.publish_waiters.pop(data, None)
+            return status
+
+        status = waiter.wait(self.publish_reply_timeout)
+        if status is None:
+            self.publish_waiters.pop(data, None)
+            status = constants.STATUS_TIMED_OUT
         return status
 
     def request_download(self, file_name, file_dest, blocking=False,
-                         callback=None, timeout=0, file_global=False):
+                         callback=None, timeout=0, file_global=False,
+                         on_reply=None):
         """
         Request a C2D file transfer
         """
@@ -1191,7 +2415,7 @@ class Handler(object):
         # Generate and send message to request file transfer
         command = tr50.create_file_get(self.config.key, file_name, file_global)
         message = defs.OutMessage(command, "Download {}".format(file_name),
-                                  data=transfer)
+                                  data=transfer, on_reply=on_reply)
         status = self.send(message)
 
         # If blocking is set, wait for result of file transfer
@@ -1209,7 +2433,8 @@ class Handler(object):
         return status
 
     def request_upload(self, file_path, upload_name=None, blocking=False,
-                       callback=None, timeout=0, file_global=False):
+                       callback=None, timeout=0, file_global=False,
+                       on_reply=None):
         """
         Request a D2C file transfer
         """
@@ -1258,7 +2483,7 @@ class Handler(object):
                 message_desc = "Upload {} as {}".format(file_name,
                                                         upload_name)
                 message = defs.OutMessage(command, message_desc,
-                                          data=transfer)
+                                          data=transfer, on_reply=on_reply)
                 status = self.send(message)
 
                 # If blocking is set, wait for result of file transfer
@@ -1275,6 +2500,284 @@ class Handler(object):
 
         return status
 
+    def schedule_publish(self):
+        """
+        Queue work to send all pending publishes now, unless it is already
+        queued
+        """
+
+        with self.publish_cond:
+            self.publish_deadline = None
+            if self.publish_scheduled:
+                return constants.STATUS_SUCCESS
+            self.publish_scheduled = True
+        return self.queue_work(defs.Work(constants.WORK_PUBLISH, None))
+
+    def spool_ack(self, pubs):
+        """
+        Remove publishes from the spool
+        """
+
+        try:
+            self.spool.ack([pub.spool_id for pub in pubs
+                            if pub.spool_id is not None])
+        except (IOError, OSError) as error:
+            self.logger.error("Failed to update spool: %s", str(error))
+
+    def telemetry_filter(self, telemetry_name, value):
+        """
+        Returns True if a telemetry sample was taken by an aggregation window
+        or suppressed by a deadband, so it should not be queued
+        """
+
+        return (self.aggregate_sample(telemetry_name, value) or
+                not self.deadband_filter(telemetry_name, value))
+
+    def telemetry_messages(self, samples, owners=None, replaced=None):
+        """
+        Create the messages for (name, value, timestamp) telemetry samples.
+        With property_batch enabled, consecutive samples of the same key are
+        sent in one property.batch command. owners holds the publish of each
+        sample, and each message carries the publishes of its own samples.
+        replaced is a message the new messages are sent instead of.
+        """
+
+        if owners is None:
+            owners = [None] * len(samples)
+        messages = []
+        if self.property_batch:
+            start = 0
+            while start < len(samples):
+                name = samples[start][0]
+                end = start + 1
+                while end < len(samples) and samples[end][0] == name:
+                    end += 1
+                if end - start > 1:
+                    data = [(value, timestamp) for _, value, timestamp in
+                            samples[start:end]]
+                    encoded = tr50.encode_property_batch(self.config.key,
+                                                         name, data)
+                    # The samples are kept with their publishes to resend
+                    # them one by one if the Cloud rejects property.batch
+                    publishes = []
+                    for owner in owners[start:end]:
+                        if owner is not None and (not publishes or
+                                                  publishes[-1] is not owner):
+                            publishes.append(owner)
+                    messages.append(defs.OutMessage(
+                        None, "Property Batch {} : {} samples".format(
+                            name, end - start),
+                        data=(samples[start:end], owners[start:end]),
+                        publishes=publishes, encoded=encoded,
+                        command_type=TR50Command.property_batch))
+                else:
+                    messages.extend(self.telemetry_messages_single(
+                        samples[start:end], owners[start:end]))
+                start = end
+        else:
+            messages = self.telemetry_messages_single(samples, owners)
+
+        self.telemetry_parts(messages, replaced)
+        return messages
+
+    def telemetry_messages_single(self, samples, owners):
+        """
+        Create a property.publish message for each telemetry sample
+        """
+
+        encoded = tr50.encode_telemetry_batch(self.config.key, samples)
+        return [defs.OutMessage(None,
+                                "Property Publish {} : {}".format(name, value),
+                                publishes=[owner] if owner else None,
+                                encoded=command,
+                                command_type=TR50Command.property_publish)
+                for (name, value, _), command, owner in zip(samples, encoded,
+                                                            owners)]
+
+    def telemetry_parts(self, messages, replaced=None):
+        """
+        Count the messages carrying each batch of telemetry samples, so it is
+        only replied to once all of them are. Messages sent instead of the
+        replaced message take over from it.
+        """
+
+        counts = {}
+        for message in messages:
+            for pub in message.publishes:
+                if pub.type == "PublishTelemetryBatch":
+                    counts[pub] = counts.get(pub, 0) + 1
+        if not counts:
+            return
+        replaced_pubs = replaced.publishes if replaced else ()
+        with self.lock:
+            for pub, count in counts.items():
+                parts = self.publish_parts.get(pub)
+                if pub in replaced_pubs:
+                    count -= 1
+                    if parts is None:
+                        count += 1
+                if parts is not None:
+                    parts[0] += count
+                elif count > 1:
+                    self.publish_parts[pub] = [count,
+                                               constants.STATUS_SUCCESS]
+
+    def telemetry_publish_many(self, samples, values=None, timestamps=None):
+        """
+        Queue many telemetry samples as a single batch
+        """
+
+        status, pub, wait = self.telemetry_batch(samples, values, timestamps)
+        if pub is None:
+            return status
+        if wait:
+            sleep(wait)
+        return self.queue_publish(pub)
+
+    def telemetry_batch(self, samples, values=None, timestamps=None):
+        """
+        Filter and rate limit many telemetry samples into a single batch.
+        Returns (status, batch publish or None if there is nothing to queue,
+        seconds to wait before queueing it).
+        """
+
+        if values is not None:
+            # Parallel sequences of names (or one name), values and timestamps
+            if hasattr(values, "tolist"):
+                values = values.tolist()
+            values = list(values)
+            if isinstance(samples, tr50.STRING_TYPES):
+                names = [samples] * len(values)
+            else:
+                names = list(samples)
+            if timestamps is None:
+                timestamps = [None] * len(values)
+            else:
+                timestamps = list(timestamps)
+            if not len(names) == len(values) == len(timestamps):
+                self.logger.error("Telemetry names, values and timestamps "
+                                  "differ in length")
+                return constants.STATUS_BAD_PARAMETER, None, 0
+            samples = zip(names, values, timestamps)
+
+        now = None
+        batch = []
+        delay = 0
+        for sample in samples:
+            name, value = sample[0], sample[1]
+            if self.telemetry_filter(name, value):
+                continue
+            status, wait = self.rate_check(name, value)
+            if status is not None:
+                continue
+            delay = max(delay, wait)
+
+            # Samples without a timestamp share one for the whole batch
+            timestamp = sample[2] if len(sample) > 2 else None
+            if timestamp is None:
+                if now is None:
+                    now = defs.format_time_ns(defs.time_ns())
+                timestamp = now
+            elif type(timestamp) is datetime:
+                timestamp = timestamp.strftime(constants.TIME_FORMAT)
+            batch.append((name, value, timestamp))
+
+        if not batch:
+            return constants.STATUS_SUCCESS, None, 0
+        return (constants.STATUS_SUCCESS, defs.PublishTelemetryBatch(batch),
+                delay)
+
+    def telemetry_aggregate_set(self, telemetry_name, window=None,
+                                functions=None):
+        """
+        Aggregate a telemetry key over windows of window seconds or, with no
+        window, stop aggregating it
+        """
+
+        if functions is None:
+            functions = [constants.AGGREGATE_AVG]
+        elif not isinstance(functions, list):
+            functions = [functions]
+        for function in functions:
+            if function not in constants.AGGREGATE_FUNCTIONS:
+                self.logger.error("Invalid aggregation function \"%s\" for "
+                                  "%s", function, telemetry_name)
+                return constants.STATUS_BAD_PARAMETER
+
+        with self.lock:
+            # Publish what was aggregated so far before changing the window
+            old_window = self.windows.pop(telemetry_name, None)
+            if old_window:
+                self.window_samples += old_window.samples
+            if window:
+                self.windows[telemetry_name] = defs.TelemetryWindow(window,
+                                                                    functions)
+        if old_window:
+            results = old_window.flush(force=True)
+            if results:
+                self.aggregate_publish(telemetry_name, old_window, results)
+        return constants.STATUS_SUCCESS
+
+    def telemetry_deadband_set(self, telemetry_name, absolute=None,
+                               percent=None, max_silence=None):
+        """
+        Set or, with no thresholds, remove the deadband for a telemetry key
+        """
+
+        with self.lock:
+            if telemetry_name == "*":
+                removed = list(self.default_deadbands.values())
+                self.default_deadbands = {}
+                self.deadband_default = None
+            else:
+                removed = [self.deadbands.pop(telemetry_name, None)]
+
+            for deadband in removed:
+                if deadband:
+                    self.deadband_suppressed += deadband.suppressed
+
+            if (absolute is not None or percent is not None or
+                    max_silence is not None):
+                if telemetry_name == "*":
+                    self.deadband_default = (absolute, percent, max_silence)
+                else:
+                    self.deadbands[telemetry_name] = defs.Deadband(
+                        absolute, percent, max_silence)
+        return constants.STATUS_SUCCESS
+
+    def send_split(self, messages):
+        """
+        Send commands split into as many requests as required to stay within
+        max_commands_per_request and max_payload_bytes. Each request is tracked
+        separately, so failing to send one does not affect the others.
+        """
+
+        status = constants.STATUS_SUCCESS
+        max_commands = self.config.max_commands_per_request or 0
+        max_bytes = self.config.max_payload_bytes or 0
+
+        if max_bytes:
+            sizes = [len(msg.encoded) if msg.encoded is not None else
+                     tr50.command_size(msg.command) for msg in messages]
+        else:
+            sizes = [0] * len(messages)
+
+        for start, end in tr50.split_request(sizes, max_commands, max_bytes):
+            if max_bytes and end - start == 1 and sizes[start] > max_bytes:
+                self.logger.warning("%s exceeds max_payload_bytes (%d), "
+                                    "sending it on its own",
+                                    messages[start], max_bytes)
+            try:
+                result = self.send(messages[start:end])
+            except Exception:
+                self.logger.exception("Failed to send commands %d-%d:",
+                                      start + 1, end)
+                result = constants.STATUS_FAILURE
+            if result != constants.STATUS_SUCCESS:
+                status = result
+
+        return status
+
     def send(self, messages):
         """
         Send commands to the Cloud, and track them to wait for replies
@@ -1286,11 +2789,15 @@ class Handler(object):
             message_list = [messages]
 
         # Generate final request string
-        payload = tr50.generate_request([x.command for x in message_list])
+        payload = tr50.generate_request_encoded(
+            [x.encoded if x.encoded is not None else
+             tr50.encode_command(x.command) for x in message_list])
 
         # Lock to ensure all outgoing messages are tracked before handling
         # received messages
+        evicted = []
         self.lock.acquire()
+        idle = self.reply_tracker.next_deadline() is None
         try:
             # Obtain new unused topic number
             while True:
@@ -1298,10 +2805,12 @@ class Handler(object):
                 self.topic_counter += 1
                 if topic_num not in self.reply_tracker:
                     break
-            self.pub_topic = topic_num
             # Send payload over MQTT
             result, mid = self.mqtt.publish("api/{}".format(topic_num),
                                             payload, qos = self.qos_level)
+            if self.mqtt.want_write():
+                # Not all written, the main loop has to finish it
+                self.wake()
 
             # Track the topic this message will send on
             self.reply_tracker.add_mid(mid, topic_num)
@@ -1309,20 +2818,187 @@ class Handler(object):
             # Current timestamp to mark when message was sent
             current_time = datetime.utcnow()
 
-            # Track each message
+            # Track each message. Only pay for pretty printing commands if
+            # they will be logged.
+            log_commands = self.logger.isEnabledFor(logging.INFO)
             for num, msg in enumerate(message_list):
                 # Add timestamps and ids
                 msg.timestamp = current_time
                 msg.out_id = "{}-{}".format(topic_num, num+1)
 
-                self.reply_tracker.add_message(msg)
-                self.logger.info("MQTT queued %s-%d - %s\n%s", topic_num, num+1,
-                                 msg, json.dumps(msg.command, indent=2,
-                                                 sort_keys=True))
+                evicted.extend(self.reply_tracker.add_message(msg))
+                if log_commands:
+                    self.logger.info("MQTT queued %s-%d - %s\n%s", topic_num,
+                                     num+1, msg,
+                                     json.dumps(msg.command, indent=2,
+                                                sort_keys=True))
             status = constants.STATUS_SUCCESS
 
         finally:
             self.lock.release()
 
+        # Messages pushed out of the full reply tracker will never get a reply
+        for message in evicted:
+            self.reply_expired(message)
+
+        # The linger thread waits for the first reply deadline
+        if idle and self.reply_tracker.next_deadline() is not None:
+            with self.publish_cond:
+                self.publish_cond.notify()
         return status
 
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        self._state = state
+        self.state_notify()
+
+    def state_notify(self):
+        """
+        Wake anything waiting in state_wait to check again
+        """
+
+        with self.state_cond:
+            self.state_cond.notify_all()
+
+    def state_wait(self, predicate, deadline=None):
+        """
+        Wait until predicate() is True or the monotonic deadline passes (None
+        waits forever). Returns the final result of predicate().
+        """
+
+        with self.state_cond:
+            result = predicate()
+            while not result:
+                if deadline is None:
+                    self.state_cond.wait()
+                else:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    self.state_cond.wait(remaining)
+                result = predicate()
+            return result
+
+    @property
+    def to_quit(self):
+        return self._to_quit
+
+    @to_quit.setter
+    def to_quit(self, to_quit):
+        """
+        Set whether the Client is quitting. Quitting wakes the main loop,
+        linger thread and worker threads, so they stop straight away.
+        """
+
+        self._to_quit = to_quit
+        if to_quit:
+            self.wake()
+            self.state_notify()
+            with self.publish_cond:
+                self.publish_cond.notify_all()
+            for work_queue in self.worker_queues:
+                work_queue.put(defs.Work(None, None))
+
+    def wake(self):
+        """
+        Wake the main loop from waiting for network activity
+        """
+
+        if self.wake_send is not None:
+            try:
+                self.wake_send.send(b"0")
+            except socket.error:
+                # Full, so it is awake already
+                pass
+
+    def wake_drain(self):
+        """
+        Empty the wake up socket
+        """
+
+        try:
+            while self.wake_recv.recv(1024):
+                pass
+        except socket.error:
+            pass
+
+    def wake_wait(self, timeout):
+        """
+        Wait up to timeout seconds for wake()
+        """
+
+        if self.wake_recv is None:
+            sleep(timeout)
+            return
+        readable = select.select([self.wake_recv], [], [], timeout)[0]
+        if readable:
+            self.wake_drain()
+
+    def work_pending(self):
+        """
+        Returns the number of items waiting in every work queue
+        """
+
+        return sum(work_queue.qsize() for work_queue in self.work_queues())
+
+    def work_queue_for(self, work_type):
+        """
+        Returns the queue for a type of work: its pool's own queue, or
+        work_queue if the pool has no threads of its own
+        """
+
+        return self.pool_queues.get(constants.WORK_POOLS.get(work_type),
+                                    self.work_queue)
+
+    def work_queues(self):
+        """
+        Returns work_queue and the queue of every worker pool
+        """
+
+        return [self.work_queue] + list(self.pool_queues.values())
+
+    def work_stats(self):
+        """
+        Get the threads, backlog, queue wait and handling time of each worker
+        pool
+        """
+
+        stats = {}
+        for pool in constants.WORK_POOL_NAMES:
+            work_queue = self.pool_queues.get(pool)
+            if work_queue is not None:
+                pending = work_queue.qsize()
+            else:
+                pending = len([work for work in self.work_queue.items()
+                               if constants.WORK_POOLS.get(work.type) == pool])
+            stats[pool] = {
+                "threads":self.pool_sizes[pool],
+                "pending":pending,
+                "wait":self.work_wait[pool].stats(),
+                "run":self.work_run[pool].stats()
+            }
+        return stats
+
+    def worker_pool_sizes(self):
+        """
+        Read the number of threads of each worker pool from worker_pools
+        """
+
+        sizes = dict((pool, 0) for pool in constants.WORK_POOL_NAMES)
+        pools = self.config.worker_pools or {}
+        for pool, size in pools.items():
+            if pool not in sizes:
+                self.logger.warning("Unknown worker pool \"%s\", expected "
+                                    "one of %s", pool,
+                                    ", ".join(constants.WORK_POOL_NAMES))
+            elif not isinstance(size, int) or size < 0:
+                self.logger.warning("Worker pool \"%s\" must have 0 or more "
+                                    "threads, leaving it to the worker "
+                                    "threads", pool)
+            else:
+                sizes[pool] = size
+        return sizes
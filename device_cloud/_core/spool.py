@@ -0,0 +1,408 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the on-disk spool that keeps publishes until the Cloud has
+replied to them, so they survive restarts of the Client
+"""
+
+import json
+import os
+import struct
+import threading
+from binascii import crc32
+from bisect import bisect_right
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+from device_cloud._core import defs
+
+
+# Record header: length of body, crc32 of body
+HEADER = struct.Struct("<II")
+
+# Record types
+RECORD_PUBLISH = b"P"
+RECORD_ACK = b"A"
+
+# Segment file name, numbered by the sequence number of its first record
+SEGMENT_FORMAT = "{:020d}.seg"
+SEGMENT_SUFFIX = ".seg"
+
+# Attributes stored for each type of publish, after its timestamp
+PUBLISH_FIELDS = {
+    "PublishAlarm":("name", "state", "message"),
+    "PublishAttribute":("name", "value"),
+    "PublishLocation":("latitude", "longitude", "heading", "altitude",
+                       "speed", "accuracy", "fix_type"),
+    "PublishLog":("message",),
+    "PublishTelemetry":("name", "value", "aggregate"),
+    "PublishTelemetryBatch":("samples",)
+}
+
+
+def decode_publish(body):
+    """
+    Rebuild a publish from the body of a spool record
+    """
+
+    fields = json.loads(body[1:].decode("utf-8"))
+    seq, pub_type, timestamp = fields[:3]
+    pub_class = getattr(defs, pub_type)
+    pub = pub_class.__new__(pub_class)
+    pub.timestamp = timestamp
+    pub.spool_id = seq
+    values = fields[3:]
+    for num, name in enumerate(PUBLISH_FIELDS[pub_type]):
+        # Fields added since the record was written are left unset
+        setattr(pub, name, values[num] if num < len(values) else None)
+    return pub
+
+def encode_publish(seq, pub):
+    """
+    Generate the body of a spool record for a publish
+    """
+
+    fields = [seq, pub.type, pub.timestamp]
+    fields.extend(getattr(pub, name) for name in PUBLISH_FIELDS[pub.type])
+    return RECORD_PUBLISH + json.dumps(fields,
+                                       separators=(",", ":")).encode("utf-8")
+
+def encode_ack(seqs):
+    """
+    Generate the body of a spool record acknowledging sequence numbers, as a
+    list of inclusive ranges
+    """
+
+    ranges = []
+    for seq in sorted(seqs):
+        if ranges and ranges[-1][1] + 1 == seq:
+            ranges[-1][1] = seq
+        else:
+            ranges.append([seq, seq])
+    return RECORD_ACK + json.dumps(ranges,
+                                   separators=(",", ":")).encode("utf-8")
+
+def read_records(path, offset=0):
+    """
+    Yield (offset after record, body) for each intact record in a segment.
+    Stops at the first torn or corrupt record.
+    """
+
+    with open(path, "rb") as seg_file:
+        seg_file.seek(offset)
+        while True:
+            header = seg_file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            length, checksum = HEADER.unpack(header)
+            body = seg_file.read(length)
+            if len(body) < length or crc32(body) & 0xffffffff != checksum:
+                break
+            offset += HEADER.size + length
+            yield offset, body
+
+
+class Segment(object):
+    """
+    Holds information about one segment file of the spool
+    """
+
+    def __init__(self, path, first_seq):
+        self.path = path
+        self.first_seq = first_seq
+        self.acked = bytearray()
+        self.pending = 0
+        self.size = 0
+
+    def ack(self, seq):
+        """
+        Mark a sequence number in this segment as acknowledged. Returns True
+        if it was pending.
+        """
+
+        index = seq - self.first_seq
+        if 0 <= index < len(self.acked) and not self.acked[index]:
+            self.acked[index] = 1
+            self.pending -= 1
+            return True
+        return False
+
+
+class Spool(object):
+    """
+    Append-only store of publishes split into segment files. Publishes are
+    appended before they are sent and acknowledged when the Cloud replies.
+    Segments are deleted once everything in them and in every older segment
+    is acknowledged, or when the spool grows past max_bytes (oldest first).
+    Acks are written to the newest segment, so a segment can hold the acks of
+    publishes in older ones and must outlive them.
+    """
+
+    def __init__(self, directory, segment_bytes, max_bytes, fsync_interval,
+                 logger):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval
+        self.logger = logger
+
+        self.lock = threading.Lock()
+        self.segments = []
+        self.first_seqs = []
+        self.active = None
+        self.active_file = None
+        self.next_seq = 1
+        self.size = 0
+        self.dirty = False
+        self.last_sync = monotonic()
+        self.evicted = 0
+
+        # Segments found when opening, read back for replay
+        self.replay_segments = []
+        self.replay_offset = 0
+        self.replay_backlog = 0
+
+    def open(self):
+        """
+        Recover any segments left by a previous run and start a new segment
+        """
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.endswith(SEGMENT_SUFFIX))
+        acks = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                segment = Segment(path, int(name[:-len(SEGMENT_SUFFIX)]))
+            except ValueError:
+                continue
+
+            offset = 0
+            for offset, body in read_records(path):
+                if body[:1] == RECORD_PUBLISH:
+                    segment.acked.append(0)
+                    segment.pending += 1
+                elif body[:1] == RECORD_ACK:
+                    acks.extend(json.loads(body[1:].decode("utf-8")))
+
+            # Drop anything after the last intact record
+            if offset < os.path.getsize(path):
+                self.logger.warning("Truncating torn spool segment %s", path)
+                with open(path, "r+b") as seg_file:
+                    seg_file.truncate(offset)
+            segment.size = offset
+            self.add_segment(segment)
+            self.next_seq = max(self.next_seq,
+                                segment.first_seq + len(segment.acked))
+
+        for start, end in acks:
+            for seq in range(start, end + 1):
+                segment = self.find_segment(seq)
+                if segment:
+                    segment.ack(seq)
+
+        for segment in self.segments:
+            if segment.pending:
+                self.replay_segments.append(segment)
+                self.replay_backlog += segment.pending
+
+        if self.replay_backlog:
+            self.logger.info("Recovered %d unacknowledged publishes from the "
+                             "spool", self.replay_backlog)
+        self.start_segment()
+
+    def add_segment(self, segment):
+        self.segments.append(segment)
+        self.first_seqs.append(segment.first_seq)
+        self.size += segment.size
+
+    def find_segment(self, seq):
+        index = bisect_right(self.first_seqs, seq) - 1
+        if index >= 0:
+            return self.segments[index]
+        return None
+
+    def remove_acked(self):
+        """
+        Delete fully acknowledged segments, oldest first. A segment is kept
+        while any older one is, as its acks may cover publishes in those.
+        """
+
+        while self.segments and self.segments[0] is not self.active and \
+                self.segments[0].pending == 0:
+            segment = self.segments[0]
+            if segment in self.replay_segments:
+                if segment is self.replay_segments[0]:
+                    self.replay_offset = 0
+                self.replay_segments.remove(segment)
+            self.remove_segment(segment)
+
+    def remove_segment(self, segment):
+        index = self.segments.index(segment)
+        del self.segments[index]
+        del self.first_seqs[index]
+        self.size -= segment.size
+        try:
+            os.remove(segment.path)
+        except OSError as error:
+            self.logger.error("Failed to remove spool segment %s: %s",
+                              segment.path, str(error))
+
+    def start_segment(self):
+        if self.active_file:
+            self.active_file.flush()
+            os.fsync(self.active_file.fileno())
+            self.active_file.close()
+        # A segment without publishes (empty, or only acks) starts at the
+        # next sequence number too. Skip one so they never share a file.
+        if self.segments and self.segments[-1].first_seq >= self.next_seq:
+            self.next_seq = self.segments[-1].first_seq + 1
+        path = os.path.join(self.directory,
+                            SEGMENT_FORMAT.format(self.next_seq))
+        self.active = Segment(path, self.next_seq)
+        self.active_file = open(path, "ab")
+        self.add_segment(self.active)
+        self.remove_acked()
+
+    def write(self, body):
+        self.active_file.write(HEADER.pack(len(body),
+                                           crc32(body) & 0xffffffff))
+        self.active_file.write(body)
+        written = HEADER.size + len(body)
+        self.active.size += written
+        self.size += written
+        self.dirty = True
+
+        if self.active.size >= self.segment_bytes:
+            self.start_segment()
+            # Evict the oldest segments to stay within the size limit
+            while self.max_bytes and self.size > self.max_bytes and \
+                    len(self.segments) > 1:
+                oldest = self.segments[0]
+                self.evicted += oldest.pending
+                if oldest in self.replay_segments:
+                    self.replay_segments.remove(oldest)
+                    self.replay_backlog -= oldest.pending
+                    self.replay_offset = 0
+                self.logger.warning("Spool full, evicting %s (%d "
+                                    "unacknowledged)", oldest.path,
+                                    oldest.pending)
+                self.remove_segment(oldest)
+                self.remove_acked()
+
+        if monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync_locked()
+
+    def append(self, pub):
+        """
+        Add a publish to the spool, setting its spool_id
+        """
+
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            pub.spool_id = seq
+            self.active.acked.append(0)
+            self.active.pending += 1
+            self.write(encode_publish(seq, pub))
+        return seq
+
+    def ack(self, seqs):
+        """
+        Mark spooled publishes as acknowledged, deleting the segments that no
+        longer hold anything unacknowledged
+        """
+
+        with self.lock:
+            acked = []
+            for seq in seqs:
+                segment = self.find_segment(seq)
+                if segment and segment.ack(seq):
+                    acked.append(seq)
+            if acked:
+                self.write(encode_ack(acked))
+                self.remove_acked()
+
+    def replay(self, count):
+        """
+        Read up to count unacknowledged publishes recovered from a previous
+        run
+        """
+
+        pubs = []
+        with self.lock:
+            while self.replay_segments and len(pubs) < count:
+                segment = self.replay_segments[0]
+                try:
+                    for offset, body in read_records(segment.path,
+                                                     self.replay_offset):
+                        self.replay_offset = offset
+                        if body[:1] != RECORD_PUBLISH:
+                            continue
+                        pub = decode_publish(body)
+                        index = pub.spool_id - segment.first_seq
+                        if not segment.acked[index]:
+                            pubs.append(pub)
+                            self.replay_backlog -= 1
+                            if len(pubs) >= count:
+                                break
+                    else:
+                        self.replay_segments.pop(0)
+                        self.replay_offset = 0
+                except (IOError, OSError) as error:
+                    self.logger.error("Failed to read spool segment %s: %s",
+                                      segment.path, str(error))
+                    self.replay_backlog -= segment.pending
+                    self.replay_segments.pop(0)
+                    self.replay_offset = 0
+            if not self.replay_segments:
+                self.replay_backlog = 0
+        return pubs
+
+    def stats(self):
+        """
+        Return the current size and counters of the spool
+        """
+
+        with self.lock:
+            return {
+                "spool_bytes":self.size,
+                "spool_segments":len(self.segments),
+                "spool_pending":sum(seg.pending for seg in self.segments),
+                "spool_evicted":self.evicted,
+                "spool_replay_backlog":self.replay_backlog
+            }
+
+    def sync(self, force=True):
+        """
+        Write everything buffered to disk. Unless forced, only does so once
+        fsync_interval has passed since the last time.
+        """
+
+        with self.lock:
+            if force or monotonic() - self.last_sync >= self.fsync_interval:
+                self.sync_locked()
+
+    def sync_locked(self):
+        if self.dirty and self.active_file:
+            self.active_file.flush()
+            os.fsync(self.active_file.fileno())
+            self.dirty = False
+        self.last_sync = monotonic()
@@ -17,9 +17,15 @@ Client application
 """
 
 import json
+from json.encoder import encode_basestring_ascii
 
 from device_cloud._core import constants
 
+try:
+    STRING_TYPES = (str, unicode)
+except NameError:
+    STRING_TYPES = (str,)
+
 
 CLOUD_ERROR_CODES = {
     constants.STATUS_SUCCESS:0,
@@ -63,11 +69,73 @@ class TR50Command(object):
     mailbox_ack = "mailbox.ack"
     mailbox_check = "mailbox.check"
     mailbox_update = "mailbox.update"
+    property_batch = "property.batch"
     property_publish = "property.publish"
     property_current = "property.current"
     thing_find = "thing.find"
 
 
+# Command and (param name, attribute) pairs used to encode each type of publish,
+# in the same order as the matching create_*_publish function
+PUBLISH_TEMPLATES = {
+    "PublishAlarm":(TR50Command.alarm_publish,
+                    (("key", "name"), ("state", "state"), ("msg", "message"),
+                     ("ts", "timestamp"))),
+    "PublishAttribute":(TR50Command.attribute_publish,
+                        (("key", "name"), ("value", "value"),
+                         ("ts", "timestamp"))),
+    "PublishLocation":(TR50Command.location_publish,
+                       (("lat", "latitude"), ("lng", "longitude"),
+                        ("heading", "heading"), ("altitude", "altitude"),
+                        ("speed", "speed"), ("fixAcc", "accuracy"),
+                        ("fixType", "fix_type"), ("ts", "timestamp"))),
+    "PublishLog":(TR50Command.log_publish,
+                  (("msg", "message"), ("ts", "timestamp"))),
+    "PublishTelemetry":(TR50Command.property_publish,
+                        (("key", "name"), ("value", "value"),
+                         ("ts", "timestamp"), ("aggregate", "aggregate")))
+}
+
+# Encoded start of a publish command for each (thing key, publish type), and
+# the encoded prefix of each param
+_publish_prefixes = {}
+_param_prefixes = dict(
+    (pub_type, tuple((",{}:".format(encode_basestring_ascii(param)), attr)
+                     for param, attr in fields))
+    for pub_type, (_, fields) in PUBLISH_TEMPLATES.items())
+
+
+def _encode_value(value):
+    """
+    Encode a single value exactly as json.dumps would, taking shortcuts for the
+    common types
+    """
+
+    value_type = type(value)
+    if value_type in STRING_TYPES:
+        return encode_basestring_ascii(value)
+    elif value_type is int:
+        return int.__repr__(value)
+    elif value_type is float and value - value == 0.0:
+        # Finite floats only. NaN and infinity are left to json.
+        return float.__repr__(value)
+    # Compact, as encode_command encodes everything else
+    return json.dumps(value, separators=(",", ":"))
+
+def _publish_prefix(thing_key, pub_type):
+    """
+    Return the encoded start of a publish command, up to and including the
+    thing key
+    """
+
+    prefix = _publish_prefixes.get((thing_key, pub_type))
+    if prefix is None:
+        prefix = "{{\"command\":{},\"params\":{{\"thingKey\":{}".format(
+            encode_basestring_ascii(PUBLISH_TEMPLATES[pub_type][0]),
+            _encode_value(thing_key))
+        _publish_prefixes[(thing_key, pub_type)] = prefix
+    return prefix
+
 def _generate_params(kwargs):
     """
     Generate JSON based on the arguments passed to this function
@@ -284,6 +352,22 @@ def create_mailbox_update(mail_id, message):
     cmd["params"] = _generate_params(kwargs)
     return cmd
 
+def create_property_batch(thing_key, key, data):
+    """
+    Generate a TR50 JSON request for publishing many values of one property
+    to the Cloud. data is a list of (value, timestamp) tuples.
+    """
+
+    kwargs = {
+        "thingKey":thing_key,
+        "key":key,
+        "data":[_generate_params({"value":value, "ts":timestamp})
+                for value, timestamp in data]
+    }
+    cmd = {"command":TR50Command.property_batch}
+    cmd["params"] = _generate_params(kwargs)
+    return cmd
+
 def create_property_publish(thing_key, key, value, timestamp=None, corr_id=None,
                             aggregate=None):
     """
@@ -326,6 +410,115 @@ def create_thing_find(key):
     cmd["params"] = _generate_params(kwargs)
     return cmd
 
+def encode_command(command):
+    """
+    Encode a single command the same way generate_request does
+    """
+
+    return json.dumps(command, separators=(",", ":"))
+
+def encode_property_batch(thing_key, key, data):
+    """
+    Encode a property batch command for (value, timestamp) tuples of one key.
+    The result is identical to encoding the command from
+    create_property_batch.
+    """
+
+    if thing_key is None or key is None:
+        return encode_command(create_property_batch(thing_key, key, data))
+
+    parts = ["{{\"command\":\"{}\",\"params\":{{\"thingKey\":{},"
+             "\"key\":{},\"data\":[".format(TR50Command.property_batch,
+                                            _encode_value(thing_key),
+                                            _encode_value(key))]
+    for num, (value, timestamp) in enumerate(data):
+        entry = []
+        if value is not None:
+            entry.append("\"value\":" + _encode_value(value))
+        if timestamp is not None:
+            entry.append("\"ts\":" + _encode_value(timestamp))
+        if num:
+            parts.append(",")
+        parts.append("{" + ",".join(entry) + "}")
+    parts.append("]}}")
+    return "".join(parts)
+
+def encode_publish(thing_key, pub):
+    """
+    Encode a publish straight to a TR50 JSON command. The result is identical
+    to encoding the command from the matching create_*_publish function.
+    """
+
+    if thing_key is None:
+        # thingKey would be left out, so the cached prefixes do not apply
+        return encode_command(_create_publish(thing_key, pub))
+
+    parts = [_publish_prefix(thing_key, pub.type)]
+    for param_prefix, attr in _param_prefixes[pub.type]:
+        value = getattr(pub, attr)
+        if value is not None:
+            parts.append(param_prefix)
+            parts.append(_encode_value(value))
+    parts.append("}}")
+    return "".join(parts)
+
+def encode_telemetry_batch(thing_key, samples):
+    """
+    Encode a property publish command for each (name, value, timestamp)
+    sample in one pass. The result is identical to encoding the commands from
+    create_property_publish.
+    """
+
+    if thing_key is None:
+        return [encode_command(create_property_publish(thing_key, name, value,
+                                                       timestamp=timestamp))
+                for name, value, timestamp in samples]
+
+    prefix = _publish_prefix(thing_key, "PublishTelemetry")
+    encoded = []
+    for name, value, timestamp in samples:
+        parts = [prefix]
+        if name is not None:
+            parts.append(",\"key\":")
+            parts.append(_encode_value(name))
+        if value is not None:
+            parts.append(",\"value\":")
+            parts.append(_encode_value(value))
+        if timestamp is not None:
+            parts.append(",\"ts\":")
+            parts.append(_encode_value(timestamp))
+        parts.append("}}")
+        encoded.append("".join(parts))
+    return encoded
+
+def _create_publish(thing_key, pub):
+    """
+    Generate a TR50 JSON request for a publish through the create_*_publish
+    functions
+    """
+
+    if pub.type == "PublishAlarm":
+        return create_alarm_publish(thing_key, pub.name, pub.state,
+                                    message=pub.message,
+                                    timestamp=pub.timestamp)
+    elif pub.type == "PublishAttribute":
+        return create_attribute_publish(thing_key, pub.name, pub.value,
+                                        timestamp=pub.timestamp)
+    elif pub.type == "PublishLocation":
+        return create_location_publish(thing_key, pub.latitude,
+                                       pub.longitude, heading=pub.heading,
+                                       altitude=pub.altitude,
+                                       speed=pub.speed,
+                                       fix_accuracy=pub.accuracy,
+                                       fix_type=pub.fix_type,
+                                       timestamp=pub.timestamp)
+    elif pub.type == "PublishLog":
+        return create_log_publish(thing_key, pub.message,
+                                  timestamp=pub.timestamp)
+    return create_property_publish(thing_key, pub.name, pub.value,
+                                   timestamp=pub.timestamp,
+                                   aggregate=pub.aggregate)
+
 def generate_request(commands):
     """
     Generate a final TR50 request string out of multiple commands
@@ -344,6 +537,49 @@ def generate_request(commands):
 
     return json.dumps(request, separators=(",", ":"))
 
+def generate_request_encoded(encoded_commands):
+    """
+    Generate a final TR50 request string out of already encoded commands
+    """
+
+    return "{{{}}}".format(",".join(
+        "\"{}\":{}".format(num + 1, val)
+        for num, val in enumerate(encoded_commands)))
+
+def command_size(command):
+    """
+    Return the number of bytes a command takes up in a request
+    """
+
+    return len(encode_command(command))
+
+def split_request(command_sizes, max_commands=0, max_bytes=0):
+    """
+    Split commands into consecutive (start, end) ranges so that each request
+    generated from a range stays within max_commands and max_bytes. A single
+    command larger than max_bytes is given a range of its own.
+    """
+
+    ranges = []
+    start = 0
+    size = 2
+    for num, cmd_size in enumerate(command_sizes):
+        count = num - start
+        # "N": prefix, plus a comma if this is not the first command
+        entry_size = cmd_size + len(str(count + 1)) + 3
+        if count > 0:
+            entry_size += 1
+        if count > 0 and ((max_commands and count >= max_commands) or
+                          (max_bytes and size + entry_size > max_bytes)):
+            ranges.append((start, num))
+            start = num
+            size = 2
+            entry_size = cmd_size + 4
+        size += entry_size
+    if start < len(command_sizes):
+        ranges.append((start, len(command_sizes)))
+    return ranges
+
 def translate_error_code(error_code):
     """
     Return the related Cloud error code for a given device error code
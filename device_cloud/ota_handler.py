@@ -71,8 +71,8 @@ class OTAHandler(object):
         Callback to be registered as an action in the client. This will lock the
         updater until the current update is complete, or return an error if
         there is already an update in progress. If all is OK, then a new thread
-        will be started to handle the update and a success status is returned to
-        the cloud.
+        will be started to handle the update, which completes the deferred
+        request once done.
         """
         self._runtime_dir = user_data[0]
 
@@ -81,10 +81,13 @@ class OTAHandler(object):
             # Create an empty lockfile
             open(os.path.join(self._runtime_dir, OTA_LOCKFILE), 'a').close()
 
-            # Run the updating in the background to block the main thread
+            # Run the updating in the background, so the request is completed
+            # later without holding up a worker thread. Updates may take a
+            # long time, so there is no time limit.
+            completion = request.defer(timeout=0)
             self._update_thread = threading.Thread(target=self._update_software,
                                                    args=(client, params,
-                                                         request))
+                                                         request, completion))
             self._update_thread.start()
             result = (iot.STATUS_INVOKED, "Software Update Started (Invoked)")
         else:
@@ -94,7 +97,7 @@ class OTAHandler(object):
         return result
 
     ## Private Methods ##
-    def _update_software(self, client, params, request):
+    def _update_software(self, client, params, request, completion):
         """
         Main method that will run in a new thread and perform all the software
         updates
@@ -245,8 +248,7 @@ class OTAHandler(object):
             client.alarm_publish(ALARM_NAME, ALARM_FAILED)
             status_string = iot.status_string(status)
 
-        client.action_acknowledge(request.request_id,
-                                  status, status_string)
+        completion.resolve(status, status_string)
 
         # Cleanup
         if os.path.isdir(package_dir):
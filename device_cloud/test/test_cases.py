@@ -13,6 +13,7 @@
     OR CONDITIONS OF ANY KIND, either express or implied.
 '''
 
+import array
 import json
 import os
 import unittest
@@ -20,9 +21,12 @@ from binascii import crc32
 import mock
 import platform
 import re
+import shutil
 import socket
 import ssl
 import sys
+import tempfile
+import threading
 
 # yocto supports websockets, not websocket, so check for that
 try:
@@ -30,6 +34,8 @@ try:
 except ImportError:
     import websockets as websocket
 
+from datetime import datetime
+from datetime import timedelta
 from time import sleep
 
 import device_cloud
@@ -343,6 +349,110 @@ class ClientConnectFailure(unittest.TestCase):
 
 
 
+@unittest.skipIf(sys.version_info < (3, 5), "AsyncClient needs Python 3.5")
+class ClientAsync(unittest.TestCase):
+    @mock.patch("ssl.SSLContext")
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.isfile")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    @mock.patch("socket.gethostbyname")
+    def runTest(self, mock_gethostbyname, mock_mqtt, mock_exists, mock_isfile,
+                mock_open, mock_context):
+        import asyncio
+
+        # Set up mocks. The MQTT socket is one end of a socket pair, so the
+        # event loop sees it become readable.
+        mock_exists.side_effect = [True, True, True]
+        mock_isfile.side_effect = [True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mqtt = helpers.init_mock_mqtt()
+        mock_mqtt.return_value = mqtt
+        mock_gethostbyname.return_value = ["1.1.1.1"]
+        self.sockets = socket.socketpair()
+        mqtt.socket.return_value = self.sockets[0]
+        mqtt.want_write.return_value = False
+        mqtt._sockpairR = None
+        mqtt.publish.return_value = (0, 1)
+
+        def mqtt_loop_read(max_packets=1):
+            self.sockets[0].recv(16)
+            if mqtt.on_connect_exec:
+                mqtt.on_connect_exec = False
+                mqtt.on_connect(mqtt, None, None, mqtt.on_connect_rc)
+            return 0
+        mqtt.loop_read.side_effect = mqtt_loop_read
+
+        # Initialize client, sending publishes straight away
+        kwargs = {"loop_time":1, "thread_count":0, "publish_linger_ms":0}
+        self.client = device_cloud.AsyncClient("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+
+        # Connect is accepted once the event loop reads the socket
+        self.sockets[1].send(b"c")
+        loop = self.loop
+        assert loop.run_until_complete(self.client.connect(timeout=5)) == device_cloud.STATUS_SUCCESS
+        assert self.client.is_connected() is True
+        assert mqtt.loop.call_count == 0
+        assert handler.main_thread is None
+
+        # Publish awaits the reply from the Cloud
+        task = loop.create_task(self.client.telemetry_publish(
+            "temp", 1, cloud_response=True))
+        loop.run_until_complete(asyncio.sleep(0))
+        assert not task.done()
+        handler.work_queue.get_nowait()
+        handler.handle_publish()
+        handler.handle_message(device_cloud._core.defs.Message(
+            "reply/0001", {"1":{"success":True}}))
+        assert loop.run_until_complete(task) == device_cloud.STATUS_SUCCESS
+        assert handler.publish_waiters == {}
+
+        # A rejected download resolves from its reply
+        task = loop.create_task(self.client.file_download(
+            "file.txt", tempfile.gettempdir(), blocking=True, timeout=5))
+        loop.run_until_complete(asyncio.sleep(0))
+        handler.handle_message(device_cloud._core.defs.Message(
+            "reply/0002", {"1":{"success":False, "errorCodes":[-90008]}}))
+        assert loop.run_until_complete(task) == device_cloud.STATUS_NOT_FOUND
+
+        # Waiting for room in a full queue does not block the event loop
+        publish_queue = handler.publish_queue
+        publish_queue.maxsize = 1
+        publish_queue.put(device_cloud._core.defs.PublishAttribute("a", "1"))
+        task = loop.create_task(self.client.attribute_publish("b", "2"))
+        loop.run_until_complete(asyncio.sleep(0.2))
+        assert not task.done()
+        assert publish_queue.get().name == "a"
+        assert loop.run_until_complete(task) == device_cloud.STATUS_SUCCESS
+        assert publish_queue.get().name == "b"
+        while not handler.work_queue.empty():
+            handler.work_queue.get_nowait()
+
+        assert loop.run_until_complete(self.client.disconnect()) == device_cloud.STATUS_SUCCESS
+        mqtt.disconnect.assert_called_once()
+        assert self.client.is_connected() is False
+
+    def setUp(self):
+        import asyncio
+
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        import asyncio
+
+        self.client.handler.to_quit = True
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        for sock in self.sockets:
+            sock.close()
+
 class ClientConnectSuccess(unittest.TestCase):
     @mock.patch("ssl.SSLContext")
     @mock.patch(builtin + ".open")
@@ -387,6 +497,295 @@ class ClientConnectSuccess(unittest.TestCase):
         if self.client.handler.main_thread:
             self.client.handler.main_thread.join()
 
+class ClientDisconnectWakesThreads(unittest.TestCase):
+    @mock.patch("ssl.SSLContext")
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.isfile")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    @mock.patch("socket.gethostbyname")
+    def runTest(self,  mock_gethostbyname, mock_mqtt, mock_exists, mock_isfile,
+                mock_open, mock_context):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        mock_isfile.side_effect = [True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+        mock_gethostbyname.return_value = ["1.1.1.1"]
+
+        # Initialize client with a loop time far longer than the test
+        kwargs = {"loop_time":60, "thread_count":2}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        assert self.client.connect(timeout=5) == device_cloud.STATUS_SUCCESS
+        threads = handler.worker_threads + [handler.main_thread,
+                                            handler.linger_thread]
+
+        # Idle threads do not poll, they are woken by disconnecting
+        mqtt = handler.mqtt
+        sleep(0.5)
+        assert mqtt.loop_read.call_count == 1
+        start = datetime.utcnow()
+        assert self.client.disconnect() == device_cloud.STATUS_SUCCESS
+        assert datetime.utcnow() - start < timedelta(seconds=5)
+        for thread in threads:
+            assert not thread.is_alive()
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+    def tearDown(self):
+        # Ensure threads have stopped
+        self.client.handler.to_quit = True
+        if self.client.handler.main_thread:
+            self.client.handler.main_thread.join()
+
+class ClientConnectAsync(unittest.TestCase):
+    @mock.patch("ssl.SSLContext")
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.isfile")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    @mock.patch("socket.gethostbyname")
+    def runTest(self,  mock_gethostbyname, mock_mqtt, mock_exists, mock_isfile,
+                mock_open, mock_context):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        mock_isfile.side_effect = [True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+        mock_gethostbyname.return_value = ["1.1.1.1"]
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+
+        # Connecting finishes in the background
+        statuses = []
+        completion = self.client.connect_async(timeout=5)
+        assert completion.wait(5) == device_cloud.STATUS_SUCCESS
+        assert completion.done() is True
+        completion.add_done_callback(statuses.append)
+        assert statuses == [device_cloud.STATUS_SUCCESS]
+        assert self.client.is_connected() is True
+        assert self.client.disconnect() == device_cloud.STATUS_SUCCESS
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+    def tearDown(self):
+        # Ensure threads have stopped
+        self.client.handler.to_quit = True
+        if self.client.handler.main_thread:
+            self.client.handler.main_thread.join()
+
+class ClientConnectNoNetwork(unittest.TestCase):
+    @mock.patch("ssl.SSLContext")
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.isfile")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    @mock.patch("socket.gethostbyname")
+    def runTest(self,  mock_gethostbyname, mock_mqtt, mock_exists, mock_isfile,
+                mock_open, mock_context):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        mock_isfile.side_effect = [True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+        mock_gethostbyname.side_effect = socket.error("no network")
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+
+        # Checking for the network gives up at the timeout
+        start = datetime.utcnow()
+        assert self.client.connect(timeout=1.5) == \
+            device_cloud.STATUS_TIMED_OUT
+        assert datetime.utcnow() - start < timedelta(seconds=5)
+        assert mock_gethostbyname.call_count == 2
+        self.client.handler.mqtt.connect.assert_not_called()
+        assert self.client.is_connected() is False
+
+        # Disconnecting stops the wait straight away
+        completion = self.client.connect_async()
+        sleep(0.2)
+        assert completion.done() is False
+        self.client.handler.to_quit = True
+        assert completion.wait(5) == device_cloud.STATUS_FAILURE
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+    def tearDown(self):
+        # Ensure threads have stopped
+        self.client.handler.to_quit = True
+        if self.client.handler.main_thread:
+            self.client.handler.main_thread.join()
+
+class ClientWorkerPools(unittest.TestCase):
+    @mock.patch("ssl.SSLContext")
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.isfile")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    @mock.patch("socket.gethostbyname")
+    def runTest(self,  mock_gethostbyname, mock_mqtt, mock_exists, mock_isfile,
+                mock_open, mock_context):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        mock_isfile.side_effect = [True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+        mock_gethostbyname.return_value = ["1.1.1.1"]
+
+        # Initialize client with one shared worker and one transfer worker
+        kwargs = {"loop_time":1, "thread_count":1,
+                  "worker_pools":{"transfer":1, "bogus":2}}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        assert handler.pool_sizes == {"message":0, "publish":0, "action":0,
+                                      "transfer":1}
+        assert self.client.connect(timeout=5) == device_cloud.STATUS_SUCCESS
+        assert len(handler.worker_threads) == 2
+
+        # Transfers that take a while do not hold up received messages
+        release = threading.Event()
+        started = threading.Event()
+        handled = threading.Event()
+        handler.handle_file_download = mock.Mock(
+            side_effect=lambda transfer: started.set() or release.wait(5))
+        handler.handle_message = mock.Mock(
+            side_effect=lambda message: handled.set())
+        work = device_cloud._core.defs.Work
+        constants = device_cloud._core.constants
+        handler.queue_work(work(constants.WORK_DOWNLOAD, None))
+        handler.queue_work(work(constants.WORK_DOWNLOAD, None))
+        handler.queue_work(work(constants.WORK_MESSAGE, None))
+        assert handled.wait(2) is True
+        assert started.wait(2) is True
+        stats = self.client.work_stats()
+        assert stats["transfer"]["threads"] == 1
+        assert stats["transfer"]["pending"] == 1
+        assert stats["message"]["threads"] == 0
+        assert stats["message"]["wait"]["count"] == 1
+
+        # Waiting and handling times are recorded once the work is done
+        release.set()
+        assert self.client.disconnect(timeout=5) == \
+            device_cloud.STATUS_SUCCESS
+        stats = self.client.work_stats()
+        assert stats["transfer"]["run"]["count"] == 2
+        assert stats["transfer"]["wait"]["count"] == 2
+        assert stats["transfer"]["wait"]["max_ms"] > 0
+        assert sum(stats["transfer"]["wait"]["buckets"].values()) == 2
+        assert stats["action"]["run"]["count"] == 0
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+    def tearDown(self):
+        # Ensure threads have stopped
+        self.client.handler.to_quit = True
+        if self.client.handler.main_thread:
+            self.client.handler.main_thread.join()
+
+class ClientDisconnectDrain(unittest.TestCase):
+    @mock.patch("ssl.SSLContext")
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.isfile")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    @mock.patch("socket.gethostbyname")
+    def runTest(self,  mock_gethostbyname, mock_mqtt, mock_exists, mock_isfile,
+                mock_open, mock_context):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        mock_isfile.return_value = True
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+        mock_gethostbyname.return_value = ["1.1.1.1"]
+
+        # Initialize client with one worker thread
+        kwargs = {"loop_time":1, "thread_count":1, "publish_linger_ms":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        assert self.client.connect(timeout=5) == device_cloud.STATUS_SUCCESS
+
+        # Queued publishes are sent before disconnecting
+        mqtt = handler.mqtt
+        self.client.telemetry_publish("property_key", 1)
+        assert self.client.disconnect(timeout=5) == device_cloud.STATUS_SUCCESS
+        assert mqtt.publish.call_count == 1
+        assert len(self.client.undelivered()) == 0
+
+        # Work that does not finish by the deadline leaves the rest queued
+        mqtt.publish.reset_mock()
+        assert self.client.connect(timeout=5) == device_cloud.STATUS_SUCCESS
+        release = threading.Event()
+        handler.handle_message = mock.Mock(
+            side_effect=lambda message: release.wait(5))
+        handler.queue_work(device_cloud._core.defs.Work(
+            device_cloud._core.constants.WORK_MESSAGE, None))
+        sleep(0.2)
+        self.client.telemetry_publish("property_key", 2)
+        self.client.telemetry_publish("property_key", 3)
+        threading.Timer(1.5, release.set).start()
+        start = datetime.utcnow()
+        assert self.client.disconnect(timeout=0.5) == \
+            device_cloud.STATUS_TIMED_OUT
+        assert datetime.utcnow() - start < timedelta(seconds=1.4)
+        undelivered = self.client.undelivered()
+        assert len(undelivered.publishes) == 2
+        assert undelivered.publishes[0].value == 2
+        assert [work.type for work in undelivered.work] == \
+            [device_cloud._core.constants.WORK_PUBLISH]
+        mqtt.publish.assert_not_called()
+
+        # Without a timeout, what is left is only reported in undelivered()
+        handler.main_thread.join()
+        handler.main_thread = None
+        assert self.client.connect(timeout=5) == device_cloud.STATUS_SUCCESS
+        self.client.telemetry_publish("property_key", 4)
+        def lost():
+            handler.is_connected = mock.Mock(return_value=False)
+            handler.state_notify()
+        threading.Timer(0.5, lost).start()
+        assert self.client.disconnect(wait_for_replies=True) == \
+            device_cloud.STATUS_SUCCESS
+        undelivered = self.client.undelivered()
+        assert undelivered.replies and not undelivered.publishes
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+    def tearDown(self):
+        # Ensure threads have stopped
+        self.client.handler.to_quit = True
+        if self.client.handler.main_thread:
+            self.client.handler.main_thread.join()
+
 class ClientDisconnectFailure(unittest.TestCase):
     @mock.patch("ssl.SSLContext")
     @mock.patch(builtin + ".open")
@@ -868,9 +1267,616 @@ class ClientTelemetryPublish(unittest.TestCase):
         assert pub.name == "property_key"
         assert pub.value == 26.6
 
-    def setUp(self):
-        # Configuration to be 'read' from config file
-        self.config_args = helpers.config_file_default()
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class ClientTelemetryAggregate(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with an aggregated key
+        kwargs = {"loop_time":1, "thread_count":0,
+                  "telemetry_aggregate":{"accel":{"window":10,
+                                                  "functions":["min", "max",
+                                                               "avg"]}}}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        pub_queue = handler.publish_queue
+
+        # Samples inside the window are only accumulated
+        for value in [1, 5, 3]:
+            assert self.client.telemetry_publish("accel", value) == device_cloud.STATUS_SUCCESS
+        assert pub_queue.empty()
+        assert handler.publish_stats()["aggregated_samples"] == 3
+
+        # Next sample after the window ends publishes the window's results
+        handler.windows["accel"].end -= 10
+        self.client.telemetry_publish("accel", 7)
+        pubs = [pub_queue.get() for _ in range(pub_queue.qsize())]
+        assert [(pub.name, pub.value) for pub in pubs] == [("accel_min", 1),
+                                                           ("accel_max", 5),
+                                                           ("accel_avg", 3.0)]
+        assert all(pub.aggregate for pub in pubs)
+        command = device_cloud._core.tr50.encode_publish("thing", pubs[0])
+        assert command.endswith(",\"aggregate\":true}}")
+
+        # Window that ended with no new samples is flushed periodically
+        handler.windows["accel"].end -= 10
+        handler.aggregate_flush()
+        assert pub_queue.qsize() == 3
+        while not pub_queue.empty():
+            pub_queue.get()
+
+        # Samples that are not numbers are published as they are
+        assert self.client.telemetry_publish("accel", "n/a") == device_cloud.STATUS_SUCCESS
+        pub = pub_queue.get()
+        assert (pub.name, pub.value, pub.aggregate) == ("accel", "n/a", None)
+        assert handler.windows["accel"].count == 0
+
+        # Invalid functions are rejected
+        assert self.client.telemetry_aggregate_set("accel", 10, ["median"]) == device_cloud.STATUS_BAD_PARAMETER
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class ClientPublishRateLimit(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("device_cloud._core.handler.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with a per key limit from the configuration
+        kwargs = {"loop_time":1, "thread_count":0,
+                  "publish_rate_limit":{"keys":{"temp":{"rate":0.001,
+                                                        "burst":2}}}}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        pub_queue = self.client.handler.publish_queue
+
+        # Burst is allowed, the rest is dropped, other keys are not limited
+        results = [self.client.telemetry_publish("temp", value)
+                   for value in range(4)]
+        assert results == [device_cloud.STATUS_SUCCESS] * 2 + \
+            [device_cloud.STATUS_TRY_AGAIN] * 2
+        assert self.client.attribute_publish("name", "a") == device_cloud.STATUS_SUCCESS
+        assert pub_queue.qsize() == 3
+
+        # Aggregate over limit telemetry of every other key
+        assert self.client.publish_rate_limit_set(
+            "*", 0.001, policy="aggregate", functions=["max"]) == device_cloud.STATUS_SUCCESS
+        for value in [1, 5, 3]:
+            self.client.telemetry_publish("volts", value)
+        assert pub_queue.qsize() == 4
+        self.client.handler.aggregate_flush(force=True)
+        pub = list(pub_queue.lanes[device_cloud._core.constants.PRIORITY_LOW])[-1]
+        assert (pub.name, pub.value, pub.aggregate) == ("volts", 5, True)
+
+        # Client wide limit delays every publish over it
+        self.client.publish_rate_limit_set(None, 1, policy="delay")
+        self.client.event_publish("first")
+        self.client.event_publish("second")
+        assert mock_sleep.call_count == 1
+        assert pub_queue.qsize() == 7
+
+        stats = self.client.publish_stats()
+        assert stats["rate_dropped"] == 2
+        assert stats["rate_aggregated"] == 2
+        assert stats["rate_delayed"] == 1
+        assert stats["rate_limited_keys"] == {"temp":2, "volts":2}
+
+        # Bad policies are rejected
+        assert self.client.publish_rate_limit_set("temp", 1, policy="x") == \
+            device_cloud.STATUS_BAD_PARAMETER
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class ClientTelemetryDeadband(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with a deadband from the configuration
+        kwargs = {"loop_time":1, "thread_count":0,
+                  "telemetry_deadband":{"temp":{"absolute":0.5}}}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        pub_queue = self.client.handler.publish_queue
+
+        # Small changes from the last published value are suppressed
+        for value in [20.0, 20.3, 20.5, 20.6, 20.0]:
+            assert self.client.telemetry_publish("temp", value) == device_cloud.STATUS_SUCCESS
+        assert [pub_queue.get().value for _ in range(pub_queue.qsize())] == [20.0, 20.6, 20.0]
+
+        # Samples that are shed, straight away or later, are not compared
+        # with what follows
+        defs = device_cloud._core.defs
+        pub_queue.maxsize = 1
+        pub_queue.policy = device_cloud.PUBLISH_POLICY_DROP_NEWEST
+        pub_queue.put(defs.PublishAttribute("a", "1"))
+        assert self.client.telemetry_publish("temp", 25.0) == device_cloud.STATUS_FULL
+        pub_queue.get()
+        pub_queue.policy = device_cloud.PUBLISH_POLICY_DROP_OLDEST
+        assert self.client.telemetry_publish("temp", 21.0) == device_cloud.STATUS_SUCCESS
+        pub_queue.put(defs.PublishTelemetry("other", 1))
+        for value in [20.3, 20.6]:
+            self.client.telemetry_publish("temp", value)
+        assert [pub_queue.get().value for _ in range(pub_queue.qsize())] == [20.6]
+        pub_queue.maxsize = 0
+
+        # Percentage deadband for every other key, with a heartbeat
+        self.client.telemetry_deadband_set("*", percent=10, max_silence=60)
+        self.client.telemetry_publish("volts", 12.0)
+        self.client.telemetry_publish("volts", 12.5)
+        self.client.telemetry_publish("volts", 13.5)
+        deadband = self.client.handler.default_deadbands["volts"]
+        deadband.last_time -= 60
+        self.client.telemetry_publish("volts", 13.5)
+        assert [pub_queue.get().value for _ in range(pub_queue.qsize())] == [12.0, 13.5, 13.5]
+        assert self.client.publish_stats()["deadband_suppressed"] == 4
+
+        # Removing the deadband keeps the count
+        self.client.telemetry_deadband_set("temp")
+        self.client.telemetry_publish("temp", 20.0)
+        assert pub_queue.qsize() == 1
+        assert self.client.publish_stats()["deadband_suppressed"] == 4
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class ClientTelemetryPublishMany(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        tr50 = device_cloud._core.tr50
+
+        # Tuples are queued as one unit, counting for each sample
+        timestamp = datetime(2018, 1, 2, 3, 4, 5)
+        samples = [("a", 1), ("b", 2.5, timestamp), ("c", 3, "2018-01-01T00:00:00Z")]
+        assert self.client.telemetry_publish_many(samples) == device_cloud.STATUS_SUCCESS
+        assert len(handler.publish_queue.items()) == 1
+        assert handler.publish_queue.qsize() == 3
+        batch = handler.publish_queue.get()
+        assert batch.samples[1][2] == timestamp.strftime(device_cloud._core.constants.TIME_FORMAT)
+
+        # One command per sample, identical to publishing them one at a time
+        messages = handler.publish_messages([batch])
+        assert len(messages) == 3
+        for (name, value, ts), message in zip(batch.samples, messages):
+            assert message.encoded == tr50.encode_command(
+                tr50.create_property_publish(handler.config.key, name, value,
+                                             timestamp=ts))
+        assert all(message.publishes == [batch] for message in messages)
+        assert handler.publish_parts == {batch:[3, device_cloud.STATUS_SUCCESS]}
+
+        # Parallel sequences, with one name for every value
+        values = array.array("d", [1.0, 2.0, 3.0])
+        assert self.client.telemetry_publish_many("d", values) == device_cloud.STATUS_SUCCESS
+        batch = handler.publish_queue.get()
+        assert [sample[:2] for sample in batch.samples] == [("d", 1.0), ("d", 2.0), ("d", 3.0)]
+        assert self.client.telemetry_publish_many(["x", "y"], [1]) == device_cloud.STATUS_BAD_PARAMETER
+        assert handler.publish_queue.empty()
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class ClientTelemetryPublishQueueFull(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with a small publish queue
+        kwargs = {"loop_time":1, "thread_count":0, "publish_queue_size":2,
+                  "publish_queue_policy":"drop_newest"}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+
+        # Third publish is shed
+        assert self.client.telemetry_publish("property_key", 1) == device_cloud.STATUS_SUCCESS
+        assert self.client.telemetry_publish("property_key", 2) == device_cloud.STATUS_SUCCESS
+        assert self.client.telemetry_publish("property_key", 3) == device_cloud.STATUS_FULL
+        stats = self.client.publish_stats()
+        assert stats["queue_depth"] == 2
+        assert stats["queue_capacity"] == 2
+        assert stats["dropped_newest"] == 1
+        assert stats["dropped_oldest"] == 0
+        assert self.client.handler.publish_queue.get().value == 1
+        assert self.client.handler.publish_queue.get().value == 2
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class PublishTimestamp(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+        time_format = device_cloud._core.constants.TIME_FORMAT
+
+        # Formatting matches strftime, including across seconds
+        for timestamp_ns in [0, 1516000000123456789, 1516000000999999999,
+                             1516000001000000000, 1516000001000001000]:
+            expected = (defs.EPOCH + timedelta(
+                microseconds=timestamp_ns // 1000)).strftime(time_format)
+            assert defs.format_time_ns(timestamp_ns) == expected
+
+        # Publishes have no __dict__ and format their timestamp on demand
+        pub = defs.PublishTelemetry("a", 1)
+        assert not hasattr(pub, "__dict__")
+        assert pub._timestamp is None
+        assert pub.timestamp == defs.format_time_ns(pub.time_ns)
+
+        # Explicit timestamps are kept as given
+        pub = defs.PublishTelemetry("a", 1, "2018-01-01T00:00:00.000000Z")
+        assert pub.time_ns is None
+        assert pub.timestamp == "2018-01-01T00:00:00.000000Z"
+
+class PublishQueueCoalesce(unittest.TestCase):
+    def runTest(self):
+        pub_queue = device_cloud._core.defs.PublishQueue(
+            2, device_cloud.PUBLISH_POLICY_COALESCE)
+        first = device_cloud._core.defs.PublishTelemetry("a", 1)
+        second = device_cloud._core.defs.PublishTelemetry("b", 2)
+        assert pub_queue.put(first) == device_cloud.STATUS_SUCCESS
+        assert pub_queue.put(second) == device_cloud.STATUS_SUCCESS
+
+        # Same key replaces the pending value in place
+        third = device_cloud._core.defs.PublishTelemetry("a", 3)
+        assert pub_queue.put(third) == device_cloud.STATUS_SUCCESS
+        assert pub_queue.qsize() == 2
+        assert pub_queue.stats()["coalesced"] == 1
+
+        # No pending key falls back to dropping the oldest, and the alarm is
+        # taken before telemetry
+        alarm = device_cloud._core.defs.PublishAlarm("alarm", 1)
+        assert pub_queue.put(alarm) == device_cloud.STATUS_SUCCESS
+        assert pub_queue.stats()["dropped_oldest"] == 1
+        assert pub_queue.get() is alarm
+        assert pub_queue.get() is second
+
+class PublishQueueLanes(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+        constants = device_cloud._core.constants
+
+        # Strict priority: alarms, then attributes, then telemetry
+        pub_queue = defs.PublishQueue(3, device_cloud.PUBLISH_POLICY_DROP_OLDEST)
+        telemetry = defs.PublishTelemetry("a", 1)
+        attribute = defs.PublishAttribute("b", "2")
+        alarm = defs.PublishAlarm("alarm", 1)
+        for pub in [telemetry, attribute, alarm]:
+            pub_queue.put(pub)
+        assert pub_queue.stats()["queue_lanes"] == {"high":1, "normal":1,
+                                                    "low":1}
+
+        # Full queue sheds from the lowest priority lane first
+        assert pub_queue.put(defs.PublishAlarm("alarm", 2)) == \
+            device_cloud.STATUS_SUCCESS
+        assert pub_queue.stats()["dropped_oldest"] == 1
+        assert pub_queue.stats()["queue_lanes"] == {"high":2, "normal":1,
+                                                    "low":0}
+        assert [pub_queue.get().type for _ in range(3)] == \
+            ["PublishAlarm", "PublishAlarm", "PublishAttribute"]
+
+        # Telemetry never takes the place of an alarm, it is shed instead
+        pub_queue = defs.PublishQueue(2, device_cloud.PUBLISH_POLICY_DROP_OLDEST)
+        pub_queue.put(defs.PublishAlarm("alarm", 1))
+        pub_queue.put(defs.PublishTelemetry("a", 1))
+        assert pub_queue.put(defs.PublishTelemetry("a", 2)) == \
+            device_cloud.STATUS_SUCCESS
+        assert pub_queue.put(defs.PublishAttribute("b", "1")) == \
+            device_cloud.STATUS_SUCCESS
+        assert pub_queue.put(defs.PublishTelemetry("a", 3)) == \
+            device_cloud.STATUS_FULL
+        assert pub_queue.stats()["dropped_oldest"] == 2
+        assert pub_queue.stats()["dropped_newest"] == 1
+        assert [pub_queue.get().type for _ in range(2)] == \
+            ["PublishAlarm", "PublishAttribute"]
+
+        # Weighted round robin does not starve the low lane
+        pub_queue = defs.PublishQueue(weights=[2, 1, 1])
+        for num in range(3):
+            pub_queue.put(defs.PublishTelemetry("a", num))
+            pub_queue.put(defs.PublishAlarm("alarm", num))
+        assert [pub_queue.get().type for _ in range(6)] == \
+            ["PublishAlarm", "PublishAlarm", "PublishTelemetry",
+             "PublishAlarm", "PublishTelemetry", "PublishTelemetry"]
+
+        # Replies are handled before actions and file transfers
+        work_queue = defs.WorkQueue()
+        for work_type in [constants.WORK_UPLOAD, constants.WORK_ACTION,
+                          constants.WORK_MESSAGE]:
+            work_queue.put(defs.Work(work_type, None))
+        assert [work_queue.get().type for _ in range(3)] == \
+            [constants.WORK_MESSAGE, constants.WORK_ACTION,
+             constants.WORK_UPLOAD]
+
+class PublishQueueDropOldest(unittest.TestCase):
+    def runTest(self):
+        pub_queue = device_cloud._core.defs.PublishQueue(
+            1, device_cloud.PUBLISH_POLICY_DROP_OLDEST)
+        first = device_cloud._core.defs.PublishTelemetry("a", 1)
+        second = device_cloud._core.defs.PublishTelemetry("a", 2)
+        assert pub_queue.put(first) == device_cloud.STATUS_SUCCESS
+        assert pub_queue.put(second) == device_cloud.STATUS_SUCCESS
+        assert pub_queue.get() is second
+        assert pub_queue.stats()["dropped_oldest"] == 1
+
+        # Blocking queue gives up after its timeout
+        pub_queue = device_cloud._core.defs.PublishQueue(
+            1, device_cloud.PUBLISH_POLICY_BLOCK, block_timeout=0.01)
+        assert pub_queue.put(first) == device_cloud.STATUS_SUCCESS
+        assert pub_queue.put(second) == device_cloud.STATUS_FULL
+        assert pub_queue.stats()["dropped_newest"] == 1
+
+class PublishQueueBatchSamples(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+
+        # A batch takes up a place for each of its samples
+        pub_queue = defs.PublishQueue(3, device_cloud.PUBLISH_POLICY_DROP_NEWEST)
+        batch = defs.PublishTelemetryBatch([("a", 1, None), ("a", 2, None)])
+        assert pub_queue.put(batch) == device_cloud.STATUS_SUCCESS
+        assert pub_queue.qsize() == 2
+        assert not pub_queue.fits(defs.PublishTelemetryBatch(
+            [("b", 1, None), ("b", 2, None)]))
+        assert pub_queue.put(defs.PublishTelemetryBatch(
+            [("b", 1, None), ("b", 2, None)])) == device_cloud.STATUS_FULL
+        assert pub_queue.put(defs.PublishTelemetry("c", 1)) == \
+            device_cloud.STATUS_SUCCESS
+        assert pub_queue.full()
+        assert pub_queue.get() is batch
+        assert pub_queue.qsize() == 1
+
+        # Enough older publishes are dropped to make room for a batch, and a
+        # batch larger than the queue still goes in on its own
+        pub_queue = defs.PublishQueue(3, device_cloud.PUBLISH_POLICY_DROP_OLDEST)
+        for num in range(3):
+            pub_queue.put(defs.PublishTelemetry("a", num))
+        big = defs.PublishTelemetryBatch([("b", num, None) for num in range(5)])
+        pub_queue.put(big)
+        assert pub_queue.stats()["dropped_oldest"] == 3
+        assert pub_queue.qsize() == 5
+        assert pub_queue.get() is big
+        assert pub_queue.empty()
+
+class SpoolEvictOldest(unittest.TestCase):
+    def runTest(self):
+        spool = device_cloud._core.spool.Spool(self.spool_dir, 200, 400, 0,
+                                               mock.Mock())
+        spool.open()
+        for num in range(40):
+            pub = device_cloud._core.defs.PublishTelemetry("a", num)
+            spool.append(pub)
+        stats = spool.stats()
+        assert stats["spool_bytes"] <= 400 + 200
+        assert stats["spool_evicted"] > 0
+        assert stats["spool_pending"] + stats["spool_evicted"] == 40
+
+        # Acknowledging everything left removes all but the active segment
+        spool.ack(range(1, 41))
+        assert spool.stats()["spool_pending"] == 0
+        assert spool.stats()["spool_segments"] == 1
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+class SpoolRecover(unittest.TestCase):
+    def runTest(self):
+        spool = device_cloud._core.spool.Spool(self.spool_dir, 1048576, 0, 1,
+                                               mock.Mock())
+        spool.open()
+        pubs = [device_cloud._core.defs.PublishTelemetry("a", 1),
+                device_cloud._core.defs.PublishAttribute("b", "two"),
+                device_cloud._core.defs.PublishAlarm("c", 3, "three")]
+        for pub in pubs:
+            spool.append(pub)
+        spool.ack([pubs[0].spool_id])
+        spool.sync()
+
+        # Torn write at the end is ignored
+        with open(spool.active.path, "ab") as seg_file:
+            seg_file.write(b"\x10\x00")
+        spool.active_file.close()
+
+        # Unacknowledged publishes are replayed by a new spool
+        spool = device_cloud._core.spool.Spool(self.spool_dir, 1048576, 0, 1,
+                                               mock.Mock())
+        spool.open()
+        assert spool.replay_backlog == 2
+        replayed = spool.replay(10)
+        assert [pub.type for pub in replayed] == ["PublishAttribute",
+                                                  "PublishAlarm"]
+        assert replayed[0].value == "two"
+        assert replayed[1].message == "three"
+        assert replayed[1].timestamp == pubs[2].timestamp
+        assert spool.replay_backlog == 0
+
+        # New publishes continue the sequence
+        pub = device_cloud._core.defs.PublishTelemetry("a", 4)
+        assert spool.append(pub) == 4
+
+        # Acknowledged segments are removed
+        spool.ack([item.spool_id for item in replayed])
+        assert spool.stats()["spool_segments"] == 1
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+class SpoolRestartKeepsAcks(unittest.TestCase):
+    def runTest(self):
+        Spool = device_cloud._core.spool.Spool
+        spool = Spool(self.spool_dir, 100, 0, 0, mock.Mock())
+        spool.open()
+        pubs = [device_cloud._core.defs.PublishTelemetry("a", num)
+                for num in range(3)]
+        spool.append(pubs[0])
+        spool.append(pubs[1])
+        assert spool.stats()["spool_segments"] == 2
+
+        # The second segment holds the ack for the first publish. Once
+        # everything in it is acknowledged it is kept, as the first segment
+        # still holds an unacknowledged publish.
+        spool.append(pubs[2])
+        spool.ack([pubs[0].spool_id])
+        spool.ack([pubs[2].spool_id])
+        assert spool.stats()["spool_segments"] == 3
+        assert spool.stats()["spool_pending"] == 1
+        spool.sync()
+        spool.active_file.close()
+
+        # Only the publish never acknowledged is replayed after a restart
+        spool = Spool(self.spool_dir, 100, 0, 0, mock.Mock())
+        spool.open()
+        assert spool.replay_backlog == 1
+        replayed = spool.replay(10)
+        assert [pub.value for pub in replayed] == [1]
+
+        # Acknowledging it removes every segment before the active one
+        spool.ack([replayed[0].spool_id])
+        assert spool.stats()["spool_segments"] == 1
+        assert spool.stats()["spool_pending"] == 0
+        spool.active_file.close()
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+class SpoolRestartEmptySegment(unittest.TestCase):
+    def runTest(self):
+        Spool = device_cloud._core.spool.Spool
+
+        # A run that spools nothing leaves an empty segment behind
+        spool = Spool(self.spool_dir, 100, 0, 0, mock.Mock())
+        spool.open()
+        spool.sync()
+        spool.active_file.close()
+
+        # The next run starts its own segment rather than sharing that one
+        spool = Spool(self.spool_dir, 100, 0, 0, mock.Mock())
+        spool.open()
+        pub = device_cloud._core.defs.PublishTelemetry("a", 1)
+        spool.append(pub)
+        spool.sync()
+        spool.active_file.close()
+        assert os.path.exists(spool.active.path)
+
+        # So what it spooled is replayed after another restart
+        spool = Spool(self.spool_dir, 100, 0, 0, mock.Mock())
+        spool.open()
+        assert spool.replay_backlog == 1
+        assert [pub.value for pub in spool.replay(10)] == [1]
+        spool.active_file.close()
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+class TR50EncodePublish(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+        tr50 = device_cloud._core.tr50
+        pubs = [defs.PublishTelemetry("temp", 21.5),
+                defs.PublishTelemetry("count", 3),
+                defs.PublishTelemetry("bad", float("nan")),
+                defs.PublishAttribute("name", u"caf\u00e9 \"quoted\""),
+                defs.PublishAlarm("alarm", 2),
+                defs.PublishAlarm("alarm", 1, "message"),
+                defs.PublishLocation(1.5, -2.25, heading=90, fix_type="gps"),
+                defs.PublishLog("log line\n")]
+        pubs[1].timestamp = None
+
+        # Output matches the create_*_publish functions byte for byte
+        encoded = [tr50.encode_publish("thing", pub) for pub in pubs]
+        created = [tr50._create_publish("thing", pub) for pub in pubs]
+        assert (tr50.generate_request_encoded(encoded) ==
+                tr50.generate_request(created))
+        assert (tr50.encode_publish(None, pubs[0]) ==
+                tr50.encode_command(tr50._create_publish(None, pubs[0])))
+
+        # Command is decoded only when asked for
+        message = defs.OutMessage(None, "desc", encoded=encoded[0])
+        assert message.command == created[0]
+
+class TR50EncodePublishContainers(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+        tr50 = device_cloud._core.tr50
+        pubs = [defs.PublishTelemetry("list", [1, 2.5, "three", None]),
+                defs.PublishTelemetry("dict", {"a":[1, {"b":2}]}),
+                defs.PublishAttribute("list", ["x", "y"]),
+                defs.PublishTelemetryBatch([("nested", {"c":[3, 4]}, None)])]
+
+        # Lists and dicts are encoded as compactly as every other command
+        for pub in pubs[:3]:
+            assert (tr50.encode_publish("thing", pub) ==
+                    tr50.encode_command(tr50._create_publish("thing", pub)))
+        samples = pubs[3].samples
+        assert (tr50.encode_telemetry_batch("thing", samples) ==
+                [tr50.encode_command(tr50.create_property_publish(
+                    "thing", name, value, timestamp=timestamp))
+                 for name, value, timestamp in samples])
+        assert ", " not in tr50.encode_publish("thing", pubs[1])
 
 class ConfigMissingHost(unittest.TestCase):
     @mock.patch(builtin + ".open")
@@ -1077,10 +2083,9 @@ class HandleActionExecCallbackSuccess(unittest.TestCase):
     @mock.patch("os.path.isfile")
     @mock.patch("os.path.exists")
     @mock.patch("time.sleep")
-    @mock.patch("device_cloud._core.defs.inspect")
     @mock.patch("paho.mqtt.client.Client")
     @mock.patch("socket.gethostbyname")
-    def runTest(self, mock_gethostbyname, mock_mqtt, mock_inspect, mock_sleep, mock_exists,
+    def runTest(self, mock_gethostbyname, mock_mqtt, mock_sleep, mock_exists,
                 mock_isfile, mock_open, mock_context):
         # Set up mocks
         mock_exists.side_effect = [True, True, True]
@@ -1088,8 +2093,6 @@ class HandleActionExecCallbackSuccess(unittest.TestCase):
         read_strings = [json.dumps(self.config_args), helpers.uuid]
         mock_read = mock_open.return_value.__enter__.return_value.read
         mock_read.side_effect = read_strings
-        mock_inspect.getargspec.return_value.args.__len__.return_value = 3
-        mock_inspect.ismethod.return_value = False
         mock_mqtt.return_value = helpers.init_mock_mqtt()
         mock_gethostbyname.return_value = ["1.1.1.1"]
 
@@ -1285,6 +2288,589 @@ class HandlePublishAllTypes(unittest.TestCase):
         if self.client.handler.main_thread:
             self.client.handler.main_thread.join()
 
+class HandlePublishChunked(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with request limits
+        kwargs = {"thread_count":0, "max_commands_per_request":4,
+                  "max_payload_bytes":600}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        mqtt = self.client.handler.mqtt
+
+        # Second request fails to send, the others are still sent
+        mqtt.publish.side_effect = [(0, 1), Exception("socket error"), (0, 3),
+                                    (0, 4), (0, 5)]
+        for value in range(10):
+            self.client.telemetry_publish("property_key", value)
+        result = self.client.handler.handle_publish()
+        assert result == device_cloud.STATUS_FAILURE
+
+        payloads = [call[0][1] for call in mqtt.publish.call_args_list]
+        assert len(payloads) > 2
+        sent = 0
+        for payload in payloads:
+            jload = json.loads(payload)
+            assert len(jload) <= 4
+            assert len(payload) <= 600
+            sent += len(jload)
+        assert sent == 10
+
+        # Only commands from requests that were sent are waiting for replies
+        failed = len(json.loads(payloads[1]))
+        assert len(self.client.handler.reply_tracker) == 10 - failed
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishCoalesce(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client, coalescing only the "gauge" key
+        kwargs = {"thread_count":0, "publish_coalesce_keys":["gauge"]}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        self.client.handler.send = mock.Mock()
+        self.client.handler.send.return_value = device_cloud.STATUS_SUCCESS
+
+        for value in range(5):
+            self.client.telemetry_publish("gauge", value)
+            self.client.telemetry_publish("counter", value)
+        self.client.attribute_publish("gauge", "attribute")
+        self.client.handler.handle_publish()
+
+        # Only the newest "gauge" telemetry is sent, other keys are untouched
+        messages = self.client.handler.send.call_args[0][0]
+        commands = [msg.command for msg in messages]
+        gauges = [cmd["params"]["value"] for cmd in commands
+                  if cmd["params"]["key"] == "gauge"]
+        counters = [cmd["params"]["value"] for cmd in commands
+                    if cmd["params"]["key"] == "counter"]
+        assert gauges == ["attribute", 4]
+        assert counters == [0, 1, 2, 3, 4]
+        assert self.client.publish_stats()["drain_coalesced"] == 4
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishRounds(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with weighted lanes, so a round is 4 publishes
+        kwargs = {"thread_count":0, "publish_lane_weights":[2, 1, 1]}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        handler.send = mock.Mock()
+        handler.send.return_value = device_cloud.STATUS_SUCCESS
+        assert handler.publish_round_size == 4
+
+        def sent():
+            messages = handler.send.call_args[0][0]
+            return [msg.command["params"].get("key") or
+                    msg.command["params"].get("name") for msg in messages]
+
+        # A backlog of telemetry is sent a round at a time
+        for value in range(6):
+            self.client.telemetry_publish("temp", value)
+        handler.handle_publish()
+        assert sent() == ["temp"] * 4
+        assert handler.publish_queue.qsize() == 2
+        assert handler.publish_scheduled
+
+        # Alarms and attributes queued in the meantime are interleaved with
+        # the rest of the backlog
+        self.client.alarm_publish("door", 1)
+        self.client.alarm_publish("door", 0)
+        self.client.attribute_publish("mode", "auto")
+        self.client.telemetry_publish("volts", 12)
+        handler.handle_publish()
+        assert sent() == ["door", "door", "mode", "temp"]
+        handler.handle_publish()
+        assert sent() == ["temp", "volts"]
+        assert handler.publish_queue.empty()
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishCloudResponse(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        kwargs = {"thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        handler.mqtt.publish.return_value = (0, 1)
+
+        # Two threads wait for replies to their own publishes at once
+        results = {}
+        def publish(name):
+            results[name] = self.client.telemetry_publish(
+                name, 1, cloud_response=True)
+        threads = []
+        for name in ["first", "second"]:
+            thread = threading.Thread(target=publish, args=(name,))
+            thread.start()
+            threads.append(thread)
+            while handler.publish_queue.empty():
+                sleep(0.01)
+            handler.handle_publish()
+
+        # Replies arriving out of order reach the right publisher
+        handler.handle_message(device_cloud._core.defs.Message(
+            "reply/0002", {"1":{"success":False}}))
+        handler.handle_message(device_cloud._core.defs.Message(
+            "reply/0001", {"1":{"success":True}}))
+        for thread in threads:
+            thread.join(5)
+        assert results == {"first":device_cloud.STATUS_SUCCESS,
+                           "second":device_cloud.STATUS_FAILURE}
+        assert handler.publish_waiters == {}
+
+        # By default publishes wait for their reply, unless a limit is set
+        assert handler.publish_reply_timeout is None
+        handler.publish_reply_timeout = 0.1
+        assert self.client.telemetry_publish("third", 1, cloud_response=True) == \
+            device_cloud.STATUS_TIMED_OUT
+        assert handler.publish_waiters == {}
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishCloudResponseSamples(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        kwargs = {"thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        handler.mqtt.publish.return_value = (0, 1)
+
+        # Two samples sent in one request, each waited for
+        results = {}
+        def publish(name):
+            results[name] = self.client.telemetry_publish(
+                name, 1, cloud_response=True)
+        threads = []
+        for num, name in enumerate(["first", "second"]):
+            thread = threading.Thread(target=publish, args=(name,))
+            thread.start()
+            threads.append(thread)
+            while handler.publish_queue.qsize() <= num:
+                sleep(0.01)
+
+        # A batch of samples sent in as many commands, also waited for
+        batch_replies = []
+        batch = device_cloud._core.defs.PublishTelemetryBatch(
+            [("a", 1, None), ("b", 2, None)])
+        handler.queue_publish(batch, batch_replies.append)
+        handler.handle_publish()
+        request = json.loads(handler.mqtt.publish.call_args[0][1])
+        assert len(request) == 4
+
+        # Only the sample whose command failed fails
+        handler.handle_message(device_cloud._core.defs.Message(
+            "reply/0001", {"1":{"success":False}, "2":{"success":True},
+                           "3":{"success":False}}))
+        for thread in threads:
+            thread.join(5)
+        assert results == {"first":device_cloud.STATUS_FAILURE,
+                           "second":device_cloud.STATUS_SUCCESS}
+
+        # The batch waits for the replies to all of its commands
+        assert batch_replies == []
+        handler.handle_message(device_cloud._core.defs.Message(
+            "reply/0001", {"4":{"success":True}}))
+        assert batch_replies == [device_cloud.STATUS_FAILURE]
+        assert handler.publish_waiters == {}
+        assert handler.publish_parts == {}
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishSpoolAck(unittest.TestCase):
+    def runTest(self):
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        with mock.patch(builtin + ".open") as mock_open, \
+                mock.patch("os.path.exists") as mock_exists, \
+                mock.patch("paho.mqtt.client.Client") as mock_mqtt:
+            mock_exists.side_effect = [True, True, True]
+            mock_read = mock_open.return_value.__enter__.return_value.read
+            mock_read.side_effect = read_strings
+            mock_mqtt.return_value = helpers.init_mock_mqtt()
+            kwargs = {"thread_count":0}
+            self.client = device_cloud.Client("testing-client", kwargs)
+            self.client.initialize()
+        handler = self.client.handler
+        handler.mqtt.publish.return_value = (0, 1)
+        handler.spool = device_cloud._core.spool.Spool(
+            self.spool_dir, 1048576, 0, 0, handler.logger)
+        handler.spool.open()
+
+        # A batch sent in two commands stays spooled until both are replied
+        self.client.telemetry_publish_many([("a", 1), ("b", 2)])
+        self.client.telemetry_publish("c", 3)
+        handler.handle_publish()
+        assert handler.spool.stats()["spool_pending"] == 2
+        handler.handle_message(device_cloud._core.defs.Message(
+            "reply/0001", {"1":{"success":True}, "3":{"success":True}}))
+        assert handler.spool.stats()["spool_pending"] == 1
+        handler.handle_message(device_cloud._core.defs.Message(
+            "reply/0001", {"2":{"success":False}}))
+        assert handler.spool.stats()["spool_pending"] == 0
+
+        # A batch with a command that timed out stays spooled, to be replayed
+        self.client.telemetry_publish_many([("a", 1), ("b", 2)])
+        handler.handle_publish()
+        with handler.lock:
+            expired = handler.reply_tracker.pop_message("0002", "2")
+        handler.reply_expired(expired)
+        handler.handle_message(device_cloud._core.defs.Message(
+            "reply/0002", {"1":{"success":True}}))
+        assert handler.publish_parts == {}
+        assert handler.spool.stats()["spool_pending"] == 1
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.client.handler.spool.active_file.close()
+        shutil.rmtree(self.spool_dir)
+
+class HandleReadLastSamples(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        kwargs = {"thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+        mqtt.publish.return_value = (0, 1)
+
+        # Every key is read in one request, each only once
+        results = {}
+        def read():
+            results.update(self.client.read_last_samples(
+                ["temp", "volts", "temp", "rpm"], timeout=5))
+        thread = threading.Thread(target=read)
+        thread.start()
+        while not mqtt.publish.called:
+            sleep(0.01)
+        request = json.loads(mqtt.publish.call_args[0][1])
+        assert len(request) == 3
+        assert request["1"]["command"] == "property.current"
+        assert request["2"]["params"]["key"] == "volts"
+
+        # Each reply goes to its own key, whatever order they arrive in
+        handler.handle_message(device_cloud._core.defs.Message(
+            "reply/0001",
+            {"3":{"success":False, "errorCodes":[-90008]},
+             "2":{"success":False},
+             "1":{"success":True, "params":{"value":21.5, "ts":"now"}}}))
+        thread.join(5)
+        assert results == {
+            "temp":(device_cloud.STATUS_SUCCESS, 21.5, "now"),
+            "volts":(device_cloud.STATUS_FAILURE, None, None),
+            "rpm":(device_cloud.STATUS_NOT_FOUND, None, None)}
+
+        # Keys without a reply in time time out, late replies are ignored
+        status = self.client.attribute_read_last_sample("serial", 0.1)
+        assert status == (device_cloud.STATUS_TIMED_OUT, None, None)
+        request = json.loads(mqtt.publish.call_args[0][1])
+        assert request["1"]["command"] == "attribute.current"
+        handler.handle_message(device_cloud._core.defs.Message(
+            "reply/0002", {"1":{"success":True, "params":{"value":"abc"}}}))
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandleReadCache(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        kwargs = {"thread_count":0,
+                  "read_cache":{"ttl":60, "max_entries":2}}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+        mqtt.publish.return_value = (0, 1)
+
+        def read(names, before_reply=None):
+            sent = mqtt.publish.call_count
+            results = handler.read_request(names)
+            if mqtt.publish.call_count > sent:
+                request = json.loads(mqtt.publish.call_args[0][1])
+                if before_reply:
+                    before_reply()
+                reply = dict((num, {"success":True, "params":{
+                    "value":request[num]["params"]["key"]}})
+                             for num in request)
+                handler.handle_message(device_cloud._core.defs.Message(
+                    "reply/" + mqtt.publish.call_args[0][0][4:], reply))
+            return results.wait(1)
+
+        # Second read of a key is answered from the cache
+        assert read(["temp"])["temp"][1] == "temp"
+        assert read(["temp"])["temp"][1] == "temp"
+        assert mqtt.publish.call_count == 1
+        stats = self.client.read_cache_stats()
+        assert stats["read_cache_hits"] == 1
+        assert stats["read_cache_misses"] == 1
+
+        # Publishing a key invalidates it, even while a read is in flight
+        self.client.telemetry_publish("temp", 1)
+        read(["temp"], lambda: self.client.telemetry_publish("temp", 2))
+        read(["temp"])
+        assert mqtt.publish.call_count == 3
+        read(["temp"])
+        assert mqtt.publish.call_count == 3
+
+        # Least recently used keys are evicted past max_entries
+        read(["volts", "rpm"])
+        stats = self.client.read_cache_stats()
+        assert stats["read_cache_entries"] == 2
+        assert stats["read_cache_evictions"] == 1
+        read(["rpm"])
+        assert mqtt.publish.call_count == 4
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandleReplyExpiry(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        kwargs = {"thread_count":0, "reply_timeout":10,
+                  "reply_tracker_size":2}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        handler.mqtt.publish.return_value = (0, 1)
+
+        # Messages without a reply in time fail whatever waits for them
+        finished = []
+        def callback(client, file_name, status):
+            finished.append(status)
+        self.client.file_download("file.txt", "download.txt",
+                                  callback=callback)
+        results = handler.read_request(["temp"])
+        handler.reply_expire()
+        assert len(handler.reply_tracker) == 2
+        later = device_cloud._core.handler.monotonic() + 11
+        with mock.patch("device_cloud._core.handler.monotonic",
+                        return_value=later):
+            handler.reply_expire()
+        assert finished == [device_cloud.STATUS_TIMED_OUT]
+        assert results.wait(0)["temp"][0] == device_cloud.STATUS_TIMED_OUT
+        stats = self.client.publish_stats()
+        assert stats["reply_pending"] == 0
+        assert stats["reply_expired"] == 2
+        assert stats["reply_mids_pending"] == 0
+
+        # Late replies are ignored
+        handler.handle_message(device_cloud._core.defs.Message(
+            "reply/0001", {"1":{"success":True}}))
+
+        # Past reply_tracker_size the oldest message is given up on
+        first = handler.read_request(["a"])
+        handler.read_request(["b", "c"])
+        assert first.wait(0)["a"][0] == device_cloud.STATUS_TIMED_OUT
+        assert self.client.publish_stats()["reply_evicted"] == 1
+        assert sorted(handler.reply_tracker) == ["0004-1", "0004-2"]
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishPropertyBatch(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        kwargs = {"thread_count":0, "property_batch":True}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        mqtt = handler.mqtt
+        mqtt.publish.return_value = (0, 1)
+
+        # Consecutive samples of one key become a single command, sent after
+        # the alarm
+        self.client.telemetry_publish_many("temp", list(range(1000)))
+        self.client.telemetry_publish("temp", 1000)
+        self.client.alarm_publish("alarm", 1)
+        self.client.telemetry_publish("volts", 12)
+        handler.handle_publish()
+        request = json.loads(mqtt.publish.call_args[0][1])
+        assert [request[num]["command"] for num in ["1", "2", "3"]] == ["alarm.publish", "property.batch", "property.publish"]
+        assert len(request["2"]["params"]["data"]) == 1001
+        batch_size = len(mqtt.publish.call_args[0][1])
+
+        # Rejected batch is resent sample by sample, and batching stops
+        reply = {"2":{"success":False, "errorCodes":[-90005]}}
+        message = device_cloud._core.defs.Message(
+            "reply/0001", reply)
+        handler.handle_message(message)
+        assert handler.property_batch is False
+        request = json.loads(mqtt.publish.call_args[0][1])
+        assert len(request) == 1001
+        assert request["1"]["command"] == "property.publish"
+        assert batch_size * 2 < len(mqtt.publish.call_args[0][1])
+
+        # The batch of 1000 samples is replied to once all of them are
+        assert list(handler.publish_parts.values()) == \
+            [[1000, device_cloud.STATUS_SUCCESS]]
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+class HandlePublishLinger(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with a short linger and small batches
+        kwargs = {"thread_count":0, "publish_linger_ms":50,
+                  "publish_batch_size":3}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+
+        # Batch is sent as soon as it fills, and only scheduled once
+        self.client.telemetry_publish("property_key", 1)
+        self.client.telemetry_publish("property_key", 2)
+        assert handler.work_queue.empty()
+        assert handler.publish_deadline is not None
+        self.client.telemetry_publish("property_key", 3)
+        self.client.telemetry_publish("property_key", 4)
+        work = handler.work_queue.get_nowait()
+        assert work.type == device_cloud._core.constants.WORK_PUBLISH
+        assert handler.work_queue.empty()
+
+        # Single publish is sent once the linger time expires
+        handler.send = mock.Mock()
+        handler.send.return_value = device_cloud.STATUS_SUCCESS
+        handler.handle_publish()
+        handler.to_quit = False
+        handler.linger_thread = device_cloud._core.handler.threading.Thread(
+            target=handler.linger_loop)
+        handler.linger_thread.start()
+        self.client.telemetry_publish("property_key", 5)
+        work = handler.work_queue.get(timeout=2)
+        assert work.type == device_cloud._core.constants.WORK_PUBLISH
+        handler.handle_publish()
+        assert handler.send.call_count == 2
+
+        # Alarms skip the linger time
+        self.client.alarm_publish("alarm_key", 1)
+        work = handler.work_queue.get_nowait()
+        assert work.type == device_cloud._core.constants.WORK_PUBLISH
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+    def tearDown(self):
+        # Ensure threads have stopped
+        self.client.handler.to_quit = True
+        if self.client.handler.linger_thread:
+            self.client.handler.linger_thread.join()
+
 class HandlerInitMissingKey(unittest.TestCase):
     @mock.patch(builtin + ".open")
     @mock.patch("os.path.exists")
@@ -1559,8 +3145,10 @@ class OTAUpdateCallback(unittest.TestCase):
         self.client = device_cloud.Client("testing-client")
         self.ota = device_cloud.ota_handler.OTAHandler()
 
-        result = self.ota.update_callback(self.client, {}, ["aaaa"], None)
+        request = mock.Mock()
+        result = self.ota.update_callback(self.client, {}, ["aaaa"], request)
         assert result[0] == device_cloud.STATUS_INVOKED
+        request.defer.assert_called_once_with(timeout=0)
 
 class OTAUpdateCallbackInProgress(unittest.TestCase):
     @mock.patch("os.path.isfile")
@@ -1572,8 +3160,10 @@ class OTAUpdateCallbackInProgress(unittest.TestCase):
         self.client = device_cloud.Client("testing-client")
         self.ota = device_cloud.ota_handler.OTAHandler()
 
-        result = self.ota.update_callback(self.client, {}, ["aaaa"], None)
+        request = mock.Mock()
+        result = self.ota.update_callback(self.client, {}, ["aaaa"], request)
         assert result[0] == device_cloud.STATUS_FAILURE
+        request.defer.assert_not_called()
 
 class OTAUpdateSoftware(unittest.TestCase):
     """
@@ -1591,6 +3181,7 @@ class OTAUpdateSoftware(unittest.TestCase):
                             "err_action": "err"}
         self.request = mock.Mock()
         self.request.message_id = 1234
+        self.completion = mock.Mock()
 
     @mock.patch("os.remove")
     @mock.patch("os.path")
@@ -1626,6 +3217,7 @@ class OTAUpdateSoftware(unittest.TestCase):
         self.mock_path.reset_mock()
         self.mock_remove.reset_mock()
         self.client.reset_mock()
+        self.completion.reset_mock()
 
         self.mock_execute.side_effect = None
         self.update_data = {"pre_install": "pre", \
@@ -1643,7 +3235,8 @@ class OTAUpdateSoftware(unittest.TestCase):
     def successCase(self):
         self.resetMocks()
 
-        self.ota._update_software(self.client, self.params, self.request)
+        self.ota._update_software(self.client, self.params, self.request,
+                                  self.completion)
 
         self.mock_dl.assert_called_once()
         self.mock_unzip.assert_called_once()
@@ -1651,12 +3244,15 @@ class OTAUpdateSoftware(unittest.TestCase):
         assert self.mock_execute.call_count == 3
         assert mock.call(device_cloud.LOGERROR, "OTA Failed!") not in self.client.log.call_args_list
         assert mock.call(device_cloud.LOGINFO, "OTA Successful!") in self.client.log.call_args_list
+        self.completion.resolve.assert_called_once_with(
+            device_cloud.STATUS_SUCCESS, "")
 
     def downloadFailCase(self):
         self.resetMocks()
         self.mock_dl.return_value = device_cloud.STATUS_FAILURE
 
-        self.ota._update_software(self.client, self.params, self.request)
+        self.ota._update_software(self.client, self.params, self.request,
+                                  self.completion)
 
         self.mock_dl.assert_called_once()
         self.mock_unzip.assert_not_called()
@@ -1665,12 +3261,15 @@ class OTAUpdateSoftware(unittest.TestCase):
         assert mock.call(device_cloud.LOGINFO, "OTA Successful!") not in self.client.log.call_args_list
         assert mock.call(device_cloud.LOGERROR, "Download Failed!") in self.client.log.call_args_list
         assert mock.call(device_cloud.LOGERROR, "OTA Failed!") in self.client.log.call_args_list
+        self.completion.resolve.assert_called_once_with(
+            device_cloud.STATUS_FAILURE, "Failure")
 
     def unzipFailCase(self):
         self.resetMocks()
         self.mock_unzip.return_value = device_cloud.STATUS_IO_ERROR
 
-        self.ota._update_software(self.client, self.params, self.request)
+        self.ota._update_software(self.client, self.params, self.request,
+                                  self.completion)
 
         self.mock_dl.assert_called_once()
         self.mock_unzip.assert_called_once()
@@ -1684,7 +3283,8 @@ class OTAUpdateSoftware(unittest.TestCase):
         self.resetMocks()
         self.mock_read.return_value = (device_cloud.STATUS_FAILURE, "")
 
-        self.ota._update_software(self.client, self.params, self.request)
+        self.ota._update_software(self.client, self.params, self.request,
+                                  self.completion)
 
         self.mock_dl.assert_called_once()
         self.mock_unzip.assert_called_once()
@@ -1699,7 +3299,8 @@ class OTAUpdateSoftware(unittest.TestCase):
         self.mock_execute.return_value = None
         self.mock_execute.side_effect = [device_cloud.STATUS_EXECUTION_ERROR, device_cloud.STATUS_SUCCESS, device_cloud.STATUS_SUCCESS]
 
-        self.ota._update_software(self.client, self.params, self.request)
+        self.ota._update_software(self.client, self.params, self.request,
+                                  self.completion)
 
         self.mock_dl.assert_called_once()
         self.mock_unzip.assert_called_once()
@@ -1713,7 +3314,8 @@ class OTAUpdateSoftware(unittest.TestCase):
         self.resetMocks()
         self.mock_execute.side_effect = [device_cloud.STATUS_SUCCESS, device_cloud.STATUS_EXECUTION_ERROR, device_cloud.STATUS_SUCCESS]
 
-        self.ota._update_software(self.client, self.params, self.request)
+        self.ota._update_software(self.client, self.params, self.request,
+                                  self.completion)
 
         self.mock_dl.assert_called_once()
         self.mock_unzip.assert_called_once()
@@ -1727,7 +3329,8 @@ class OTAUpdateSoftware(unittest.TestCase):
         self.resetMocks()
         self.mock_execute.side_effect = [device_cloud.STATUS_SUCCESS, device_cloud.STATUS_SUCCESS, device_cloud.STATUS_EXECUTION_ERROR, device_cloud.STATUS_SUCCESS]
 
-        self.ota._update_software(self.client, self.params, self.request)
+        self.ota._update_software(self.client, self.params, self.request,
+                                  self.completion)
 
         self.mock_dl.assert_called_once()
         self.mock_unzip.assert_called_once()
@@ -1741,7 +3344,8 @@ class OTAUpdateSoftware(unittest.TestCase):
         self.resetMocks()
         self.update_data["pre_install"] = ""
 
-        self.ota._update_software(self.client, self.params, self.request)
+        self.ota._update_software(self.client, self.params, self.request,
+                                  self.completion)
 
         self.mock_dl.assert_called_once()
         self.mock_unzip.assert_called_once()
@@ -1755,7 +3359,8 @@ class OTAUpdateSoftware(unittest.TestCase):
         self.resetMocks()
         self.update_data["post_install"] = ""
 
-        self.ota._update_software(self.client, self.params, self.request)
+        self.ota._update_software(self.client, self.params, self.request,
+                                  self.completion)
 
         self.mock_dl.assert_called_once()
         self.mock_unzip.assert_called_once()
@@ -1888,6 +3493,129 @@ class ActionCommandExecuteBasic(unittest.TestCase):
         assert result == (0, "command: ['cmd']  ,  stdout:   ,  stderr: ")
         mock_popen.assert_called_once()
 
+class ActionCommandExecuteStream(unittest.TestCase):
+    def runTest(self):
+        client = mock.Mock()
+        client.file_upload.return_value = device_cloud.STATUS_SUCCESS
+        action = device_cloud._core.defs.ActionCommand(
+            "stream", self.command, client, stream=True, tail_bytes=32,
+            progress_interval=60, upload_log=True)
+        request = device_cloud._core.defs.ActionRequest("mail", "stream", {})
+
+        ret_code, result = action.execute(request)
+        assert ret_code == 3
+        assert result.startswith("command: ['{}']  ,  output (last 32 of "
+                                 "{} bytes): ".format(self.command,
+                                                      self.output_bytes))
+        assert result.endswith("line 1999\n  ,  log: stream-mail.log")
+        assert "line 1998" in result
+        assert "line 0\n" not in result
+
+        # The first line is sent straight away, then no more than one a minute
+        client.action_progress_update.assert_called_once_with("mail",
+                                                              "line 0")
+
+        # The full output is uploaded, then removed
+        args, kwargs = client.file_upload.call_args
+        assert kwargs["upload_name"] == "stream-mail.log"
+        with open(args[0], "rb") as log_file:
+            assert len(log_file.read()) == self.output_bytes
+        kwargs["callback"](client, "stream-mail.log",
+                           device_cloud.STATUS_SUCCESS)
+        assert not os.path.exists(args[0])
+
+        # Output is kept to the tail, not all of it
+        tail = device_cloud._core.defs.OutputTail(32)
+        output = ""
+        for num in range(2000):
+            line = "line {}\n".format(num)
+            tail.add(line.encode())
+            output += line
+        assert tail.size < 64
+        assert tail.truncated() is True
+        assert str(tail) == output[-32:]
+
+        # With no tail, none of the output is reported
+        client.reset_mock()
+        action = device_cloud._core.defs.ActionCommand(
+            "stream", self.command, client, stream=True, tail_bytes=0,
+            progress_interval=60)
+        ret_code, result = action.execute(request)
+        assert ret_code == 3
+        assert result == "command: ['{}']  ,  output (last 0 of {} bytes): " \
+            "".format(self.command, self.output_bytes)
+        client.action_progress_update.assert_called_once_with("mail", "")
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.command = os.path.join(self.temp_dir, "lines.sh")
+        with open(self.command, "w") as script:
+            script.write("#!/bin/sh\n"
+                         "i=0\n"
+                         "while [ $i -lt 2000 ]; do\n"
+                         "  echo \"line $i\"\n"
+                         "  i=$((i + 1))\n"
+                         "done\n"
+                         "exit 3\n")
+        os.chmod(self.command, 0o755)
+        self.output_bytes = sum(len("line {}\n".format(num))
+                                for num in range(2000))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+class ActionExecutePrototypes(unittest.TestCase):
+    def runTest(self):
+        Action = device_cloud._core.defs.Action
+        client = mock.Mock()
+        request = device_cloud._core.defs.ActionRequest("1", "name",
+                                                        {"p":1})
+        calls = []
+
+        def no_args():
+            calls.append(())
+        def two_args(client, params):
+            calls.append((client, params))
+        def all_args(client, params, user_data, request, extra=None):
+            calls.append((client, params, user_data, request, extra))
+        def var_args(*args):
+            calls.append(args)
+        def var_kwargs(client, **kwargs):
+            calls.append((client, kwargs))
+
+        class Handler(object):
+            def method(self, client, params, user_data):
+                calls.append((self, client, params, user_data))
+        handler = Handler()
+
+        for callback in (no_args, two_args, all_args, var_args, var_kwargs,
+                         handler.method):
+            Action("name", callback, client, "data").execute(request)
+        assert calls == [(),
+                         (client, {"p":1}),
+                         (client, {"p":1}, "data", request, None),
+                         (client, {"p":1}, "data", request),
+                         (client, {"params":{"p":1}, "user_data":"data",
+                                   "request":request}),
+                         (handler, client, {"p":1}, "data")]
+
+        # Keyword-only parameters are passed by name
+        if sys.version_info.major >= 3:
+            namespace = {"calls":calls}
+            exec("def keywords(client, *, request, other=None):\n"
+                 "    calls.append((client, request, other))\n", namespace)
+            Action("name", namespace["keywords"], client).execute(request)
+            assert calls[-1] == (client, request, None)
+
+        # The prototype is only looked at when the action is created
+        del calls[:]
+        action = Action("name", two_args, client)
+        with mock.patch("device_cloud._core.defs.inspect") as mock_inspect:
+            for _ in range(3):
+                action.execute(request)
+        assert mock_inspect.mock_calls == []
+        assert calls == [(client, {"p":1})] * 3
+
 # this test is failing randomly
 #class ActionCommandExecuteParams(unittest.TestCase):
     #@mock.patch("device_cloud._core.defs.Action")
@@ -1939,6 +3667,250 @@ class HandlerHandleActionException(unittest.TestCase):
     def setUp(self):
         self.config_args = helpers.config_file_default()
 
+class HandlerHandleActionLimits(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    def runTest(self, mock_exists, mock_open):
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+
+        kwargs = {"action_limits":{"slow":{"max_concurrency":1,
+                                           "max_queued":1}}}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        assert self.client.action_limit_set("fast", policy="bogus") == \
+            device_cloud.STATUS_BAD_PARAMETER
+        assert self.client.action_limit_set(
+            "fast", max_concurrency=1,
+            policy=device_cloud.ACTION_POLICY_REJECT) == \
+            device_cloud.STATUS_SUCCESS
+
+        callback = mock.Mock(return_value=(0, "done"))
+        callback.__name__ = "callback"
+        self.client.action_register_callback("slow", callback)
+        self.client.action_register_callback("fast", callback)
+        handler.callbacks.execute_action = mock.Mock(
+            side_effect=lambda request: callback(self.client, request.params))
+        handler.send = mock.Mock(return_value=device_cloud.STATUS_SUCCESS)
+        handler.queue_work = mock.Mock()
+        ActionRequest = device_cloud._core.defs.ActionRequest
+        first = ActionRequest("1", "slow", {})
+        second = ActionRequest("2", "slow", {})
+        third = ActionRequest("3", "slow", {})
+        fourth = ActionRequest("4", "fast", {})
+
+        # While the first request runs, the second waits its turn, the third
+        # has no room to wait and requests of a rejecting action are refused
+        def run_others(client, params):
+            assert handler.handle_action(second) == \
+                device_cloud.STATUS_SUCCESS
+            assert handler.handle_action(third) == \
+                device_cloud.STATUS_SUCCESS
+            handler.action_limit("fast").start(ActionRequest("5", "fast", {}))
+            assert handler.handle_action(fourth) == \
+                device_cloud.STATUS_SUCCESS
+            return (0, "done")
+        callback.side_effect = run_others
+        assert handler.handle_action(first) == device_cloud.STATUS_SUCCESS
+        assert callback.call_count == 1
+        params = [call[0][0].command["params"]
+                  for call in handler.send.call_args_list]
+        assert [param["id"] for param in params] == ["3", "4", "1"]
+        try_again = device_cloud._core.tr50.translate_error_code(
+            device_cloud.STATUS_TRY_AGAIN)
+        assert params[0]["errorCode"] == try_again
+        assert params[1]["errorCode"] == try_again
+        assert params[2]["errorCode"] == \
+            device_cloud._core.tr50.translate_error_code(
+                device_cloud.STATUS_SUCCESS)
+
+        # Finishing the first request hands its turn to the second
+        handler.queue_work.assert_called_once()
+        work = handler.queue_work.call_args[0][0]
+        assert work.type == device_cloud._core.constants.WORK_ACTION
+        assert work.data is second
+        callback.side_effect = None
+        assert handler.handle_action(second) == device_cloud.STATUS_SUCCESS
+        assert callback.call_count == 2
+
+        stats = self.client.action_stats()
+        assert stats["slow"]["running"] == 0
+        assert stats["slow"]["waiting"] == 0
+        assert stats["slow"]["rejected"] == 1
+        assert stats["slow"]["latency"]["count"] == 2
+        assert stats["fast"]["rejected"] == 1
+
+    def setUp(self):
+        self.config_args = helpers.config_file_default()
+
+class HandlerHandleActionDeferred(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    def runTest(self, mock_exists, mock_open):
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+
+        kwargs = {"action_limits":{"update":{"max_concurrency":1}}}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        handler.send = mock.Mock(return_value=device_cloud.STATUS_SUCCESS)
+        handler.queue_work = mock.Mock()
+        completions = []
+
+        def update(client, params, user_data, request):
+            completions.append(request.defer(params.get("timeout")))
+            if params.get("fail"):
+                raise RuntimeError("failed")
+            return device_cloud.STATUS_SUCCESS
+        self.client.action_register_callback("update", update)
+        ActionRequest = device_cloud._core.defs.ActionRequest
+        translate = device_cloud._core.tr50.translate_error_code
+
+        # The callback returns straight away, and the Cloud is told the
+        # request was invoked
+        request = ActionRequest("1", "update", {})
+        assert handler.handle_action(request) == device_cloud.STATUS_SUCCESS
+        command = handler.send.call_args[0][0].command
+        assert command["command"] == "mailbox.update"
+        assert handler.action_completions == {"1":completions[0]}
+        assert self.client.action_stats()["update"]["running"] == 1
+
+        # Resolving it acks the request and frees its turn
+        second = ActionRequest("2", "update", {})
+        assert handler.handle_action(second) == device_cloud.STATUS_SUCCESS
+        assert handler.send.call_count == 1
+        assert completions[0].resolve(device_cloud.STATUS_SUCCESS, "done",
+                                      {"a":1}) == device_cloud.STATUS_SUCCESS
+        command = handler.send.call_args[0][0].command
+        assert command["command"] == "mailbox.ack"
+        assert command["params"] == {"id":"1", "errorCode":0,
+                                     "errorMessage":"done",
+                                     "params":{"a":1}}
+        assert handler.action_completions == {}
+        assert completions[0].done() is True
+        assert completions[0].resolve() == device_cloud.STATUS_FAILURE
+        assert handler.queue_work.call_args[0][0].data is second
+        assert handler.handle_action(second) == device_cloud.STATUS_SUCCESS
+        assert completions[1].resolve(device_cloud.STATUS_FAILURE) == \
+            device_cloud.STATUS_SUCCESS
+
+        # A request not resolved in time times out
+        request = ActionRequest("3", "update", {"timeout":0.01})
+        assert handler.handle_action(request) == device_cloud.STATUS_SUCCESS
+        assert handler.linger_timeout() <= 0.01
+        sleep(0.02)
+        handler.action_expire()
+        command = handler.send.call_args[0][0].command
+        assert command["command"] == "mailbox.ack"
+        assert command["params"]["id"] == "3"
+        assert command["params"]["errorCode"] == \
+            translate(device_cloud.STATUS_TIMED_OUT)
+        assert request.cancelled is True
+        assert handler.action_completions == {}
+        assert completions[2].resolve() == device_cloud.STATUS_FAILURE
+        assert handler.linger_timeout() is None
+        stats = self.client.action_stats()["update"]
+        assert stats["running"] == 0
+        assert stats["timed_out"] == 1
+        assert stats["latency"]["count"] == 3
+
+        # A callback failing after deferring its request acks the failure
+        request = ActionRequest("4", "update", {"fail":True})
+        assert handler.handle_action(request) == device_cloud.STATUS_SUCCESS
+        command = handler.send.call_args[0][0].command
+        assert command["command"] == "mailbox.ack"
+        assert command["params"]["errorCode"] == \
+            translate(device_cloud.STATUS_FAILURE)
+        assert completions[3].resolve() == device_cloud.STATUS_FAILURE
+        assert handler.action_completions == {}
+
+    def setUp(self):
+        self.config_args = helpers.config_file_default()
+
+class HandlerHandleActionTimeout(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    def runTest(self, mock_exists, mock_open):
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+
+        self.client = device_cloud.Client("testing-client")
+        self.client.initialize()
+        handler = self.client.handler
+        self.client.action_limit_set("*", timeout=0.5)
+
+        # A command that outlives its timeout is killed once the linger
+        # thread finds its deadline passed
+        self.client.action_register_command("sleeper", self.command)
+        handler.send = mock.Mock(return_value=device_cloud.STATUS_SUCCESS)
+        request = device_cloud._core.defs.ActionRequest("1", "sleeper", {})
+        worker = threading.Thread(target=handler.handle_action,
+                                  args=(request,))
+        worker.start()
+        sleep(0.2)
+        handler.action_expire()
+        assert request.cancelled is False
+        sleep(0.5)
+        handler.action_expire()
+        assert request.cancelled is True
+        worker.join(5)
+        assert not worker.is_alive()
+        assert request.process.returncode is not None
+        assert not handler.action_deadlines
+
+        handler.send.assert_called_once()
+        params = handler.send.call_args[0][0].command["params"]
+        assert params["id"] == "1"
+        assert params["errorCode"] == \
+            device_cloud._core.tr50.translate_error_code(
+                device_cloud.STATUS_TIMED_OUT)
+        stats = self.client.action_stats()
+        assert stats["sleeper"]["timed_out"] == 1
+        assert stats["sleeper"]["running"] == 0
+
+        # A callback cannot be stopped, it is abandoned and what it returns
+        # later is dropped
+        release = threading.Event()
+        def stuck(client, params, user_data):
+            release.wait(5)
+            return (device_cloud.STATUS_SUCCESS, "late")
+        self.client.action_register_callback("stuck", stuck)
+        handler.send.reset_mock()
+        request = device_cloud._core.defs.ActionRequest("2", "stuck", {})
+        worker = threading.Thread(target=handler.handle_action,
+                                  args=(request,))
+        worker.start()
+        sleep(0.7)
+        handler.action_expire()
+        handler.send.assert_called_once()
+        params = handler.send.call_args[0][0].command["params"]
+        assert params["id"] == "2"
+        assert self.client.action_stats()["stuck"]["running"] == 0
+        release.set()
+        worker.join(5)
+        assert not worker.is_alive()
+        handler.send.assert_called_once()
+        assert self.client.action_stats()["stuck"]["timed_out"] == 1
+
+    def setUp(self):
+        self.config_args = helpers.config_file_default()
+        self.temp_dir = tempfile.mkdtemp()
+        self.command = os.path.join(self.temp_dir, "sleeper.sh")
+        with open(self.command, "w") as script:
+            script.write("#!/bin/sh\nexec sleep 30\n")
+        os.chmod(self.command, 0o755)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
 class RelayInitNoLogger(unittest.TestCase):
     def runTest(self):
         self.relay = device_cloud.relay.Relay("host1.aaa", "host2.aaa", 12345, True, None)
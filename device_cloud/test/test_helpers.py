@@ -13,6 +13,7 @@
     OR CONDITIONS OF ANY KIND, either express or implied.
 '''
 
+import socket
 import ssl
 import sys
 from time import sleep
@@ -55,9 +56,25 @@ def config_file_default():
     return kwargs
 
 
+class SignalQueue(Queue):
+    """
+    Queue that makes a socket readable whenever something is put on it, as
+    incoming data would
+    """
+
+    def __init__(self, sock):
+        Queue.__init__(self)
+        self.sock = sock
+
+    def put(self, item, block=True, timeout=None):
+        Queue.put(self, item, block, timeout)
+        self.sock.send(b"0")
+
+
 def init_mock_mqtt():
     """
-    Pretend initializer for a mock MQTT client object
+    Pretend initializer for a mock MQTT client object. Its socket becomes
+    readable once connecting succeeds and whenever a message is queued.
     """
 
     mock_mqtt = mock.Mock()
@@ -67,10 +84,27 @@ def init_mock_mqtt():
     mock_mqtt.on_message = None
     mock_mqtt.on_connect_rc = 0
     mock_mqtt.on_disconnect_rc = 0
-    mock_mqtt.messages = Queue()
+    sock, peer = socket.socketpair()
+    sock.setblocking(False)
+    mock_mqtt.sockets = (sock, peer)
+    mock_mqtt.messages = SignalQueue(peer)
 
     def mqtt_connect(host, port=1883, keepalive=60, bind_address=""):
         mock_mqtt.on_connect_exec = True
+        peer.send(b"0")
+        return 0
+
+    def mqtt_loop_read(max_packets=1):
+        try:
+            sock.recv(1024)
+        except socket.error:
+            pass
+        if mock_mqtt.on_connect_exec:
+            mock_mqtt.on_connect(mock_mqtt, None, None,
+                                 mock_mqtt.on_connect_rc)
+            mock_mqtt.on_connect_exec = False
+        while not mock_mqtt.messages.empty():
+            mock_mqtt.on_message(mock_mqtt, None, mock_mqtt.messages.get())
         return 0
 
     def mqtt_disconnect():
@@ -94,6 +128,11 @@ def init_mock_mqtt():
     mock_mqtt.connect.side_effect = mqtt_connect
     mock_mqtt.disconnect.side_effect = mqtt_disconnect
     mock_mqtt.loop.side_effect = mqtt_loop
+    mock_mqtt.socket.return_value = sock
+    mock_mqtt.want_write.return_value = False
+    mock_mqtt.loop_read.side_effect = mqtt_loop_read
+    mock_mqtt.loop_write.return_value = 0
+    mock_mqtt.loop_misc.return_value = 0
     mock_mqtt.publish.return_value = (0, 0)
     mock_mqtt.username_pw_set.return_value = 0
 
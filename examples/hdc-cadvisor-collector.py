@@ -133,6 +133,10 @@ def publish_telemetry(name, value, timestamp=None):
         client.log(iot.LOGINFO, "Publishing %s to %s", value, name)
         client.telemetry_publish(name, value)
 
+def publish_telemetry_many(samples):
+    client.log(iot.LOGINFO, "Publishing %d samples", len(samples))
+    client.telemetry_publish_many(samples)
+
 def process_attributes(attributes):
     # Get Machine metrics
     r = requests.get('%s/machine' % cadvisor_base)
@@ -204,7 +208,9 @@ def process_properties(attributes, properties):
                 client.log(iot.LOGWARNING, "Skipping current timestamp as it is older than previous timestamp.")
                 return properties
 
-            # Calculate rates of change
+            # Calculate rates of change. Samples are collected and published
+            # together.
+            samples = []
 
             # cpu_usage_x
             for key in ('total','user','system'):
@@ -216,12 +222,12 @@ def process_properties(attributes, properties):
                 if cpu_usage_x is None:
                     client.log(iot.LOGWARNING, "CPU Usage calculation returned None")
                 else:
-                    publish_telemetry('cpu_usage_%s' % key, str(cpu_usage_x), curr_ts)
+                    samples.append(('cpu_usage_%s' % key, str(cpu_usage_x), curr_ts))
 
             # memory
             for key in ('usage','workingset'):
                 if "memory_%s" % key in curr:
-                    publish_telemetry("memory_%s" % key, curr["memory_%s" % key], curr_ts)
+                    samples.append(("memory_%s" % key, curr["memory_%s" % key], curr_ts))
 
             # cpu_usage_percpu
             for i in range(0, attributes['num_cores']):
@@ -233,7 +239,9 @@ def process_properties(attributes, properties):
                 if cpu_usage_percpu is None:
                     client.log(iot.LOGWARNING, "CPU Usage calculation returned None")
                 else:
-                    publish_telemetry("cpu_percpu_%d" % i, str(cpu_usage_percpu), curr_ts)
+                    samples.append(("cpu_percpu_%d" % i, str(cpu_usage_percpu), curr_ts))
+
+            publish_telemetry_many(samples)
             return curr
     return properties
 
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""
+Microbenchmark of the overhead of calling an action callback, for small
+actions like "ping" that are requested often. Action.execute, which works out
+how to call the callback once when the action is created, is compared with
+looking at the callback's prototype on every call as it used to.
+
+Usage: action_dispatch.py [calls]
+"""
+
+import inspect
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", ".."))
+
+from device_cloud._core import defs
+
+
+class LegacyAction(defs.Action):
+    """
+    Action looking at its callback's prototype every time it is executed
+    """
+
+    def execute(self, request):
+        if hasattr(inspect, "signature"):
+            arglen = len(inspect.signature(self.callback).parameters)
+        else:
+            arglen = len(inspect.getargspec(self.callback).args)
+            if inspect.ismethod(self.callback):
+                arglen -= 1
+        args = [self.client, request.params, self.user_data, request]
+        return self.callback(*args[:arglen])
+
+
+class Device(object):
+    def ping(self, client, params):
+        return 0
+
+
+def ping(client, params):
+    return 0
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    request = defs.ActionRequest("0", "ping", {})
+    print("{:<10} {:>14} {:>14} {:>10}".format(
+        "callback", "legacy ns/call", "cached ns/call", "speedup"))
+    for name, callback in (("function", ping), ("method", Device().ping)):
+        legacy = LegacyAction("ping", callback, None)
+        cached = defs.Action("ping", callback, None)
+        if legacy.execute(request) != cached.execute(request):
+            print("Results differ")
+            return 1
+        legacy_time = min(timeit.repeat(lambda: legacy.execute(request),
+                                        number=calls, repeat=3))
+        cached_time = min(timeit.repeat(lambda: cached.execute(request),
+                                        number=calls, repeat=3))
+        print("{:<10} {:>14.0f} {:>14.0f} {:>9.2f}x".format(
+            name, legacy_time / calls * 1e9, cached_time / calls * 1e9,
+            legacy_time / cached_time))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of telemetry publishes that wait for the Cloud's reply
+(cloud_response=True) from many threads at once. The MQTT connection is
+replaced by one that replies to every command after a fixed delay, so only the
+Client's own overhead is measured. Every publish should succeed.
+
+Usage: confirmed_publish.py [publishers] [publishes each] [reply delay ms]
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", ".."))
+
+from device_cloud._core import constants
+from device_cloud._core import defs
+from device_cloud._core.handler import Handler
+
+if sys.version_info.major == 2:
+    import Queue as queue
+else:
+    import queue
+
+
+class FakeMQTT(object):
+    """
+    Replies successfully to every command of every request, from a thread of
+    its own, delay seconds after it was published
+    """
+
+    def __init__(self, handler, delay):
+        self.handler = handler
+        self.delay = delay
+        self.mid = 0
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.reply_loop)
+        self.thread.start()
+
+    def publish(self, topic, payload, qos=0):
+        with self.lock:
+            self.mid += 1
+            mid = self.mid
+        self.requests.put((time.time() + self.delay, topic, payload))
+        return 0, mid
+
+    def want_write(self):
+        return False
+
+    def reply_loop(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            due, topic, payload = request
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            reply = dict((num, {"success":True})
+                         for num in json.loads(payload))
+            self.handler.handle_message(
+                defs.Message("reply/" + topic[len("api/"):], reply))
+
+    def stop(self):
+        self.requests.put(None)
+        self.thread.join()
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def main():
+    publishers = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    delay = (float(sys.argv[3]) if len(sys.argv) > 3 else 5) / 1000.0
+
+    config = defs.Config()
+    config.update({
+        "key":"benchmark",
+        "cloud":{"host":"localhost", "port":1883, "token":"benchmark"},
+        "proxy":{},
+        "quiet":True,
+        "qos_level":1,
+        "loop_time":1,
+        "thread_count":3,
+        "publish_linger_ms":1
+    })
+    handler = Handler(config, None)
+    handler.logger.setLevel(logging.ERROR)
+    handler.mqtt = FakeMQTT(handler, delay)
+    handler.to_quit = False
+    handler.state = constants.STATE_CONNECTED
+    handler.worker_threads = [threading.Thread(
+        target=handler.handle_work_loop) for _ in range(config.thread_count)]
+    handler.worker_queues = [handler.work_queue]
+    threads = handler.worker_threads + [
+        threading.Thread(target=handler.linger_loop)]
+    for thread in threads:
+        thread.start()
+
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+
+    def publisher(num):
+        for sample in range(count):
+            start = time.time()
+            status = handler.request_publish(
+                defs.PublishTelemetry("property_{}".format(num), sample),
+                True)
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                if status != constants.STATUS_SUCCESS:
+                    failures[0] += 1
+
+    start = time.time()
+    pub_threads = [threading.Thread(target=publisher, args=(num,))
+                   for num in range(publishers)]
+    for thread in pub_threads:
+        thread.start()
+    for thread in pub_threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    handler.to_quit = True
+    for thread in threads:
+        thread.join()
+    handler.mqtt.stop()
+
+    latencies.sort()
+    total = publishers * count
+    print("publishers:  {:>10d}".format(publishers))
+    print("publishes:   {:>10d}".format(total))
+    print("failed:      {:>10d}".format(failures[0]))
+    print("throughput:  {:>10.0f} publishes/s".format(total / elapsed))
+    print("latency p50: {:>10.1f} ms".format(percentile(latencies, 0.5) * 1000))
+    print("latency p99: {:>10.1f} ms".format(percentile(latencies, 0.99) *
+                                             1000))
+    return 1 if failures[0] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the Client's own threads: how long a publish takes to reach the
+socket, how often the threads wake up while there is nothing to do, and how
+long the Client takes to stop. The Handler is compared with a copy that polls
+the way it used to: the MQTT loop, worker threads and linger thread each
+waking every loop_time to check for work. The MQTT connection is replaced by
+one that writes publishes to a local socket, so only the Client is measured.
+
+Usage: loop_latency.py [publishes] [idle seconds] [loop_time]
+"""
+
+import logging
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", ".."))
+
+from device_cloud._core import constants
+from device_cloud._core import defs
+from device_cloud._core.handler import Handler
+
+if sys.version_info.major == 2:
+    import Queue as queue
+else:
+    import queue
+
+
+class FakeMQTT(object):
+    """
+    Writes every publish straight to a local socket, as paho does when its
+    own thread is not running, and records when it was written
+    """
+
+    def __init__(self):
+        self.sock, self.peer = socket.socketpair()
+        self.sock.setblocking(False)
+        self.mid = 0
+        self.written = []
+        self._out_messages = {}
+
+    def publish(self, topic, payload, qos=0):
+        self.mid += 1
+        self.written.append(time.time())
+        return 0, self.mid
+
+    def socket(self):
+        return self.sock
+
+    def want_write(self):
+        return False
+
+    def loop(self, timeout=1.0):
+        select.select([self.sock], [], [], timeout)
+        return self.loop_read()
+
+    def loop_read(self, max_packets=1):
+        try:
+            self.sock.recv(1024)
+        except socket.error:
+            pass
+        return 0
+
+    def loop_write(self, max_packets=1):
+        return 0
+
+    def loop_misc(self):
+        return 0
+
+    def disconnect(self):
+        return 0
+
+
+class LegacyHandler(Handler):
+    """
+    Handler whose threads poll every loop_time instead of waiting for events
+    """
+
+    @property
+    def to_quit(self):
+        return self._to_quit
+
+    @to_quit.setter
+    def to_quit(self, to_quit):
+        self._to_quit = to_quit
+
+    def handle_work_loop(self):
+        while not self.to_quit:
+            try:
+                work = self.work_queue.get(timeout=self.config.loop_time)
+            except queue.Empty:
+                continue
+            if work.type == constants.WORK_PUBLISH:
+                self.handle_publish()
+
+    def linger_timeout(self):
+        return self.config.loop_time
+
+    def mqtt_loop(self, timeout):
+        self.mqtt.loop(timeout=self.config.loop_time)
+
+
+def count_calls(obj, name, counter):
+    """
+    Count the calls to a method of obj in counter[name]
+    """
+
+    method = getattr(obj, name)
+    counter[name] = 0
+
+    def counted(*args, **kwargs):
+        counter[name] += 1
+        return method(*args, **kwargs)
+    setattr(obj, name, counted)
+
+def start(handler_class, loop_time, linger_ms):
+    """
+    Start a connected handler with a main loop, linger thread and worker
+    threads. Returns the handler and its wake up counters.
+    """
+
+    config = defs.Config()
+    config.update({
+        "key":"benchmark",
+        "cloud":{"host":"localhost", "port":1883, "token":"benchmark"},
+        "proxy":{},
+        "quiet":True,
+        "qos_level":1,
+        "loop_time":loop_time,
+        "thread_count":3,
+        "publish_linger_ms":linger_ms
+    })
+    handler = handler_class(config, None)
+    # Nothing replies, so do not list every publish as unanswered on stop
+    handler.logger.setLevel(logging.CRITICAL)
+    handler.mqtt = FakeMQTT()
+    counter = {}
+    count_calls(handler, "mqtt_loop", counter)
+    count_calls(handler, "reply_expire", counter)
+    count_calls(handler.work_queue, "get", counter)
+    handler.to_quit = False
+    handler.state = constants.STATE_CONNECTED
+    handler.main_thread = threading.Thread(target=handler.main_loop)
+    handler.main_thread.start()
+    handler.connect_finish(constants.STATUS_SUCCESS)
+    return handler, counter
+
+def stop(handler):
+    """
+    Stop a handler, returning how many seconds it took
+    """
+
+    begin = time.time()
+    handler.to_quit = True
+    handler.main_thread.join()
+    return time.time() - begin
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def measure(handler_class, publishes, idle, loop_time, linger_ms):
+    handler, counter = start(handler_class, loop_time, linger_ms)
+
+    # Publish one at a time, so each one is measured on its own
+    latencies = []
+    for num in range(publishes):
+        begin = time.time()
+        handler.queue_publish(defs.PublishTelemetry("property", num))
+        while len(handler.mqtt.written) <= num:
+            time.sleep(0.0001)
+        latencies.append(handler.mqtt.written[num] - begin)
+    latencies.sort()
+
+    # Count wake ups while there is nothing to do
+    time.sleep(loop_time)
+    before = dict(counter)
+    cpu = os.times()
+    time.sleep(idle)
+    cpu = sum(os.times()[:2]) - sum(cpu[:2])
+    wakeups = sum(counter[name] - before[name] for name in counter)
+    return latencies, wakeups / float(idle), cpu, stop(handler)
+
+def main():
+    publishes = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    idle = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    loop_time = float(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+    print("{:<8} {:>7} {:>10} {:>10} {:>12} {:>10} {:>10}".format(
+        "loop", "linger", "p50 ms", "p99 ms", "idle wake/s", "idle cpu s",
+        "stop ms"))
+    for linger_ms in (0, 5):
+        for name, handler_class in (("polling", LegacyHandler),
+                                    ("events", Handler)):
+            latencies, wakeups, cpu, stopped = measure(
+                handler_class, publishes, idle, loop_time, linger_ms)
+            print("{:<8} {:>7} {:>10.2f} {:>10.2f} {:>12.2f} {:>10.3f} "
+                  "{:>10.1f}".format(name, linger_ms,
+                                     percentile(latencies, 0.5) * 1000,
+                                     percentile(latencies, 0.99) * 1000,
+                                     wakeups, cpu, stopped * 1000))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
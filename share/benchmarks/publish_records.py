@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""
+Benchmark comparing memory use and throughput of the slotted publish records
+in defs against dict based records that format their timestamp when created,
+as publishes did before.
+
+Usage: publish_records.py [count]
+"""
+
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", ".."))
+
+from device_cloud._core import constants
+from device_cloud._core import defs
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class DictPublishTelemetry(object):
+    """
+    Publish record as it was before: a __dict__ and a formatted timestamp
+    """
+
+    def __init__(self, name, value):
+        self.timestamp = datetime.utcnow().strftime(constants.TIME_FORMAT)
+        self.type = self.__class__.__name__
+        self.spool_id = None
+        self.name = name
+        self.value = value
+        self.aggregate = None
+
+
+def create(pub_class, count):
+    return [pub_class("property", num) for num in range(count)]
+
+def create_and_format(pub_class, count):
+    return [pub.timestamp for pub in create(pub_class, count)]
+
+def memory(pub_class, count):
+    tracemalloc.start()
+    pubs = create(pub_class, count)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del pubs
+    return size
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    for label, pub_class in [("dict", DictPublishTelemetry),
+                             ("slots", defs.PublishTelemetry)]:
+        create_time = min(timeit.repeat(lambda: create(pub_class, count),
+                                        number=1, repeat=3))
+        format_time = min(timeit.repeat(
+            lambda: create_and_format(pub_class, count), number=1, repeat=3))
+        print("{:<6} create: {:>10.0f}/s  create+format: {:>10.0f}/s".format(
+            label, count / create_time, count / format_time))
+        if tracemalloc:
+            print("{:<6} memory: {:>10.1f} bytes per publish".format(
+                label, float(memory(pub_class, count)) / count))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
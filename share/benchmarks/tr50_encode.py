@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""
+Microbenchmark comparing how long it takes to build a TR50 request for a batch
+of telemetry publishes with the create_*_publish functions and with
+tr50.encode_publish. Both must produce the same request.
+
+Usage: tr50_encode.py [batch size] [repeat]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", ".."))
+
+from device_cloud._core import defs
+from device_cloud._core import tr50
+
+THING_KEY = "00000000-0000-0000-0000-000000000000-benchmark"
+
+
+def create_request(pubs):
+    return tr50.generate_request([tr50._create_publish(THING_KEY, pub)
+                                  for pub in pubs])
+
+def encode_request(pubs):
+    return tr50.generate_request_encoded([tr50.encode_publish(THING_KEY, pub)
+                                          for pub in pubs])
+
+def main():
+    batch = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    pubs = [defs.PublishTelemetry("property_{}".format(num % 10), num * 0.5)
+            for num in range(batch)]
+    if create_request(pubs) != encode_request(pubs):
+        print("Requests differ")
+        return 1
+
+    create_time = min(timeit.repeat(lambda: create_request(pubs),
+                                    number=repeat, repeat=3))
+    encode_time = min(timeit.repeat(lambda: encode_request(pubs),
+                                    number=repeat, repeat=3))
+    samples = batch * repeat
+    print("create_*_publish: {:>10.0f} samples/s".format(samples / create_time))
+    print("encode_publish:   {:>10.0f} samples/s".format(samples / encode_time))
+    print("speedup:          {:>10.2f}x".format(create_time / encode_time))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())